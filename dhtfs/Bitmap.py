@@ -0,0 +1,708 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import sys
+import array
+import string
+import struct
+import binascii
+from bisect import bisect_left
+from itertools import compress, ifilterfalse, imap
+
+# Number of values above which a container is kept as a bitset
+ARRAY_MAX = 4096
+
+# Number of bytes in a bitset container
+BITSET_BYTES = 1 << 13
+
+# Arrays are intersected by binary search when one of them is this many times longer
+GALLOP_RATIO = 16
+
+# Largest number of values which are inserted into or removed from a container one by
+# one by the in place operators, instead of building the union or difference
+FEW_VALUES = 64
+
+# Headers of a serialized bitmap and of its containers
+_COUNT = struct.Struct('<I')
+_CONTAINER_HEADER = struct.Struct('<HI')
+
+def _popcount(bits):
+	return bin(bits).count('1')
+
+def _arrayToBitset(values):
+	buf = bytearray(BITSET_BYTES)
+	for v in values:
+		buf[v >> 3] |= 1 << (v & 7)
+	buf.reverse()
+	return long(binascii.hexlify(buf), 16)
+
+def _bitsetValues(bits):
+	# The string holds the bits of the bitset starting with the lowest bit
+	s = bin(bits)[:1:-1]
+	values = []
+	i = s.find('1')
+	while i >= 0:
+		values.append(i)
+		i = s.find('1', i + 1)
+	return values
+
+def _bitsetToArray(bits):
+	return array.array('H', _bitsetValues(bits))
+
+# Tables turning the digits of bin() into bytes holding 0 or 1
+_BIT_BYTES = string.maketrans('01', '\x00\x01')
+_INVERTED_BIT_BYTES = string.maketrans('01', '\x01\x00')
+
+# Recently built byte strings, a query tests many arrays against the same bitsets
+_BIT_BYTES_CACHE_SIZE = 8
+_bitBytesCache = []
+
+def _bitBytes(bits, bit):
+	# One byte per bit of the bitset, set where the bit equals bit. Looking up many
+	# values in it is done by the interpreter in C instead of testing each bit.
+	for entry in _bitBytesCache:
+		if entry[0] is bits and entry[1] == bit:
+			return entry[2]
+
+	if bit:
+		table, pad = _BIT_BYTES, '\x00'
+	else:
+		table, pad = _INVERTED_BIT_BYTES, '\x01'
+	s = bin(bits)[:1:-1].translate(table)
+	b = bytearray(s.ljust(BITSET_BYTES * 8, pad))
+
+	# The entry keeps a reference to the bitset, so its identity can not be reused
+	_bitBytesCache.insert(0, (bits, bit, b))
+	del _bitBytesCache[_BIT_BYTES_CACHE_SIZE:]
+	return b
+
+def _filterArray(values, bits, bit):
+	# Values of the array whose bit in the bitset equals bit
+	b = _bitBytes(bits, bit)
+	return list(compress(values, imap(b.__getitem__, values)))
+
+def _countArray(values, bits):
+	# Number of values of the array set in the bitset
+	b = _bitBytes(bits, 1)
+	return sum(imap(b.__getitem__, values))
+
+def _fromBitset(bits):
+	# Pick the representation for the result of an operation on bitsets
+	if bits == 0:
+		return None
+	if _popcount(bits) <= ARRAY_MAX:
+		return _bitsetToArray(bits)
+	return bits
+
+def _fromValues(values):
+	# Pick the representation for a sorted list of values
+	if len(values) == 0:
+		return None
+	if len(values) <= ARRAY_MAX:
+		return array.array('H', values)
+	return _arrayToBitset(values)
+
+def _isArray(c):
+	return isinstance(c, array.array)
+
+def _cardinality(c):
+	if _isArray(c):
+		return len(c)
+	return _popcount(c)
+
+def _bits(c):
+	if _isArray(c):
+		return _arrayToBitset(c)
+	return c
+
+def _gallop(a1, a2):
+	# Look up the values of the short array in the long one, skipping the part of the
+	# long array which is already behind
+	values = []
+	lo = 0
+	n = len(a2)
+	for v in a1:
+		lo = bisect_left(a2, v, lo)
+		if lo == n:
+			break
+		if a2[lo] == v:
+			values.append(v)
+	return values
+
+def _arrayAnd(a1, a2):
+	if len(a2) < len(a1):
+		a1, a2 = a2, a1
+	if len(a1) * GALLOP_RATIO < len(a2):
+		return _gallop(a1, a2)
+	# Hash the shorter array, filtering the other one keeps the values sorted
+	return filter(set(a1).__contains__, a2)
+
+def _and(c1, c2):
+	if _isArray(c1) and _isArray(c2):
+		return _fromValues(_arrayAnd(c1, c2))
+	if _isArray(c1):
+		c1, c2 = c2, c1
+	if _isArray(c2):
+		return _fromValues(_filterArray(c2, c1, 1))
+	return _fromBitset(c1 & c2)
+
+def _or(c1, c2):
+	if _isArray(c1) and _isArray(c2):
+		return _fromValues(sorted(set(c1).union(c2)))
+	return _bits(c1) | _bits(c2)
+
+def _insert(c, values):
+	# Add a few values to a container, changing an array in place instead of building
+	# the union
+	if not _isArray(c):
+		for v in values:
+			c |= 1 << v
+		return c
+	for v in values:
+		i = bisect_left(c, v)
+		if i == len(c) or c[i] != v:
+			c.insert(i, v)
+	if len(c) > ARRAY_MAX:
+		return _arrayToBitset(c)
+	return c
+
+def _remove(c, values):
+	# Remove a few values from a container, changing an array in place
+	if not _isArray(c):
+		for v in values:
+			c &= ~(1 << v)
+		return _fromBitset(c)
+	for v in values:
+		i = bisect_left(c, v)
+		if i < len(c) and c[i] == v:
+			del c[i]
+	if len(c) == 0:
+		return None
+	return c
+
+def _andNot(c1, c2):
+	if _isArray(c1) and _isArray(c2):
+		return _fromValues(list(ifilterfalse(set(c2).__contains__, c1)))
+	if _isArray(c1):
+		return _fromValues(_filterArray(c1, c2, 0))
+	return _fromBitset(c1 & ~_bits(c2))
+
+def _contains(c, low):
+	if _isArray(c):
+		i = bisect_left(c, low)
+		return i < len(c) and c[i] == low
+	return (c >> low) & 1 == 1
+
+def _andCardinality(c1, c2):
+	if _isArray(c1) and _isArray(c2):
+		return len(set(c1).intersection(c2))
+	if _isArray(c1):
+		c1, c2 = c2, c1
+	if _isArray(c2):
+		return _countArray(c2, c1)
+	return _popcount(c1 & c2)
+
+def _intersects(c1, c2):
+	if _isArray(c1) and _isArray(c2):
+		return not set(c1).isdisjoint(c2)
+	if _isArray(c1):
+		c1, c2 = c2, c1
+	if _isArray(c2):
+		b = _bitBytes(c1, 1)
+		return 1 in imap(b.__getitem__, c2)
+	return c1 & c2 != 0
+
+class Bitmap:
+	"""
+	Compressed bitmap of non negative integers
+
+	The bitmap is organized like a roaring bitmap. Values are grouped by their upper 16 bits
+	and each group is kept in a container holding the lower 16 bits. Sparse containers are
+	sorted arrays, dense containers (more than L{ARRAY_MAX} values) are bitsets kept in a
+	python long, so that operations on them are done a machine word at a time.
+
+	Bitmaps support the set operators &, |, - and their in place versions as well as
+	len(), iteration in ascending order and membership tests.
+	"""
+
+	def __init__(self, values=()):
+		"""
+		Bitmap(values) -> Bitmap containing the given values
+
+		@param values: Non negative integers
+		@type values: iterable
+		"""
+		self.containers = {}
+
+		groups = {}
+		for v in values:
+			groups.setdefault(v >> 16, []).append(v & 0xffff)
+		for high, lows in groups.items():
+			self.containers[high] = _fromValues(sorted(set(lows)))
+
+	def __repr__(self):
+		return '<Bitmap of %d values>' % len(self)
+
+	def __getstate__(self):
+		return self.toString()
+
+	def __setstate__(self, state):
+		self.containers = Bitmap.fromString(state).containers
+
+	def toString(self):
+		"""
+		B.toString() -> Serialized bitmap, see L{fromString}
+
+		The serialized bitmap holds the number of containers followed by the containers in
+		ascending order. Each container has a header with the upper 16 bits and the number
+		of values. Arrays are stored as little endian 16 bit integers, bitsets as
+		L{BITSET_BYTES} bytes with the lowest bits first.
+		"""
+		parts = [_COUNT.pack(len(self.containers))]
+		for high in sorted(self.containers.keys()):
+			c = self.containers[high]
+			if _isArray(c):
+				parts.append(_CONTAINER_HEADER.pack(high, len(c)))
+				if sys.byteorder == 'big':
+					c = array.array('H', c)
+					c.byteswap()
+				parts.append(c.tostring())
+			else:
+				parts.append(_CONTAINER_HEADER.pack(high, _popcount(c)))
+				parts.append(binascii.unhexlify('%0*x' % (2 * BITSET_BYTES, c))[::-1])
+		return ''.join(parts)
+
+	def fromString(cls, s, offset=0):
+		"""
+		Bitmap.fromString(s, offset) -> Bitmap serialized by L{toString}
+
+		@param s: String or buffer holding the serialized bitmap
+		@param offset: Position of the serialized bitmap in s
+		@type offset: int
+		"""
+		b = cls()
+		n, = _COUNT.unpack_from(s, offset)
+		offset += _COUNT.size
+		for i in xrange(n):
+			high, count = _CONTAINER_HEADER.unpack_from(s, offset)
+			offset += _CONTAINER_HEADER.size
+			if count <= ARRAY_MAX:
+				c = array.array('H')
+				c.fromstring(s[offset:offset + 2 * count])
+				if sys.byteorder == 'big':
+					c.byteswap()
+				offset += 2 * count
+			else:
+				c = long(binascii.hexlify(s[offset:offset + BITSET_BYTES][::-1]), 16)
+				offset += BITSET_BYTES
+			b.containers[high] = c
+		return b
+
+	fromString = classmethod(fromString)
+
+	def cardinalityOfString(cls, s, offset=0):
+		"""
+		Bitmap.cardinalityOfString(s, offset) -> Number of values of a bitmap serialized by L{toString}
+
+		Only the headers of the containers are read.
+		"""
+		n, = _COUNT.unpack_from(s, offset)
+		offset += _COUNT.size
+		total = 0
+		for i in xrange(n):
+			high, count = _CONTAINER_HEADER.unpack_from(s, offset)
+			offset += _CONTAINER_HEADER.size
+			if count <= ARRAY_MAX:
+				offset += 2 * count
+			else:
+				offset += BITSET_BYTES
+			total += count
+		return total
+
+	cardinalityOfString = classmethod(cardinalityOfString)
+
+	def __len__(self):
+		n = 0
+		for c in self.containers.itervalues():
+			n += _cardinality(c)
+		return n
+
+	def __nonzero__(self):
+		return len(self.containers) > 0
+
+	def __iter__(self):
+		for high in sorted(self.containers.keys()):
+			c = self.containers[high]
+			base = high << 16
+			if not _isArray(c):
+				c = _bitsetValues(c)
+			for low in c:
+				yield base | low
+
+	def __contains__(self, value):
+		try:
+			c = self.containers[value >> 16]
+		except KeyError:
+			return False
+		return _contains(c, value & 0xffff)
+
+	def __eq__(self, other):
+		if not isinstance(other, Bitmap):
+			return False
+		if sorted(self.containers.keys()) != sorted(other.containers.keys()):
+			return False
+		for high, c in self.containers.items():
+			if _bits(c) != _bits(other.containers[high]):
+				return False
+		return True
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def copy(self):
+		"""
+		B.copy() -> Copy of the bitmap
+		"""
+		b = Bitmap()
+		for high, c in self.containers.items():
+			if _isArray(c):
+				c = array.array('H', c)
+			b.containers[high] = c
+		return b
+
+	def add(self, value):
+		"""
+		B.add(value) -> Add a value to the bitmap
+		"""
+		high = value >> 16
+		low = value & 0xffff
+		c = self.containers.get(high)
+		if c is None:
+			self.containers[high] = array.array('H', [low])
+		elif _isArray(c):
+			i = bisect_left(c, low)
+			if i < len(c) and c[i] == low:
+				return
+			c.insert(i, low)
+			if len(c) > ARRAY_MAX:
+				self.containers[high] = _arrayToBitset(c)
+		else:
+			self.containers[high] = c | (1 << low)
+
+	def discard(self, value):
+		"""
+		B.discard(value) -> Remove a value from the bitmap if present
+		"""
+		high = value >> 16
+		low = value & 0xffff
+		c = self.containers.get(high)
+		if c is None:
+			return
+		if _isArray(c):
+			i = bisect_left(c, low)
+			if i < len(c) and c[i] == low:
+				del c[i]
+			if len(c) == 0:
+				del self.containers[high]
+		elif (c >> low) & 1:
+			self.containers[high] = _fromBitset(c & ~(1 << low))
+			if self.containers[high] is None:
+				del self.containers[high]
+
+	def clear(self):
+		"""
+		B.clear() -> Remove all values
+		"""
+		self.containers.clear()
+
+	def __and__(self, other):
+		b = Bitmap()
+		if len(other.containers) < len(self.containers):
+			self, other = other, self
+		for high, c in self.containers.iteritems():
+			c2 = other.containers.get(high)
+			if c2 is not None:
+				r = _and(c, c2)
+				if r is not None:
+					b.containers[high] = r
+		return b
+
+	def __or__(self, other):
+		b = self.copy()
+		b |= other
+		return b
+
+	def __sub__(self, other):
+		b = Bitmap()
+		for high, c in self.containers.iteritems():
+			c2 = other.containers.get(high)
+			if c2 is None:
+				if _isArray(c):
+					c = array.array('H', c)
+				b.containers[high] = c
+			else:
+				r = _andNot(c, c2)
+				if r is not None:
+					b.containers[high] = r
+		return b
+
+	def __iand__(self, other):
+		self.containers = (self & other).containers
+		return self
+
+	def __ior__(self, other):
+		for high, c2 in other.containers.iteritems():
+			c = self.containers.get(high)
+			if c is None:
+				if _isArray(c2):
+					c2 = array.array('H', c2)
+				self.containers[high] = c2
+			elif _isArray(c2) and len(c2) <= FEW_VALUES:
+				self.containers[high] = _insert(c, c2)
+			else:
+				self.containers[high] = _or(c, c2)
+		return self
+
+	def __isub__(self, other):
+		if other is self:
+			self.containers = {}
+			return self
+		for high, c2 in other.containers.iteritems():
+			c = self.containers.get(high)
+			if c is None:
+				continue
+			if _isArray(c2) and len(c2) <= FEW_VALUES:
+				c = _remove(c, c2)
+			else:
+				c = _andNot(c, c2)
+			if c is None:
+				del self.containers[high]
+			else:
+				self.containers[high] = c
+		return self
+
+	def andCardinality(self, other):
+		"""
+		B.andCardinality(other) -> len(B & other) without building the intersection
+		"""
+		n = 0
+		if len(other.containers) < len(self.containers):
+			self, other = other, self
+		for high, c in self.containers.iteritems():
+			c2 = other.containers.get(high)
+			if c2 is not None:
+				n += _andCardinality(c, c2)
+		return n
+
+	def andCardinalities(self, others):
+		"""
+		B.andCardinalities(others) -> List of B.andCardinality(other) for each of the bitmaps
+
+		Cheaper than calling L{andCardinality} for each bitmap, since the containers of B are
+		turned into bitsets only once.
+		"""
+		probes = {}
+		for high, c in self.containers.iteritems():
+			bits = _bits(c)
+			probes[high] = (bits, _bitBytes(bits, 1))
+
+		counts = []
+		for other in others:
+			n = 0
+			for high, c in other.containers.iteritems():
+				probe = probes.get(high)
+				if probe is None:
+					continue
+				if _isArray(c):
+					n += sum(imap(probe[1].__getitem__, c))
+				else:
+					n += _popcount(c & probe[0])
+			counts.append(n)
+		return counts
+
+	def intersects(self, other):
+		"""
+		B.intersects(other) -> True if B and other have a value in common
+		"""
+		if len(other.containers) < len(self.containers):
+			self, other = other, self
+		for high, c in self.containers.iteritems():
+			c2 = other.containers.get(high)
+			if c2 is not None and _intersects(c, c2):
+				return True
+		return False
+
+	def isSubset(self, other):
+		"""
+		B.isSubset(other) -> True if all values of B are in other
+		"""
+		return self.andCardinality(other) == len(self)
+
+def test():
+	import random
+	import pickle
+
+	print "Running tests ..."
+	random.seed(0)
+
+	def check(b, values):
+		# The bitmap holds the values and every container has the representation
+		# which fits the number of its values
+		if list(b) != sorted(values) or len(b) != len(values):
+			return False
+		for c in b.containers.itervalues():
+			if _cardinality(c) == 0 or _isArray(c) != (_cardinality(c) <= ARRAY_MAX):
+				return False
+		return True
+
+	# Values at the edges of the 65536 value chunks, sparse and dense containers
+	edges = [0, 1, 65535, 65536, 65537, 131071, 131072, (5 << 16) - 1]
+	sets = [set(), set(edges), set(range(ARRAY_MAX)), set(range(ARRAY_MAX + 1)),
+			set(range(65536)), set(range(65530, 65536 + ARRAY_MAX + 6)),
+			set(random.sample(xrange(1 << 18), 3000)),
+			set(random.sample(xrange(1 << 18), 30000)),
+			set(random.sample(xrange(1 << 16), ARRAY_MAX - 10)) | set(edges)]
+
+	# Test 1
+	ok = True
+	for s in sets:
+		b = Bitmap(s)
+		ok = ok and check(b, s) and check(b.copy(), s)
+		for v in edges + [2, 4095, 4096, 70000]:
+			ok = ok and ((v in b) == (v in s))
+	if ok:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test 2
+	ok = True
+	for s1 in sets:
+		for s2 in sets:
+			b1 = Bitmap(s1)
+			b2 = Bitmap(s2)
+			ok = ok and check(b1 & b2, s1 & s2) and check(b1 | b2, s1 | s2) and \
+					check(b1 - b2, s1 - s2)
+			ok = ok and b1.andCardinality(b2) == len(s1 & s2)
+			ok = ok and b1.andCardinalities([b2, b1, Bitmap()]) == [len(s1 & s2), len(s1), 0]
+			ok = ok and b1.intersects(b2) == (not s1.isdisjoint(s2))
+			ok = ok and b1.isSubset(b2) == (s1 <= s2)
+			ok = ok and (b1 == b2) == (s1 == s2)
+			b = b1.copy()
+			b &= b2
+			ok = ok and check(b, s1 & s2)
+			b = b1.copy()
+			b |= b2
+			ok = ok and check(b, s1 | s2)
+			b = b1.copy()
+			b -= b2
+			ok = ok and check(b, s1 - s2)
+			# The operands are not changed
+			ok = ok and check(b1, s1) and check(b2, s2)
+	if ok:
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+	# Test 3
+	# Adding and removing values converts the containers at the threshold
+	s = set(range(0, 2 * ARRAY_MAX, 2))
+	b = Bitmap(s)
+	ok = check(b, s) and _isArray(b.containers[0])
+	b.add(1)
+	s.add(1)
+	ok = ok and check(b, s) and not _isArray(b.containers[0])
+	b.add(1)
+	ok = ok and check(b, s)
+	b.discard(1)
+	s.discard(1)
+	ok = ok and check(b, s) and _isArray(b.containers[0])
+	b.discard(3)
+	ok = ok and check(b, s)
+	for v in range(65530, 65542):
+		b.add(v)
+		s.add(v)
+	ok = ok and check(b, s)
+	for v in sorted(s):
+		b.discard(v)
+	ok = ok and check(b, set()) and not b
+	b.add(65536)
+	b.clear()
+	ok = ok and check(b, set())
+	if ok:
+		print "Test3 succesful"
+	else:
+		print "Test3 Failed"
+
+	# Test 4
+	ok = True
+	for s in sets:
+		b = Bitmap(s)
+		data = 'xyz' + b.toString()
+		ok = ok and check(Bitmap.fromString(data, 3), s)
+		ok = ok and check(Bitmap.fromString(buffer(data), 3), s)
+		ok = ok and Bitmap.cardinalityOfString(data, 3) == len(s)
+		ok = ok and check(pickle.loads(pickle.dumps(b, 2)), s)
+	if ok:
+		print "Test4 succesful"
+	else:
+		print "Test4 Failed"
+
+	# Test 5
+	# Adding and removing a few values at a time in place, across the threshold
+	# between arrays and bitsets
+	ok = True
+	for high in (0, 3):
+		s = set()
+		b = Bitmap()
+		for i in range(400):
+			values = set([(high << 16) | random.randrange(ARRAY_MAX + 3000)
+					for j in range(FEW_VALUES)])
+			if i % 200 < 150:
+				b |= Bitmap(values)
+				s |= values
+			else:
+				values = set(random.sample(s, FEW_VALUES - 1)) | set([high << 16])
+				b -= Bitmap(values)
+				s -= values
+			ok = ok and check(b, s)
+			ok = ok and (i % 200 != 149 or not _isArray(b.containers[high]))
+			ok = ok and (i % 200 != 199 or _isArray(b.containers[high]))
+		s -= set(random.sample(s, 100))
+		b -= b - Bitmap(s)
+		ok = ok and check(b, s)
+	b |= b
+	ok = ok and check(b, s)
+	b -= b
+	ok = ok and check(b, set())
+	if ok:
+		print "Test5 succesful"
+	else:
+		print "Test5 Failed"
+
+if __name__ == "__main__":
+	test()
@@ -0,0 +1,121 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+from zlib import crc32, adler32
+import math
+
+class BloomFilter:
+	"""
+	Set of strings which may report strings as members which were never added, but never
+	misses a string which was added
+
+	The bits of a string are chosen by double hashing of its crc32 and adler32 checksums.
+	The number of bits and hash functions is chosen for the expected number of strings and
+	the rate of false positives wanted. Strings can not be removed.
+	"""
+
+	def __init__(self, capacity, errorRate=0.01):
+		"""
+		@param capacity: Number of strings expected
+		@type capacity: int
+
+		@param errorRate: Rate of false positives when capacity strings were added
+		@type errorRate: float
+		"""
+		capacity = max(capacity, 1)
+		self.capacity = capacity
+		self.bitCount = max(int(-capacity * math.log(errorRate) / (math.log(2) ** 2)), 8)
+		self.hashCount = max(int(round(float(self.bitCount) / capacity * math.log(2))), 1)
+		self.bits = bytearray((self.bitCount + 7) // 8)
+		self.count = 0
+
+	def __repr__(self):
+		return '<BloomFilter of %d/%d strings>' % (self.count, self.capacity)
+
+	def __positions(self, s):
+		if isinstance(s, unicode):
+			s = s.encode('utf-8')
+		h1 = crc32(s) & 0xffffffff
+		h2 = (adler32(s) & 0xffffffff) | 1
+		m = self.bitCount
+		return [(h1 + i * h2) % m for i in range(self.hashCount)]
+
+	def add(self, s):
+		"""
+		B.add(s) -> Add a string
+		"""
+		bits = self.bits
+		for p in self.__positions(s):
+			bits[p >> 3] |= 1 << (p & 7)
+		self.count += 1
+
+	def __contains__(self, s):
+		bits = self.bits
+		for p in self.__positions(s):
+			if not bits[p >> 3] & (1 << (p & 7)):
+				return False
+		return True
+
+	def isFull(self):
+		"""
+		B.isFull() -> True if more strings were added than the filter was sized for
+		"""
+		return self.count > self.capacity
+
+def test():
+	print "Running tests ..."
+
+	# Test 1
+	b = BloomFilter(1000)
+	names = ['name%d' % i for i in range(1000)] + [u'n\xe4me', '']
+	for name in names:
+		b.add(name)
+	if len([name for name in names if name not in b]) == 0 and u'n\xe4me'.encode('utf-8') in b:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test 2
+	# The rate of false positives is close to the one the filter was sized for
+	falsePositives = len([i for i in range(10000) if 'other%d' % i in b])
+	if falsePositives < 10000 * 0.01 * 2:
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+	# Test 3
+	b = BloomFilter(10)
+	for i in range(10):
+		b.add(str(i))
+	full = b.isFull()
+	b.add('10')
+	if not full and b.isFull() and BloomFilter(0).capacity == 1:
+		print "Test3 succesful"
+	else:
+		print "Test3 Failed"
+
+if __name__ == "__main__":
+	test()
@@ -26,6 +26,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import os, sys
+import threading
 from errno import *
 from stat import *
 import fuse
@@ -34,30 +35,96 @@ import TagHelper
 from TagHelper import TagDir, TagFile
 from Tagging import Tagging
 from GPStor import GPStor
+from PathCache import PathCache, AttrCache
+from RWLock import readLocked, writeLocked
 
 fuse.feature_assert('stateful_files')
 
-def flag2mode(flags):
-	md = {os.O_RDONLY: 'r', os.O_WRONLY: 'w', os.O_RDWR: 'w+'}
-	m = md[flags & (os.O_RDONLY | os.O_WRONLY | os.O_RDWR)]
-
-	if flags | os.O_APPEND:
-		m = m.replace('w', 'a', 1)
-
-	return m
+# Positional reads and writes on file descriptors, which do not move the file offset and
+# so can be used by several threads on the same descriptor. Python 2 has no os.pread,
+# there they are called from libc through ctypes.
+try:
+	pread = os.pread
+	pwrite = os.pwrite
+except AttributeError:
+	import ctypes, ctypes.util
+
+	_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	_pread = getattr(_libc, 'pread64', _libc.pread)
+	_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+	_pread.restype = ctypes.c_ssize_t
+	_pwrite = getattr(_libc, 'pwrite64', _libc.pwrite)
+	_pwrite.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64]
+	_pwrite.restype = ctypes.c_ssize_t
+
+	# Each thread reads into its own buffer, which grows to the largest read it made
+	_buffers = threading.local()
+
+	def _check(n):
+		if n < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		return n
+
+	def pread(fd, length, offset):
+		buf = getattr(_buffers, 'buf', None)
+		if buf is None or len(buf) < length:
+			buf = _buffers.buf = ctypes.create_string_buffer(length)
+		while True:
+			try:
+				n = _check(_pread(fd, buf, length, offset))
+				break
+			except OSError, e:
+				if e.errno != EINTR:
+					raise
+		return ctypes.string_at(buf, n)
+
+	def pwrite(fd, data, offset):
+		while True:
+			try:
+				return _check(_pwrite(fd, data, len(data), offset))
+			except OSError, e:
+				if e.errno != EINTR:
+					raise
+
+# Attributes of a file kept with its file in the tags, see Tagging.setAttrs. Times are
+# kept as floats.
+def statToAttrs(st):
+	return (st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid, st.st_gid, st.st_size,
+		st.st_atime, st.st_mtime, st.st_ctime, st.st_blocks)
+
+def attrsToStat(attrs):
+	st = fuse.Stat()
+	(st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid, st.st_gid, st.st_size,
+		st.st_atime, st.st_mtime, st.st_ctime, st.st_blocks) = attrs
+	return st
 
 class Dhtfs(Fuse):
 
 	MAX_DIR_ENTRIES = 210
+	MAX_MATERIALIZED_VIEWS = Tagging.MAX_MATERIALIZED_VIEWS
+	MISSING_CACHE_SIZE = TagDir.MISSING_CACHE_SIZE
+	PATH_CACHE_SIZE = 4096
+	ATTR_CACHE_TIMEOUT = 1.0
+
+	# Number of entries of a listing whose attributes are looked at together
+	READDIR_BATCH = 64
 	MISSING_FILE = '__MISSING_FILE_qwertyuiopasdfghjklzxcvbnm0987654321'		
 
 	DB_FILE = '.dhtfs.db'
 	SEQ_FILE = '.dhtfs.seq'
 
+	# Number of sequence numbers reserved at once. The sequence store holds the highest
+	# number reserved by any process, numbers of a block lost in a crash are not reused.
+	SEQ_BLOCK_SIZE = 4096
+
 	def checkSetup(cls, path):
 		"""
 		D.checkSetup() -> Check whether dhtfs filesystem is setup at path
 
+		Commits which were written to only a part of the tag database are reported on
+		standard error, the file system is still considered to be setup.
+
 		@param path: Path to be checked
 		@type path: str
 
@@ -70,11 +137,15 @@ class Dhtfs(Fuse):
 		if not GPStor.checkSetup(db_path=path, db_file=cls.SEQ_FILE):
 			return False
 
+		for files in Tagging.getIncompleteCommits(db_path=path, db_file=cls.DB_FILE):
+			print >> sys.stderr, "Warning: A change to the tag database at %s was not written to all of %s" % \
+					(path, ', '.join(files))
+
 		return True
 		
 	checkSetup = classmethod(checkSetup)
 
-	def setup(cls, path, forceInit=False):
+	def setup(cls, path, forceInit=False, backend=None):
 		"""
 		D.setup(path, forceInitFlag) -> Do the necessary setup to mount the specified path as a dhtfs file system
 
@@ -83,6 +154,9 @@ class Dhtfs(Fuse):
 
 		@param forceInit: If forceInit is True, do a new setup regardless of whether an older setup is present.
 		@type forceInit: bool
+
+		@param backend: Storage backend for the tag database, see L{Tagging.BACKENDS}.
+		@type backend: str
 		"""
 
 		# If forceInit flag is true, clean up the directory
@@ -95,7 +169,7 @@ class Dhtfs(Fuse):
 
 		# Initialize tagging
 
-		t = Tagging(db_path=path, db_file=cls.DB_FILE)
+		t = Tagging(db_path=path, db_file=cls.DB_FILE, backend=backend)
 		t.initDB(forceInit = forceInit)
 
 		# Initialize sequence generator
@@ -113,7 +187,12 @@ class Dhtfs(Fuse):
 	def __init__(self, *args, **kw):
 
 		Fuse.__init__(self, *args, **kw)
-		self.fileCache = {}
+		self.pathCache = None
+		self.attrCache = None
+		self.rwLock = None
+		self.dirAttrs = {}
+		self.changing = {}
+		self.changingLock = threading.Lock()
 
 	def __initialize(self):
 		try:
@@ -121,13 +200,130 @@ class Dhtfs(Fuse):
 		except:
 			self.getCover = "Dont Care"
 
+		try:
+			X = self.journal
+		except:
+			self.journal = False
+
+		try:
+			self.commitWindow = float(self.commitWindow)
+		except:
+			self.commitWindow = 0.0
+
+		try:
+			X = self.inotify
+		except:
+			self.inotify = False
+
+		try:
+			X = self.views
+		except:
+			self.views = ''
+
+		try:
+			self.maxViews = int(self.maxViews)
+		except:
+			self.maxViews = Dhtfs.MAX_MATERIALIZED_VIEWS
+
+		try:
+			self.missingCacheSize = int(self.missingCacheSize)
+		except:
+			self.missingCacheSize = Dhtfs.MISSING_CACHE_SIZE
+
+		try:
+			X = self.nameFilter
+		except:
+			self.nameFilter = False
+
+		try:
+			self.pathCacheSize = int(self.pathCacheSize)
+		except:
+			self.pathCacheSize = Dhtfs.PATH_CACHE_SIZE
+
+		try:
+			self.attrCacheTimeout = float(self.attrCacheTimeout)
+		except:
+			self.attrCacheTimeout = Dhtfs.ATTR_CACHE_TIMEOUT
+
+		try:
+			X = self.threaded
+		except:
+			self.threaded = False
+
+		try:
+			X = self.directIO
+		except:
+			self.directIO = False
+
+		try:
+			X = self.keepCache
+		except:
+			self.keepCache = False
+
 		self.logger = TagHelper.getLogger('DHTFS')
-		self.tagdir = TagDir(db_path=self.root, db_file=self.DB_FILE, logger=self.logger)
+		self.tagdir = TagDir(db_path=self.root, db_file=self.DB_FILE, logger=self.logger, journal=self.journal,
+				commitWindow=self.commitWindow / 1000, watch=self.inotify,
+				maxMaterializedViews=self.maxViews, missingCacheSize=self.missingCacheSize,
+				nameFilter=self.nameFilter, threaded=self.threaded)
+		# Operations made of several steps on the tags hold its lock
+		self.rwLock = self.tagdir.rwLock
+		self.pathCache = PathCache(self.pathCacheSize)
+		self.tagdir.addIndex(self.pathCache)
+		self.attrCache = AttrCache(self.pathCacheSize, self.attrCacheTimeout)
 		self.__initSequenceNumberGenerator()
 
+		# Directories whose listings are kept up to date on every change
+		for path in self.views.split(':'):
+			dirsInPath = [x for x in path.split(os.path.sep) if x != '']
+			if len(dirsInPath) != 0:
+				self.tagdir.addMaterializedView(dirsInPath)
+
 		self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
 		self.logger.info("Tagging and TagDir instances created for path %s" % self.root)
 		self.logger.info("self.getCover = %s" % self.getCover)
+		self.logger.info("self.journal = %s" % self.journal)
+		self.logger.info("self.commitWindow = %s ms" % self.commitWindow)
+		self.logger.info("self.inotify = %s" % self.inotify)
+		self.logger.info("self.views = %s" % self.views)
+		self.logger.info("self.maxViews = %s" % self.maxViews)
+		self.logger.info("self.missingCacheSize = %s" % self.missingCacheSize)
+		self.logger.info("self.nameFilter = %s" % self.nameFilter)
+		self.logger.info("self.pathCacheSize = %s" % self.pathCacheSize)
+		self.logger.info("self.attrCacheTimeout = %s" % self.attrCacheTimeout)
+		self.logger.info("self.threaded = %s" % self.threaded)
+		self.logger.info("self.directIO = %s" % self.directIO)
+		self.logger.info("self.keepCache = %s" % self.keepCache)
+
+	def __logCommitStats(self):
+		commits, mutations, seconds = self.tagdir.getCommitStats()
+		commitRate = 0.0
+		if seconds > 0:
+			commitRate = commits / seconds
+		mutationsPerCommit = 0.0
+		if commits > 0:
+			mutationsPerCommit = float(mutations) / commits
+		self.logger.info("STATS: %d commits of %d mutations in %.1f seconds, %.2f commits/sec, %.2f mutations per commit"
+				% (commits, mutations, seconds, commitRate, mutationsPerCommit))
+
+		hits, misses, invalidations, entries = self.tagdir.getQueryCacheStats()
+		self.logger.info("STATS: query cache %d hits, %d misses, %d invalidations, %d results cached"
+				% (hits, misses, invalidations, entries))
+
+		hits, misses, invalidations, entries = self.tagdir.getPrefixCacheStats()
+		self.logger.info("STATS: prefix cache %d hits, %d misses, %d invalidations, %d intersections cached"
+				% (hits, misses, invalidations, entries))
+
+		hits, misses, evictions, invalidations, entries = self.pathCache.getStats()
+		self.logger.info("STATS: path cache %d hits, %d misses, %d evictions, %d invalidations, %d paths cached"
+				% (hits, misses, evictions, invalidations, entries))
+
+		hits, misses, entries = self.attrCache.getStats()
+		self.logger.info("STATS: attribute cache %d hits, %d misses, %d files cached"
+				% (hits, misses, entries))
+
+		hits, misses, filtered, entries = self.tagdir.getMissingCacheStats()
+		self.logger.info("STATS: missing path cache %d hits, %d misses, %d names filtered, %d paths cached"
+				% (hits, misses, filtered, entries))
 
 	def __initSequenceNumberGenerator(self):
 		self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
@@ -138,33 +334,61 @@ class Dhtfs(Fuse):
 			self.currentSeqNumber = long(0)
 			self.seqStore.writeData(self.currentSeqNumber)
 			self.logger.info("Initialized seq store with %s" % long(0))
-			
-	def __getNextSeqNumber(self):
+
+		# Numbers up to seqLimit are reserved for this process
+		self.seqLimit = self.currentSeqNumber
+
+	def __reserveSeqNumbers(self):
 		self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
 		ret, num = self.seqStore.getDataRW()
 		self.logger.info("ret = %s, num = %s" % (ret, num))
-		self.currentSeqNumber = num + 1
-		self.seqStore.writeData(self.currentSeqNumber)
+		self.currentSeqNumber = num
+		self.seqLimit = num + Dhtfs.SEQ_BLOCK_SIZE
+		self.seqStore.writeData(self.seqLimit)
+
+	# New names are only generated holding the write lock of the tags
+	def __getNextSeqNumber(self):
+		self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
+		if self.currentSeqNumber >= self.seqLimit:
+			self.__reserveSeqNumbers()
+		self.currentSeqNumber += 1
 		return self.currentSeqNumber
 
 	def getActualPath(self, path):
 		self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
 
-		if path in self.fileCache:
+		actualPath = self.tagdir.lookupIndex(self.pathCache, path)
+		if actualPath:
 			self.logger.info("CACHE: Path %s found in cache" % path)
-			self.logger.info("CACHE: ActualPath = %s" % self.fileCache[path])
-			return self.fileCache[path]
+			self.logger.info("CACHE: ActualPath = %s" % actualPath)
+			return actualPath
+
+		dirs = [x for x in os.path.dirname(path).split(os.path.sep) if x != '']
+		filename = os.path.basename(path)
+
+		# Files depend on the directories of their path and on whether their name is a
+		# directory. Directories depend on the listing of their parent, as do files in
+		# the root directory which are looked for among all files.
+		dependsOn = None
+		if len(dirs) != 0:
+			dependsOn = frozenset(dirs + [filename])
 
 		if path == '/':
 			self.logger.info("Path is root directory")
 			actualPath = self.root
+			dependsOn = frozenset()
+
+		elif self.tagdir.isMissing(dirs, filename):
+			self.logger.info("Path is known to be missing")
+			actualPath = os.path.join(self.root, Dhtfs.MISSING_FILE)
 
 		elif self.tagdir.isDir(os.path.basename(path)):
 			dirpath = os.path.dirname(path)
 			dirname = os.path.basename(path)
-			fileInstances, dirs = self.getDirectoryEntries(dirpath)
-			self.logger.info("dirname = %s, dirs = %s" % (dirname, dirs))
-			if dirname in dirs:
+			fileInstances, subdirs = self.getDirectoryEntries(dirpath)
+			self.logger.info("dirname = %s, dirs = %s" % (dirname, subdirs))
+			dependsOn = None
+			if dirname in subdirs:
 				self.logger.info("Path is directory")
 				actualPath = os.path.join(self.root, 't_' + os.path.basename(path))
 			else:
@@ -172,22 +396,27 @@ class Dhtfs(Fuse):
 				actualPath = os.path.join(self.root, Dhtfs.MISSING_FILE)
 		else:
 			self.logger.info("get actual path from TagHelper")
-			dirs = [x for x in os.path.dirname(path).split(os.path.sep) if x != '']
-			filename = os.path.basename(path)
 			actualLocation = self.tagdir.getActualLocation(dirs, filename)
 			if actualLocation:
 				actualPath = os.path.join(self.root, actualLocation)
 			else:
 				actualPath = os.path.join(self.root, Dhtfs.MISSING_FILE)
 
+		if os.path.basename(actualPath) == Dhtfs.MISSING_FILE:
+			# Lookups of the path are answered without the tags until the next change
+			self.tagdir.addMissing(dirs, filename)
+
 		self.logger.info("Path =  %s, ActualPath =  %s" % (path, actualPath))
 		
 		# Add path to cache
 		self.logger.info("CACHE: Adding path %s to cache" % path)
-		self.fileCache[path] = actualPath
+		self.pathCache.put(path, actualPath, dependsOn)
 
 		return actualPath
 
+	# No change may be made between resolving the path and caching the result
+	getActualPath = readLocked(getActualPath)
+
 	def opendir(self, path):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
 		self.logger.info("path = %s" % path)
@@ -199,33 +428,163 @@ class Dhtfs(Fuse):
 	def getattr(self, path):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
 		self.logger.info("path = %s" % path)
-		return os.lstat(self.getActualPath(path))
+		actualPath = self.getActualPath(path)
 
-	def readdir(self, path, offset):
-		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
-		self.logger.info("path = %s" % path)
+		if path != '/' and actualPath == os.path.join(self.root, 't_' + os.path.basename(path)):
+			return self.__getDirAttrs(actualPath)
 
-		fileInstances, dirs = self.getDirectoryEntries(path)
+		# Files are answered from the attributes kept in the tags. Files which are being
+		# written and files whose attributes were never kept are looked at.
+		if path != '/' and os.path.basename(actualPath) != Dhtfs.MISSING_FILE and \
+				actualPath not in self.changing:
+			attrs = self.tagdir.getAttrs(self.getFileAt(path, actualPath))
+			if attrs is not None:
+				return attrsToStat(attrs)
 
-		# Cache the mapping between 'location in our file system' -> 'location in the underlying file system'
-		self.logger.info("CACHE: Clearing cache")
-		self.fileCache.clear()
-		self.fileCache.update([(os.path.join(path, f.name), os.path.join(self.root, f.location)) for f in fileInstances])
-		self.fileCache.update([(os.path.join(path, dir), os.path.join(self.root, 't_' + dir)) for dir in dirs])
-		self.logger.info("CACHE: Added info for dir %s to cache" % path)
+		return self.attrCache.lstat(actualPath)
 
-		# Get file names from the file object
-		filenames = [f.name for f in fileInstances] 
+	# Directories of tags are empty, so their attributes are only changed by chmod, chown,
+	# utime, rename and rmdir, which drop them
+	def __getDirAttrs(self, actualPath):
+		try:
+			return self.dirAttrs[actualPath]
+		except KeyError:
+			st = self.dirAttrs[actualPath] = os.lstat(actualPath)
+			return st
 
-		# Create a generator for the directory entries
-		for e in filenames + dirs:
-			yield fuse.Direntry(e)
+	def getFileAt(self, path, actualPath):
+		"""
+		File of the tags at a path which was resolved by L{getActualPath}
+
+		Files whose location is not below the root are not found.
+		"""
+		return TagFile(os.path.relpath(actualPath, self.root), os.path.basename(path))
+
+	def __keepAttrs(self, path, actualPath):
+		# The attributes are dropped until a file which is being written is released
+		if path == '/':
+			self.attrCache.remove(actualPath)
+		elif actualPath == os.path.join(self.root, 't_' + os.path.basename(path)):
+			self.dirAttrs.pop(actualPath, None)
+		else:
+			self.changingLock.acquire()
+			try:
+				if actualPath not in self.changing:
+					self.tagdir.setAttrs({ self.getFileAt(path, actualPath) : statToAttrs(os.lstat(actualPath)) })
+			finally:
+				self.changingLock.release()
+			self.attrCache.remove(actualPath)
+
+	def beginFileChange(self, fi, actualPath):
+		"""
+		Called before a file is first changed through a file handle
+
+		The attributes kept with the file are dropped, so that they are not used while
+		the file is written, nor after a crash before the file was released.
+		"""
+		self.changingLock.acquire()
+		try:
+			n = self.changing.get(actualPath, 0)
+			self.changing[actualPath] = n + 1
+			if n == 0:
+				self.tagdir.setAttrs({ fi : None })
+		finally:
+			self.changingLock.release()
+
+	def endFileChange(self, fi, actualPath, st):
+		"""
+		Called when a file handle which changed the file is released
+
+		The attributes of the file are kept once the last handle changing it is released.
+		"""
+		self.changingLock.acquire()
+		try:
+			n = self.changing[actualPath] - 1
+			if n == 0:
+				del self.changing[actualPath]
+				self.tagdir.setAttrs({ fi : statToAttrs(st) })
+			else:
+				self.changing[actualPath] = n
+		finally:
+			self.changingLock.release()
+
+	def readdir(self, path, offset):
+		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
+		self.logger.info("path = %s" % path)
 
-	def getDirectoryEntries(self, path):
-		# Get the directories in the specified path
-		# The directories in the path will be treated as tags
 		dirsInPath = [x for x in path.split(os.path.sep) if x != '']
 
+		# Entries are produced as the kernel takes them. The offset of an entry is the
+		# position of the next entry in the stable order of the listing. The lock is
+		# only held while a batch is taken, the next batch continues after the key of
+		# the last entry even if the listing was changed meanwhile.
+		listing = None
+		cursor = None
+		while True:
+			# No change may be made between listing the entries and caching their paths
+			self.rwLock.acquireRead()
+			try:
+				if listing is None:
+					listing, result = self.__getListingOptions(dirsInPath)
+					entries = self.tagdir.iterDirsAndFilesForDirs(dirsInPath,
+							limit=Dhtfs.READDIR_BATCH, offset=offset, **listing)
+				else:
+					entries = self.tagdir.iterDirsAndFilesForDirs(dirsInPath,
+							limit=Dhtfs.READDIR_BATCH, cursor=cursor, **listing)
+				taken = 0
+				batch = []
+				for kind, e in entries:
+					taken += 1
+					offset += 1
+					if kind == Tagging.ELEMENT:
+						if e.location == Dhtfs.MISSING_FILE:
+							continue
+						# Cache the mapping between 'location in our file system' -> 'location in the underlying file system'
+						dependsOn = None
+						if len(dirsInPath) != 0:
+							dependsOn = frozenset(dirsInPath + [e.name])
+						actualPath = os.path.join(self.root, e.location)
+						self.pathCache.put(os.path.join(path, e.name), actualPath, dependsOn)
+						batch.append((e.name, actualPath, offset, e))
+					else:
+						actualPath = os.path.join(self.root, 't_' + e)
+						self.pathCache.put(os.path.join(path, e), actualPath)
+						batch.append((e, actualPath, offset, None))
+				cursor = entries.cursor
+
+				# Attributes are taken from the tags and from the directories kept in
+				# memory. The other entries are looked at together and kept for the
+				# getattr calls which usually follow a listing.
+				kept = self.tagdir.getAttrsForElements([e for name, actualPath, o, e in batch
+						if e is not None and actualPath not in self.changing])
+				attrs = {}
+				for name, actualPath, o, e in batch:
+					if e is None:
+						st = self.dirAttrs.get(actualPath)
+					elif e in kept:
+						st = attrsToStat(kept[e])
+					else:
+						st = None
+					if st is not None:
+						attrs[actualPath] = st
+				attrs.update(self.attrCache.lstatAll([actualPath for name, actualPath, o, e in batch
+						if actualPath not in attrs]))
+			finally:
+				self.rwLock.releaseRead()
+
+			for name, actualPath, o, e in batch:
+				st = attrs.get(actualPath)
+				if st is None:
+					yield fuse.Direntry(name, offset=o)
+				else:
+					yield fuse.Direntry(name, offset=o, ino=st.st_ino, type=S_IFMT(st.st_mode) >> 12)
+
+			if taken < Dhtfs.READDIR_BATCH:
+				break
+
+	# Choose how the directory given by the tags is listed. Returns the keyword arguments
+	# of TagDir.getDirsAndFilesForDirs and its result if it was already computed.
+	def __getListingOptions(self, dirsInPath):
 		# get files and directories associated with the given tags
 		if self.getCover != 'Always':
 			dirs, files = self.tagdir.getDirsAndFilesForDirs(dirsInPath, beRestrictive=True)
@@ -243,9 +602,21 @@ class Dhtfs(Fuse):
 					len(dirs) + len(files) > Dhtfs.MAX_DIR_ENTRIES and
 					self.getCover != 'Never'
 				):
-			dirs, files = self.tagdir.getDirsAndFilesForDirs(dirsInPath, getCover=True)
+			return { 'getCover' : True, 'coverLimit' : Dhtfs.MAX_DIR_ENTRIES }, None
+
+		return { 'beRestrictive' : True }, (dirs, files)
+
+	def getDirectoryEntries(self, path):
+		# Get the directories in the specified path
+		# The directories in the path will be treated as tags
+		dirsInPath = [x for x in path.split(os.path.sep) if x != '']
+
+		listing, result = self.__getListingOptions(dirsInPath)
+		if result is None:
+			result = self.tagdir.getDirsAndFilesForDirs(dirsInPath, **listing)
 			self.logger.info("After getDirsAndFilesForDirs getCover=True, \
-					dirs = %s, files = %s" %(dirs, files))
+					dirs = %s, files = %s" % result)
+		dirs, files = result
 				
 		files = [f for f in files if f.location != Dhtfs.MISSING_FILE]
 
@@ -255,10 +626,7 @@ class Dhtfs(Fuse):
 	def rmdir(self, path):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
 		self.tagdir.delDirs([os.path.basename(path)])
-
-		# Clear cache
-		self.logger.info("CACHE: Clearing cache")
-		self.fileCache.clear()
+		self.dirAttrs.pop(os.path.join(self.root, 't_' + os.path.basename(path)), None)
 
 	def rename(self, path, path1):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
@@ -270,6 +638,8 @@ class Dhtfs(Fuse):
 			dirs1 = [x for x in path1.split(os.path.sep) if x != '']
 			self.logger.info("Renaming dir %s to %s" % (dirs, dirs1))
 			self.tagdir.renameDir(dirs, dirs1)
+			self.dirAttrs.pop(os.path.join(self.root, 't_' + dirs[-1]), None)
+			self.dirAttrs.pop(os.path.join(self.root, 't_' + dirs1[-1]), None)
 
 		else: # Path is a file
 			dirs = [x for x in os.path.dirname(path).split(os.path.sep) if x != '']
@@ -279,6 +649,7 @@ class Dhtfs(Fuse):
 			location = self.tagdir.getActualLocation(dirs, filename)
 
 			fi = TagFile(location, filename)
+			attrs = self.tagdir.getAttrs(fi)
 
 			# Remove the directories asociated with the file
 			self.tagdir.delFiles([fi], dirs)
@@ -292,23 +663,31 @@ class Dhtfs(Fuse):
 			dirs = [x for x in os.path.dirname(path1).split(os.path.sep) if x != '']
 			self.tagdir.addDirsToFiles([fi], dirs)
 
-		# Clear cache
-		self.logger.info("CACHE: Clearing cache")
-		self.fileCache.clear()
+			# The attributes stay with the file under its new name
+			if attrs is not None:
+				self.tagdir.setAttrs({ fi : attrs })
+
+	rename = writeLocked(rename)
 
 	def chmod(self, path, mode):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
-		os.chmod(self.getActualPath(path), mode)
+		actualPath = self.getActualPath(path)
+		os.chmod(actualPath, mode)
+		self.__keepAttrs(path, actualPath)
 
 	def chown(self, path, user, group):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
-		os.chown(self.getActualPath(path), user, group)
+		actualPath = self.getActualPath(path)
+		os.chown(actualPath, user, group)
+		self.__keepAttrs(path, actualPath)
 
 	def truncate(self, path, len):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
-		f = open(self.getActualPath(path), "a")
+		actualPath = self.getActualPath(path)
+		f = open(actualPath, "a")
 		f.truncate(len)
 		f.close()
+		self.__keepAttrs(path, actualPath)
 
 	def mkdir(self, path, mode):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
@@ -316,19 +695,28 @@ class Dhtfs(Fuse):
 		nf = TagFile(Dhtfs.MISSING_FILE, self.generateNewFileName())
 		self.tagdir.addDirsToFiles([nf], dirs, mode)
 
-		if path in self.fileCache:
-			self.logger.info("CACHE: Remove entry for path %s" % path)
-			del self.fileCache[path]
+		self.logger.info("CACHE: Remove entry for path %s" % path)
+		self.pathCache.remove(path)
+		self.dirAttrs.pop(os.path.join(self.root, 't_' + os.path.basename(path)), None)
+
+	mkdir = writeLocked(mkdir)
 
 	def utime(self, path, times):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
-		os.utime(self.getActualPath(path), times)
+		actualPath = self.getActualPath(path)
+		os.utime(actualPath, times)
+		self.__keepAttrs(path, actualPath)
 
 	def access(self, path, mode):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
 		if not os.access(self.getActualPath(path), mode):
 			return -EACCES
 
+	def fsdestroy(self):
+		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
+		self.tagdir.sync()
+		self.__logCommitStats()
+
 	def statfs(self):
 		self.logger.info("###### In function : %s" % sys._getframe().f_code.co_name)
 		"""
@@ -369,16 +757,16 @@ class Dhtfs(Fuse):
 
 		# If all directories asociated with the file are removed remove the file
 		if len( self.tagdir.getDirsForFiles([fi]) ) == 0:
-			actualPath = self.getActualPath(path)
+			# The path no longer resolves to the file once its directories are removed
+			actualPath = os.path.join(self.root, fi.location)
 			self.logger.info("Deleting actual file since last reference is being deleted")	
 			self.logger.info("Calling delFiles with fileList = %s" % [fi])
 			self.tagdir.delFiles([fi])
 			self.logger.info("Deleting actual file %s" % actualPath)
 			os.unlink(actualPath)
+			self.attrCache.remove(actualPath)
 
-		# Clear cache
-		self.logger.info("CACHE: Clearing cache")
-		self.fileCache.clear()
+	unlink = writeLocked(unlink)
 
 	def generateNewFileName(self):
 		number = self.__getNextSeqNumber()
@@ -405,6 +793,36 @@ class Dhtfs(Fuse):
 				self.logger = server.logger
 				self.logger.info("###### Initiating file object In function : %s" % sys._getframe().f_code.co_name)
 
+				# Let the kernel bypass or keep its page cache for the file
+				if server.directIO:
+					self.direct_io = True
+				if server.keepCache:
+					self.keep_cache = True
+
+				# A missing file is created holding the write lock, so that it is created
+				# only once when several threads open it. Files which exist are opened
+				# without the lock.
+				locked = False
+				try:
+					newCreated = self.__open(path, flags, locked, *mode)
+					if newCreated is None:
+						server.rwLock.acquireWrite()
+						locked = True
+						newCreated = self.__open(path, flags, locked, *mode)
+				finally:
+					if locked:
+						server.rwLock.releaseWrite()
+
+				# The attributes of a new file are kept when it is released. Changes are
+				# begun without the lock of the tags, which is taken by them.
+				self.changing = False
+				if newCreated:
+					server.beginFileChange(self.fi, self.actualPath)
+					self.changing = True
+
+			# Returns whether the file was created, None if it is missing and has to be
+			# created holding the write lock
+			def __open(self, path, flags, locked, *mode):
 				# set the dirs which are associated with this file
 				self.dirs = [x for x in os.path.dirname(path).split(os.path.sep) if x != '']
 
@@ -413,40 +831,56 @@ class Dhtfs(Fuse):
 
 				newCreated = False
 				if os.path.basename(actualPath) == Dhtfs.MISSING_FILE:
+					# No name is taken for a file which is not to be created
+					if not flags & os.O_CREAT:
+						raise OSError(ENOENT, os.strerror(ENOENT), path)
+					if not locked:
+						return None
+
 					# File is not yet created. Create file
 					self.logger.info("Actual path missing")
 					actualPath = server.generateNewFileName()
 					newCreated = True
-					if path in server.fileCache:
-						self.logger.info("CACHE: Remove entry for path %s" % path)
-						del server.fileCache[path]
+					self.logger.info("CACHE: Remove entry for path %s" % path)
+					server.pathCache.remove(path)
 
-				self.file = os.fdopen(os.open(os.path.join(server.root, actualPath), flags, *mode),
-										flag2mode(flags))
-				self.fd = self.file.fileno()
+				# Data is read and written at the given offsets on the descriptor, without
+				# a buffered file object
+				self.actualPath = os.path.join(server.root, actualPath)
+				self.fd = os.open(self.actualPath, flags, *mode)
 
-				filename = os.path.basename(path)
-				self.fi = TagFile(actualPath, filename)
+				self.fi = server.getFileAt(path, self.actualPath)
 
 				if newCreated:
 					self.logger.info("Adding tags %s, to file %s" %(self.dirs, self.fi))
 					# Add tag information for the newly created file
 					server.tagdir.addDirsToFiles([self.fi], self.dirs)
 
+				return newCreated
+
 			def read(self, length, offset):
 				self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
-				self.file.seek(offset)
-				return self.file.read(length)
+				return pread(self.fd, length, offset)
 
 			def write(self, buf, offset):
 				self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
-				self.file.seek(offset)
-				self.file.write(buf)
-				return len(buf)
+				if not self.changing:
+					server.beginFileChange(self.fi, self.actualPath)
+					self.changing = True
+				written = pwrite(self.fd, buf, offset)
+				while written < len(buf):
+					written += pwrite(self.fd, buf[written:], offset + written)
+				server.attrCache.remove(self.actualPath)
+				return written
 
 			def release(self, flags):
 				self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
-				self.file.close()
+				if self.changing:
+					st = os.fstat(self.fd)
+				os.close(self.fd)
+				if self.changing:
+					server.endFileChange(self.fi, self.actualPath, st)
+				server.attrCache.remove(self.actualPath)
 
 			def fsync(self, isfsyncfile):
 				self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
@@ -458,7 +892,6 @@ class Dhtfs(Fuse):
 			def flush(self):
 				self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
 				self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
-				self.file.flush()
 				# cf. xmp_flush() in fusexmp_fh.c
 				os.close(os.dup(self.fd))
 
@@ -468,7 +901,11 @@ class Dhtfs(Fuse):
 
 			def ftruncate(self, len):
 				self.logger.info("In function : %s" % sys._getframe().f_code.co_name)
-				self.file.truncate(len)
+				if not self.changing:
+					server.beginFileChange(self.fi, self.actualPath)
+					self.changing = True
+				os.ftruncate(self.fd, len)
+				server.attrCache.remove(self.actualPath)
 
 		self.file_class = DhtfsFile
 
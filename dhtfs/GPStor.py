@@ -27,17 +27,79 @@
 
 import fcntl
 import os
+import time
+import struct
+import zlib
 import cPickle
+import threading
+import atexit
+from dhtfs import Inotify
+
+class PickleFormat:
+	"""
+	Format in which L{GPStor} writes the stored object by default, a pickle
+	"""
+
+	def load(self, f):
+		"""
+		F.load(f) -> object read from the open file f
+		"""
+		return cPickle.load(f)
+
+	def dump(self, data, f):
+		"""
+		F.dump(data, f) -> write the object to the open file f
+		"""
+		cPickle.dump(data, f)
+
+# Timers of the stores with a sync pending for their commit window. The stores are
+# synced when the interpreter exits and their timers are waited for, instead of
+# leaving the timers to be stopped in the middle.
+_pendingSyncs = {}
+_pendingSyncsLock = threading.Lock()
+
+def _syncPending():
+	_pendingSyncsLock.acquire()
+	try:
+		pending = _pendingSyncs.items()
+	finally:
+		_pendingSyncsLock.release()
+	for store, timer in pending:
+		store.sync()
+		timer.join()
+
+atexit.register(_syncPending)
 
 class GPStor:
 	"""
 	This class implements a persistent store for storing python datatypes.
 
 	Care is taken so that if the store is opened by a process for writing,
-	other processes cannot open the store for either reading or writing.
-	Many processes may read data from the database simultaneously.
-
-	The data will be stored in a text file in python pickle format.
+	other processes cannot open the store for writing. Readers never wait for
+	writers. Every write of the store creates a new generation of the store
+	which replaces the old one with a rename, so a reader always sees a complete
+	generation and keeps using the one it opened. The files of old generations
+	are freed by the file system once no reader has them open.
+
+	By default the data will be stored in python pickle format after a small
+	header holding the generation.
+
+	The store can optionally be journaled. In journaled mode, changes are
+	described by small delta objects which are appended to a log file next to
+	the store instead of rewriting the whole store. A delta is any picklable
+	object with an apply(data) method which changes data in place. Readers load
+	the last checkpoint of the store and replay the deltas which were logged
+	after it. Once the log grows beyond checkpointSize bytes it is folded into
+	the store by a checkpoint.
+
+	The store is written to a temporary file which is synced to disk before it
+	replaces the store, so L{writeData} and checkpoints are durable once they
+	return. Without a commit window a delta is synced after it is appended to
+	the journal, so L{writeDelta} is durable once it returns as well. With a
+	commit window durability is lazy: L{writeDelta} returns as soon as the
+	delta is appended, and the deltas appended within the window are synced
+	together by a single fsync at the end of the window. A crash before that
+	fsync may lose them; call L{sync} to make them durable earlier.
 
 	Typical usage of this class would be as follows:
 
@@ -73,6 +135,23 @@ class GPStor:
 	# default file for the persistent store
 	STORE = '.GPStor_file'
 
+	# Suffix of the file used to log deltas in journaled mode
+	JOURNAL_SUFFIX = '.journal'
+
+	# Size of the journal in bytes after which it is folded into the store
+	CHECKPOINT_SIZE = 1024 * 1024
+
+	# Header of a journal record: length and crc32 of the pickled delta
+	RECORD_HEADER = struct.Struct('!Ii')
+
+	# Suffix of the file the store is written to before it replaces the store
+	TEMP_SUFFIX = '.tmp'
+
+	# Header of the store and of the journal: magic and generation of the store
+	HEADER = struct.Struct('!8sQ')
+	STORE_MAGIC = 'GPSTORE1'
+	JOURNAL_MAGIC = 'GPSJRNL1'
+
 	def checkSetup(cls, db_path=None, db_file=None):
 		"""
 		GPStor.checkSetup(db_path, db_file) -> True if GPStor files present, otherwise false
@@ -110,7 +189,9 @@ class GPStor:
 	def __repr__(self):
 		return 'Database at %s' % (self.__storeFile)
 
-	def __init__(self, db_path = os.getcwd(), db_file = STORE, caching = True):
+	def __init__(self, db_path = os.getcwd(), db_file = STORE, caching = True,
+			journal = False, checkpointSize = CHECKPOINT_SIZE, storeFormat = None,
+			commitWindow = 0, watch = False):
 		"""
 		GPStor() -> instance of GPStor Class
 
@@ -128,12 +209,35 @@ class GPStor:
 		@param caching: Whether caching should be used. Caching will only be used for reads
 				Writes will always be written to disk.
 		@type caching: boolean
+
+		@param journal: Whether deltas passed to L{writeDelta} should be appended to the
+				journal instead of rewriting the whole store.
+		@type journal: boolean
+
+		@param checkpointSize: Size of the journal in bytes after which it is folded into the store.
+		@type checkpointSize: int
+
+		@param storeFormat: Object with load(f) and dump(data, f) methods used to read and
+				write the stored object. Defaults to L{PickleFormat}.
+		@type storeFormat: object
+
+		@param commitWindow: Time in seconds during which deltas written in journaled mode are
+				collected and made durable by a single fsync. With 0 every delta is durable
+				when L{writeDelta} returns, otherwise within commitWindow seconds.
+		@type commitWindow: float
+
+		@param watch: Learn about changes of the store through inotify. Reads served from the
+				cache then do not look at the files of the store until they change. Changes
+				made by other processes are seen as soon as inotify reports them.
+				Ignored where inotify is not available.
+		@type watch: boolean
 		"""
 
 		# Initialize variables
 		self.__db_path = os.path.normpath(db_path)
 		self.__storeFile = os.path.join(self.__db_path, db_file)
 		self.__lockFile = os.path.join(self.__db_path, db_file + ".lock")
+		self.__journalFile = self.__storeFile + GPStor.JOURNAL_SUFFIX
 
 		# Create the store file if not present
 		try:
@@ -147,8 +251,35 @@ class GPStor:
 
 		self.__lockAcquired = False
 		self.__data = None
-		self.__lastupdate = 0
+		self.__signature = None
 		self.__caching = caching
+		self.__journal = journal
+		self.__checkpointSize = checkpointSize
+		self.__journalOffset = 0
+		self.__generation = 0
+		self.__rwData = None
+		if storeFormat is None:
+			storeFormat = PickleFormat()
+		self.__format = storeFormat
+
+		self.__commitWindow = commitWindow
+		self.__syncLock = threading.Lock()
+		self.__cacheLock = threading.RLock()
+		self.__syncTimer = None
+		self.__unsynced = 0
+		self.__groupStart = 0
+		self.__commits = 0
+		self.__mutations = 0
+		self.__startTime = time.time()
+
+		self.__watcher = None
+		self.__seenChanges = 0
+		if watch and Inotify.isAvailable():
+			try:
+				self.__watcher = Inotify.DirectoryWatcher(self.__db_path,
+						[os.path.basename(self.__storeFile), os.path.basename(self.__journalFile)])
+			except OSError:
+				pass
 
 	######## Public functions
 
@@ -157,8 +288,8 @@ class GPStor:
 		T.getTagDictRO() -> (errorcode, object)
 
 		Get the information stored in Database
-		The information got via this function cannot be changed. This function will wait if some other process
-		has obtained the database for writing.
+		The information got via this function cannot be changed. This function does not wait for processes
+		which have obtained the database for writing, it returns the last generation they wrote.
 
 		@rtype:	C{(int, object)}
 		@return: (errorcode, object)
@@ -168,14 +299,8 @@ class GPStor:
 			2. object = object stored in the database
 		"""
 
-		ret = self.__lockSH() # Acquire a shared lock
-		if ret != GPStor.GPS_ERR_SUCCESS:
-			return ret, {}
-
 		ret, data = self.__getData()
 
-		self.__unlock() # release the lock
-
 		return (ret, data)
 
 	def getDataRW(self):
@@ -184,7 +309,7 @@ class GPStor:
 
 		Get the information stored in Database
 		The information got via this function can be changed. This function will wait if some other process
-		has obtained the database for reading or writing.
+		has obtained the database for writing.
 
 		@rtype:	C{(int, object)}
 		@return: (errorcode, object)
@@ -200,7 +325,12 @@ class GPStor:
 
 		self.__lockAcquired = True
 
+		# Changes are only valid on top of the current generation
+		if self.__storeGeneration() != self.__generation:
+			self.__invalidateCache()
+
 		ret, data = self.__getData()
+		self.__rwData = data
 
 		return (ret, data)
 
@@ -226,11 +356,138 @@ class GPStor:
 			
 		ret = self.__writeDataToStore(data)
 		self.__updateCache(data)
+		self.__recordCommit(1)
 
 		self.__unlock()
 		self.__lockAcquired = False
 		return self.GPS_ERR_SUCCESS
 
+	def writeDelta(self, delta):
+		"""
+		T.writeDelta(delta) -> apply a change to the object in the database
+
+		In journaled mode the delta is appended to the journal, so the cost of the write
+		depends on the size of the change and not on the size of the database. The journal
+		is folded into the store once it grows beyond the checkpoint size.
+		Otherwise the delta is applied to the stored object which is then written back.
+		With a commit window the delta is not yet durable when this function returns, see
+		L{sync}.
+
+		Like L{writeData}, this function can only be called after L{getDataRW}.
+
+		@param delta:	Picklable object with an apply(data) method which changes data in place
+		@type delta: object
+
+		@return: 
+			1. L{GPS_ERR_SUCCESS} on success.
+			2. L{GPS_ERR_NOSETUP} if database was not found at the given path
+			3. L{GPS_ERR_NO_LOCK} if function was called without acquiring the necesary lock
+			4. L{GPS_ERR_CORRUPT_DB} if the database could not be read
+		"""
+		if not self.__lockAcquired:
+			return GPStor.GPS_ERR_NO_LOCK
+
+		if not self.__journal:
+			delta.apply(self.__rwData)
+			return self.writeData(self.__rwData)
+
+		if not self.__storeExists():
+			self.__invalidateCache()
+			self.__unlock()
+			self.__lockAcquired = False
+			return GPStor.GPS_ERR_NOSETUP
+
+		self.__appendToJournal(delta)
+		self.__commitDelta()
+
+		# The cache was brought up to date by getDataRW
+		self.__cacheLock.acquire()
+		try:
+			if self.__data is not None:
+				delta.apply(self.__data)
+		finally:
+			self.__cacheLock.release()
+
+		ret = GPStor.GPS_ERR_SUCCESS
+		if self.__journalOffset >= self.__checkpointSize:
+			ret = self.__checkpoint()
+
+		self.__unlock()
+		self.__lockAcquired = False
+		return ret
+
+	def release(self):
+		"""
+		T.release() -> release the lock obtained by L{getDataRW} without changing the database
+
+		@return: L{GPS_ERR_SUCCESS} on success, L{GPS_ERR_NO_LOCK} if no lock was obtained
+		"""
+		if not self.__lockAcquired:
+			return GPStor.GPS_ERR_NO_LOCK
+
+		self.__unlock()
+		self.__lockAcquired = False
+		return GPStor.GPS_ERR_SUCCESS
+
+	def checkpoint(self):
+		"""
+		T.checkpoint() -> fold the journal into the store
+
+		@return: L{GPS_ERR_SUCCESS} on success, error code otherwise
+		"""
+		ret = self.__lockEX()
+		if ret != GPStor.GPS_ERR_SUCCESS:
+			return ret
+
+		ret = self.__checkpoint()
+		self.__unlock()
+		return ret
+
+	def sync(self):
+		"""
+		T.sync() -> make the deltas written in the current commit window durable
+
+		A sync which is pending for the commit window is cancelled, so no thread of the
+		store is left running afterwards.
+		"""
+		self.__syncLock.acquire()
+		try:
+			if self.__unsynced > 0:
+				self.__syncJournal()
+			else:
+				self.__cancelSync()
+		finally:
+			self.__syncLock.release()
+
+	def getCommitStats(self):
+		"""
+		T.getCommitStats() -> (commits, mutations, seconds)
+
+		@return: Number of durable writes, number of changes written by them and the number
+			of seconds since the store was opened
+		@rtype: C{(int, int, float)}
+		"""
+		return self.__commits, self.__mutations, time.time() - self.__startTime
+
+	def getVersion(self, current=False):
+		"""
+		T.getVersion(current) -> Version of the data last read or written
+
+		The version changes with every change of the data, so it tells whether data derived
+		from an earlier read is still valid.
+
+		@param current: Get the version of the database files instead, without reading the data.
+			None if the database is not set up.
+		@type current: bool
+		"""
+		if current:
+			signature = self.__storeSignature()
+			if signature is None:
+				return None
+			return signature, self.__journalSize()
+
+		return self.__signature, self.__journalOffset
+
 
 	################################### Helper functions
 
@@ -242,11 +499,24 @@ class GPStor:
 	
 	############### Functions for getting data
 
+	# Threads reading through the same instance may refresh the cache at the same time
 	def __getData(self):
+		self.__cacheLock.acquire()
+		try:
+			return self.__getCachedData()
+		finally:
+			self.__cacheLock.release()
 
-		if self.__caching and self.__isCacheUpToDate():
+	def __getCachedData(self):
+
+		if self.__caching and self.__isWatchedCacheUpToDate():
 			return GPStor.GPS_ERR_SUCCESS, self.__data
 
+		if self.__caching and self.__isCacheUpToDate():
+			# Bring the cached data up to date with deltas logged by other processes
+			if self.__journalSize() <= self.__journalOffset or self.__replayJournal(self.__data):
+				return GPStor.GPS_ERR_SUCCESS, self.__data
+
 		# Either caching is disabled or the cache is not valid
 		# get the data from the persistent store
 		ret, data = self.__getDataFromStore()
@@ -261,33 +531,256 @@ class GPStor:
 	def __getDataFromStore(self):
 		if not self.__storeExists(): # Store does not exist
 			return GPStor.GPS_ERR_NOSETUP, None
-			
-		f = open(self.__storeFile, "r")
-		try:
-			data = cPickle.load(f) # Read the pickled data from file and unpickle it
-			ret = self.GPS_ERR_SUCCESS
-		except (cPickle.UnpicklingError, EOFError):
-			data = None
-			ret = self.GPS_ERR_CORRUPT_DB
-		except:
-			# TODO: Remove generic except
-			data = None
-			ret = self.GPS_ERR_CORRUPT_DB
 
-		f.close()
-		return (ret, data)
+		# A writer may replace the store after it was opened here. Read the store
+		# again if the journal already belongs to a newer generation.
+		while True:
+			try:
+				f = open(self.__storeFile, "rb")
+			except IOError:
+				return GPStor.GPS_ERR_NOSETUP, None
+
+			try:
+				generation = self.__readHeader(f, GPStor.STORE_MAGIC)
+				signature = (os.fstat(f.fileno()).st_ino, generation)
+				data = self.__format.load(f) # Read the data from file
+				ret = self.GPS_ERR_SUCCESS
+			except (cPickle.UnpicklingError, EOFError):
+				data = None
+				ret = self.GPS_ERR_CORRUPT_DB
+			except:
+				# TODO: Remove generic except
+				data = None
+				ret = self.GPS_ERR_CORRUPT_DB
+
+			f.close()
+
+			if ret != self.GPS_ERR_SUCCESS:
+				return (ret, data)
+
+			self.__generation = generation
+			self.__signature = signature
+			self.__journalOffset = 0
+			if self.__replayJournal(data):
+				return (ret, data)
 
 	def __writeDataToStore(self, data):
 		if not self.__storeExists(): # Store does not exist
 			self.__invalidateCache()
 			return
 
-		# Write data into store
-		f = open(self.__storeFile, "w")
-		cPickle.dump(data, f) # Marshall the dictionary to XML and store it in a file
+		# Write data into a new file which then replaces the store. The old file is left
+		# untouched, so readers which still use the old generation keep a consistent copy.
+		generation = self.__storeGeneration() + 1
+		tempFile = self.__storeFile + GPStor.TEMP_SUFFIX
+		f = open(tempFile, "wb")
+		f.write(GPStor.HEADER.pack(GPStor.STORE_MAGIC, generation))
+		self.__format.dump(data, f)
+		f.flush()
+		os.fsync(f.fileno())
+		signature = (os.fstat(f.fileno()).st_ino, generation)
 		f.close()
+		os.rename(tempFile, self.__storeFile)
+		self.__syncDirectory()
+		self.__generation = generation
+		self.__signature = signature
+
+		# The store now contains everything that was logged
+		if os.path.exists(self.__journalFile):
+			self.__createJournal()
+		else:
+			self.__journalOffset = 0
 		self.__invalidateCache()
 
+	# Generation of the store on disk, 0 for stores written before generations were used
+	def __storeGeneration(self):
+		try:
+			f = open(self.__storeFile, "rb")
+		except IOError:
+			return 0
+
+		generation = self.__readHeader(f, GPStor.STORE_MAGIC)
+		f.close()
+		return generation
+
+	# Read the header of the store or journal and return the generation. Files without
+	# a header belong to generation 0, they are left at their beginning.
+	def __readHeader(self, f, magic):
+		generation = self.__parseHeader(f.read(GPStor.HEADER.size), magic)
+		if generation is None:
+			f.seek(0)
+			return 0
+		return generation
+
+	# Generation in the header of the store or journal, None if it is not a header
+	def __parseHeader(self, header, magic):
+		if len(header) == GPStor.HEADER.size:
+			fileMagic, generation = GPStor.HEADER.unpack(header)
+			if fileMagic == magic:
+				return generation
+		return None
+
+	# Fold the journal into the store. The caller must hold the exclusive lock.
+	def __checkpoint(self):
+		ret, data = self.__getData()
+		if ret != GPStor.GPS_ERR_SUCCESS:
+			return ret
+
+		self.__writeDataToStore(data)
+		self.__updateCache(data)
+		self.__recordCommit(0)
+		return GPStor.GPS_ERR_SUCCESS
+
+	# Make the rename of a file in the database directory durable
+	def __syncDirectory(self):
+		fd = os.open(self.__db_path, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+	############### Functions for the journal
+
+	# Apply the deltas logged after self.__journalOffset to data. Returns False without
+	# changing data if the journal belongs to a newer generation than data.
+	def __replayJournal(self, data):
+		try:
+			f = open(self.__journalFile, "rb")
+		except IOError:
+			return True
+
+		generation = self.__readHeader(f, GPStor.JOURNAL_MAGIC)
+		if generation != self.__generation:
+			f.close()
+			# An older journal only holds deltas which are part of the store
+			return generation < self.__generation
+
+		self.__journalOffset = max(self.__journalOffset, f.tell())
+		f.seek(self.__journalOffset)
+		while True:
+			header = f.read(GPStor.RECORD_HEADER.size)
+			if len(header) < GPStor.RECORD_HEADER.size:
+				break
+
+			length, crc = GPStor.RECORD_HEADER.unpack(header)
+			record = f.read(length)
+			if len(record) < length or zlib.crc32(record) != crc:
+				# Torn write at the end of the journal, the delta was never committed
+				break
+
+			cPickle.loads(record).apply(data)
+			self.__journalOffset += GPStor.RECORD_HEADER.size + length
+
+		f.close()
+		return True
+
+	def __appendToJournal(self, delta):
+		record = cPickle.dumps(delta, cPickle.HIGHEST_PROTOCOL)
+		header = GPStor.RECORD_HEADER.pack(len(record), zlib.crc32(record))
+
+		try:
+			f = open(self.__journalFile, "r+b")
+		except IOError:
+			f = None
+
+		if f is not None and self.__readHeader(f, GPStor.JOURNAL_MAGIC) != self.__generation:
+			f.close()
+			f = None
+
+		# Start a journal for the current generation
+		if f is None:
+			self.__createJournal()
+			f = open(self.__journalFile, "r+b")
+
+		# Write after the last valid record, dropping any torn record
+		f.seek(self.__journalOffset)
+		f.write(header + record)
+		f.truncate()
+		f.close()
+
+		self.__journalOffset += len(header) + len(record)
+
+	# Replace the journal by an empty journal for the current generation. Readers which
+	# have the old journal open can still read it.
+	def __createJournal(self):
+		tempFile = self.__journalFile + GPStor.TEMP_SUFFIX
+		f = open(tempFile, "wb")
+		f.write(GPStor.HEADER.pack(GPStor.JOURNAL_MAGIC, self.__generation))
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		os.rename(tempFile, self.__journalFile)
+		self.__syncDirectory()
+		self.__journalOffset = GPStor.HEADER.size
+
+	# Count a delta appended to the journal and sync the journal if the commit window
+	# of the first unsynced delta has passed
+	def __commitDelta(self):
+		self.__syncLock.acquire()
+		try:
+			now = time.time()
+			self.__unsynced += 1
+			if self.__unsynced == 1:
+				self.__groupStart = now
+
+			if now - self.__groupStart >= self.__commitWindow:
+				self.__syncJournal()
+			elif self.__syncTimer is None:
+				self.__syncTimer = threading.Timer(self.__commitWindow, self.sync)
+				self.__syncTimer.setDaemon(True)
+				self.__syncTimer.start()
+				_pendingSyncsLock.acquire()
+				_pendingSyncs[self] = self.__syncTimer
+				_pendingSyncsLock.release()
+		finally:
+			self.__syncLock.release()
+
+	# Sync the deltas appended to the journal. The caller must hold the sync lock.
+	def __syncJournal(self):
+		try:
+			f = open(self.__journalFile, "rb")
+			os.fsync(f.fileno())
+			f.close()
+		except IOError:
+			# The journal was replaced by a checkpoint, which synced the deltas
+			pass
+		self.__countCommit(0)
+
+	# Count a durable write of the store
+	def __recordCommit(self, mutations):
+		self.__syncLock.acquire()
+		try:
+			self.__countCommit(mutations)
+		finally:
+			self.__syncLock.release()
+
+	# Count a durable write which also made all unsynced deltas durable. The caller must
+	# hold the sync lock.
+	def __countCommit(self, mutations):
+		self.__cancelSync()
+
+		mutations += self.__unsynced
+		if mutations > 0:
+			self.__commits += 1
+			self.__mutations += mutations
+		self.__unsynced = 0
+
+	# Cancel the sync started at the end of the commit window. The caller must hold the
+	# sync lock.
+	def __cancelSync(self):
+		if self.__syncTimer is not None:
+			self.__syncTimer.cancel()
+			self.__syncTimer = None
+			_pendingSyncsLock.acquire()
+			_pendingSyncs.pop(self, None)
+			_pendingSyncsLock.release()
+
+	def __journalSize(self):
+		try:
+			return os.stat(self.__journalFile).st_size
+		except OSError:
+			return 0
+
 	###################### Functions for locking
 
 	# Acquire an exclusive lock.
@@ -300,16 +793,6 @@ class GPStor:
 		fcntl.lockf(self.__lockfd, fcntl.LOCK_EX)
 		return self.GPS_ERR_SUCCESS
 
-	# Acquire shared lock.
-	def __lockSH(self):
-		try:
-			self.__lockfd = file(self.__lockFile, 'r')
-		except:
-			return self.GPS_ERR_CORRUPT_DB
-			
-		fcntl.lockf(self.__lockfd, fcntl.LOCK_SH)
-		return self.GPS_ERR_SUCCESS
-
 	# Release the lock
 	def __unlock(self):
 		fcntl.flock(self.__lockfd, fcntl.LOCK_UN)
@@ -320,17 +803,57 @@ class GPStor:
 
 	def __updateCache(self, data):
 		self.__data = data
-		self.__lastupdate = os.stat(self.__storeFile).st_mtime
 
 	def __invalidateCache(self):
 		self.__data = None
-		self.__lastupdate = 0
+
+	# Identity of the current version of the store: the inode of the file and the
+	# generation in its header, None if there is no store. Every write counts the
+	# generation up, so writes are told apart even when the inode of the previous
+	# generation is reused and the modification time did not change.
+	def __storeSignature(self):
+		try:
+			fd = os.open(self.__storeFile, os.O_RDONLY)
+		except OSError:
+			return None
+
+		try:
+			ino = os.fstat(fd).st_ino
+			generation = self.__parseHeader(os.read(fd, GPStor.HEADER.size), GPStor.STORE_MAGIC)
+		finally:
+			os.close(fd)
+		return ino, generation or 0
 
 	def __isCacheUpToDate(self):
-		if self.__lastupdate < os.stat(self.__storeFile).st_mtime:
+		if self.__data is None:
+			return False
+		if self.__storeSignature() != self.__signature:
+			return False
+		# The journal only shrinks when it is replaced for a new generation
+		if self.__journalSize() < self.__journalOffset:
+			return False
+		return True
+
+	# True if the cache is up to date because inotify reported no change of the store
+	# or the journal since they were last looked at
+	def __isWatchedCacheUpToDate(self):
+		if self.__watcher is None:
 			return False
-		else:
-			return True
+
+		changes = self.__watcher.changes
+		upToDate = self.__data is not None and self.__watcher.alive and changes == self.__seenChanges
+		self.__seenChanges = changes
+		return upToDate
+
+class AppendDelta:
+	"""
+	Delta used for testing journaled mode. Appends an item to a list.
+	"""
+	def __init__(self, item):
+		self.item = item
+
+	def apply(self, data):
+		data.append(self.item)
 
 def test():
 	TEST_DIR = '/tmp/zzzzzzzzzzzzz'
@@ -401,5 +924,63 @@ def test():
 	else:
 		 print "Test4 Failed"
 
+	# Test 5
+	g = GPStor(TEST_DIR, 'journal_db', journal=True, checkpointSize=200)
+	g.getDataRW()
+	g.writeData([])
+	g1 = GPStor(TEST_DIR, 'journal_db', journal=True, checkpointSize=200)
+	g1.getDataRO()
+	for i in range(20):
+		g.getDataRW()
+		g.writeDelta(AppendDelta(i))
+	ret, data1 = g1.getDataRO()
+	if ret == 0 and data1 == range(20):
+		 print "Test5 succesful"
+	else:
+		 print "Test5 Failed"
+
+	# Test 6
+	def timers():
+		return [t for t in threading.enumerate() if isinstance(t, threading._Timer)]
+
+	def waitForTimers(pending):
+		# Cancelled timers end as soon as they are woken up
+		for t in pending:
+			t.join(1)
+		return len(timers()) == 0
+
+	g = GPStor(TEST_DIR, 'group_db', journal=True, commitWindow=60)
+	g.getDataRW()
+	g.writeData([])
+	for i in range(10):
+		g.getDataRW()
+		g.writeDelta(AppendDelta(i))
+	pending = timers()
+	g.sync()
+	commits, mutations, seconds = g.getCommitStats()
+	ret, data1 = GPStor(TEST_DIR, 'group_db').getDataRO()
+	if ret == 0 and data1 == range(10) and (commits, mutations) == (2, 11) and \
+			len(pending) == 1 and waitForTimers(pending):
+		 print "Test6 succesful"
+	else:
+		 print "Test6 Failed"
+
+	# Test 7
+	# Writes of the same size in quick succession, which may reuse the inode of the
+	# previous generation within the same modification time
+	g = GPStor(TEST_DIR, 'version_db')
+	g1 = GPStor(TEST_DIR, 'version_db')
+	failed = False
+	for i in range(100):
+		g.getDataRW()
+		g.writeData(i % 10)
+		ret, data1 = g1.getDataRO()
+		if ret != 0 or data1 != i % 10:
+			failed = True
+	if not failed:
+		 print "Test7 succesful"
+	else:
+		 print "Test7 Failed"
+
 if __name__ == "__main__":
 	test()
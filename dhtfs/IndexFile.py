@@ -0,0 +1,660 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import sys
+import mmap
+import array
+import struct
+import cPickle
+from bisect import bisect_left
+
+from dhtfs.Bitmap import Bitmap
+from dhtfs.TagIndex import TagIndex, IndexTagView
+from dhtfs.TagStore import PickleTagStore, elementKey
+
+# Layout of an index. All integers are little endian, offsets are counted from the
+# start of the index in the file.
+#
+# Header		HEADER
+# Tags			pickled tag followed by its posting list, a serialized Bitmap
+# Elements		key of the element, see elementKey, followed by the ids of its tags
+#			and its pickled attributes
+# Tag directory		TAG_ENTRY for every tag id, zero for free ids
+# Element table		ELEMENT_ENTRY for every element id, zero for free ids
+# Key index		ids of the elements sorted by their key
+# Live elements		serialized Bitmap of the ids of all elements
+# Free tag ids
+# Free element ids
+# Attribute table	ATTR_ENTRY for every element id, zero for ids without attributes
+
+MAGIC = 'DHTFSIDX'
+VERSION = 2
+
+# Magic, version, number of tag ids, number of element ids, number of elements and
+# the offsets of the tag directory, element table, key index, live elements (with its
+# length), free tag ids, free element ids (with their counts) and attribute table
+HEADER = struct.Struct('<8sIIIIQQQQIQIQIQ')
+
+# Offset and length of the pickled tag, offset and length of the posting list
+TAG_ENTRY = struct.Struct('<QIQI')
+
+# Offset and length of the key, offset and number of the tag ids
+ELEMENT_ENTRY = struct.Struct('<QIQI')
+
+# Offset and length of the pickled attributes
+ATTR_ENTRY = struct.Struct('<QI')
+
+ID = struct.Struct('<I')
+
+def _idsToString(ids):
+	a = array.array('I', ids)
+	if sys.byteorder == 'big':
+		a.byteswap()
+	return a.tostring()
+
+class IndexImage:
+	"""
+	Read only access to an index file mapped into memory
+
+	Nothing is read from the file before it is asked for, so opening an image takes the
+	same time whatever the size of the index. Processes mapping the same file share the
+	pages of the file in the page cache.
+	"""
+
+	def __init__(self, f):
+		"""
+		@param f: File opened for reading, positioned at the start of the index. The image
+			stays valid after the file is closed.
+		@type f: file
+		"""
+		self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.base = f.tell()
+		(magic, version, self.tagCount, self.elementCount, self.keyCount,
+			tagTable, elementTable, keyIndex, liveOffset, self.liveLength,
+			freeTagsOffset, self.freeTagCount,
+			freeElementsOffset, self.freeElementCount,
+			attrTable) = HEADER.unpack_from(self.map, self.base)
+
+		if magic != MAGIC:
+			raise ValueError('%s is not a tag index' % f.name)
+		if version != VERSION:
+			raise ValueError('Unsupported version %d of tag index %s' % (version, f.name))
+
+		self.tagTable = self.base + tagTable
+		self.elementTable = self.base + elementTable
+		self.keyIndex = self.base + keyIndex
+		self.liveOffset = self.base + liveOffset
+		self.freeTagsOffset = self.base + freeTagsOffset
+		self.freeElementsOffset = self.base + freeElementsOffset
+		self.attrTable = self.base + attrTable
+
+	def __ids(self, offset, count):
+		a = array.array('I')
+		a.fromstring(self.map[offset:offset + ID.size * count])
+		if sys.byteorder == 'big':
+			a.byteswap()
+		return a
+
+	def __tagEntry(self, id):
+		offset, length, postingOffset, postingLength = TAG_ENTRY.unpack_from(self.map,
+				self.tagTable + TAG_ENTRY.size * id)
+		return self.base + offset, length, self.base + postingOffset, postingLength
+
+	def __elementEntry(self, id):
+		offset, length, tagsOffset, tagCount = ELEMENT_ENTRY.unpack_from(self.map,
+				self.elementTable + ELEMENT_ENTRY.size * id)
+		return self.base + offset, length, self.base + tagsOffset, tagCount
+
+	def getTag(self, id):
+		"""
+		I.getTag(id) -> Tag with the given id, None for a free id
+		"""
+		offset, length, postingOffset, postingLength = self.__tagEntry(id)
+		if length == 0:
+			return None
+		return cPickle.loads(self.map[offset:offset + length])
+
+	def getPosting(self, id):
+		"""
+		I.getPosting(id) -> Bitmap of the elements associated with the tag
+		"""
+		return Bitmap.fromString(self.map, self.__tagEntry(id)[2])
+
+	def getPostingCount(self, id):
+		"""
+		I.getPostingCount(id) -> Number of elements associated with the tag
+		"""
+		return Bitmap.cardinalityOfString(self.map, self.__tagEntry(id)[2])
+
+	def getPostingString(self, id):
+		"""
+		I.getPostingString(id) -> Posting list of the tag as stored in the file
+		"""
+		offset, length, postingOffset, postingLength = self.__tagEntry(id)
+		return self.map[postingOffset:postingOffset + postingLength]
+
+	def getKey(self, id):
+		"""
+		I.getKey(id) -> Key of the element with the given id, None for a free id
+		"""
+		offset, length, tagsOffset, tagCount = self.__elementEntry(id)
+		if length == 0:
+			return None
+		return self.map[offset:offset + length]
+
+	def getElement(self, id):
+		"""
+		I.getElement(id) -> Element with the given id, None for a free id
+		"""
+		key = self.getKey(id)
+		if key is None:
+			return None
+		return cPickle.loads(key)
+
+	def getTagIdsOf(self, id):
+		"""
+		I.getTagIdsOf(id) -> Set of the ids of the tags associated with the element
+		"""
+		offset, length, tagsOffset, tagCount = self.__elementEntry(id)
+		return set(self.__ids(tagsOffset, tagCount))
+
+	def getTagIdsString(self, id):
+		"""
+		I.getTagIdsString(id) -> Ids of the tags of the element as stored in the file
+		"""
+		offset, length, tagsOffset, tagCount = self.__elementEntry(id)
+		return self.map[tagsOffset:tagsOffset + ID.size * tagCount]
+
+	def getAttrsString(self, id):
+		"""
+		I.getAttrsString(id) -> Pickled attributes of the element, empty if it has none
+		"""
+		offset, length = ATTR_ENTRY.unpack_from(self.map, self.attrTable + ATTR_ENTRY.size * id)
+		if length == 0:
+			return ''
+		return self.map[self.base + offset:self.base + offset + length]
+
+	def getAttrs(self, id):
+		"""
+		I.getAttrs(id) -> Attributes of the element, None if it has none
+		"""
+		attrs = self.getAttrsString(id)
+		if not attrs:
+			return None
+		return cPickle.loads(attrs)
+
+	def findElement(self, key):
+		"""
+		I.findElement(key) -> Id of the element with the given key, None if there is none
+		"""
+		lo = 0
+		hi = self.keyCount
+		while lo < hi:
+			mid = (lo + hi) // 2
+			id, = ID.unpack_from(self.map, self.keyIndex + ID.size * mid)
+			k = self.getKey(id)
+			if k < key:
+				lo = mid + 1
+			elif k > key:
+				hi = mid
+			else:
+				return id
+		return None
+
+	def getLive(self):
+		"""
+		I.getLive() -> Bitmap of the ids of all elements
+		"""
+		return Bitmap.fromString(self.map, self.liveOffset)
+
+	def getFreeTagIds(self):
+		return list(self.__ids(self.freeTagsOffset, self.freeTagCount))
+
+	def getFreeElementIds(self):
+		return list(self.__ids(self.freeElementsOffset, self.freeElementCount))
+
+class LazyTable:
+	"""
+	Dictionary of values read from an L{IndexImage} when they are first used
+
+	Values set or deleted are kept in memory and hide the values of the image.
+	"""
+
+	def __init__(self, load, stored):
+		"""
+		@param load: Function returning the value of a key from the image
+		@param stored: Keys of the values in the image
+		"""
+		self.load = load
+		self.stored = stored
+		self.values = {}
+		self.removed = set([])
+
+	def isStored(self, key):
+		"""
+		T.isStored(key) -> True if the value of key was neither used nor changed
+		"""
+		return key not in self.values and key not in self.removed and key in self.stored
+
+	def __getitem__(self, key):
+		try:
+			return self.values[key]
+		except KeyError:
+			pass
+
+		if key in self.removed or key not in self.stored:
+			raise KeyError(key)
+
+		# Values may be changed in place, so keep the value once it is read
+		value = self.load(key)
+		self.values[key] = value
+		return value
+
+	def __setitem__(self, key, value):
+		self.values[key] = value
+
+	def __delitem__(self, key):
+		self[key]
+		self.values.pop(key, None)
+		self.removed.add(key)
+
+	def __contains__(self, key):
+		return key in self.values or (key not in self.removed and key in self.stored)
+
+	def __len__(self):
+		return len(self.keys())
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def pop(self, key):
+		value = self[key]
+		del self[key]
+		return value
+
+	def keys(self):
+		return [key for key in self.stored if self.isStored(key)] + self.values.keys()
+
+	def items(self):
+		return [(key, self[key]) for key in self.keys()]
+
+class LazyElements:
+	"""
+	List of the elements of an L{IndexImage}, indexed by element id
+	"""
+
+	def __init__(self, image):
+		self.image = image
+		self.length = image.elementCount
+		self.changed = {}
+		self.loaded = {}
+
+	def isStored(self, id):
+		"""
+		E.isStored(id) -> True if the element with the given id was not changed
+		"""
+		return id not in self.changed and id < self.image.elementCount
+
+	def __getitem__(self, id):
+		# Looked up for every element of a result, so missing keys are not caught
+		if id in self.loaded:
+			return self.loaded[id]
+		if id in self.changed:
+			return self.changed[id]
+
+		if id >= self.length:
+			raise IndexError('element id out of range')
+
+		element = self.image.getElement(id)
+		self.loaded[id] = element
+		return element
+
+	def __setitem__(self, id, element):
+		self.loaded.pop(id, None)
+		self.changed[id] = element
+
+	def __len__(self):
+		return self.length
+
+	def append(self, element):
+		self.changed[self.length] = element
+		self.length += 1
+
+class LazyElementIds:
+	"""
+	Dictionary mapping the elements of an L{IndexImage} to their ids
+
+	Elements are looked up in the key index of the image by their L{elementKey}.
+	"""
+
+	def __init__(self, image):
+		self.image = image
+		self.count = image.keyCount
+		self.changed = {}
+		self.removed = set([])
+		self.found = {}
+
+	def __getitem__(self, element):
+		try:
+			return self.changed[element]
+		except KeyError:
+			pass
+
+		if element in self.removed:
+			raise KeyError(element)
+
+		try:
+			id = self.found[element]
+		except KeyError:
+			id = self.image.findElement(elementKey(element))
+			self.found[element] = id
+
+		if id is None:
+			raise KeyError(element)
+		return id
+
+	def __setitem__(self, element, id):
+		if element not in self:
+			self.count += 1
+		self.changed[element] = id
+
+	def __delitem__(self, element):
+		self[element]
+		self.changed.pop(element, None)
+		self.removed.add(element)
+		self.count -= 1
+
+	def __contains__(self, element):
+		try:
+			self[element]
+		except KeyError:
+			return False
+		return True
+
+	def __len__(self):
+		return self.count
+
+	def get(self, element, default=None):
+		try:
+			return self[element]
+		except KeyError:
+			return default
+
+class MappedTagIndex(TagIndex):
+	"""
+	L{TagIndex} read from an L{IndexImage}
+
+	The tag directory is read when the index is opened, posting lists, elements and the tags
+	of elements when they are first used. Changes made by applying deltas are kept in memory
+	on top of the image until the index is written to a new file by L{IndexFormat}.
+	"""
+
+	def __init__(self, image=None):
+		TagIndex.__init__(self)
+		self.image = image
+		if image is None:
+			return
+
+		self.tags = [image.getTag(id) for id in xrange(image.tagCount)]
+		for id, tag in enumerate(self.tags):
+			if tag is not None:
+				self.tagIds[tag] = id
+		self.freeTagIds = image.getFreeTagIds()
+		self.freeElementIds = image.getFreeElementIds()
+
+		self.postings = LazyTable(image.getPosting, set(self.tagIds.values()))
+		self.tagCounts = LazyTable(image.getPostingCount, set(self.tagIds.values()))
+		# The ids stored in the image are shared by the lazy tables, the ids of the
+		# index change with it
+		stored = image.getLive()
+		self.e2t = LazyTable(image.getTagIdsOf, stored)
+		# Elements without attributes are kept with None
+		self.attrs = LazyTable(image.getAttrs, stored)
+		self.elements = LazyElements(image)
+		self.elementIds = LazyElementIds(image)
+		self.live = stored.copy()
+
+	def getPostingString(self, id):
+		"""
+		I.getPostingString(id) -> Serialized posting list of the tag
+		"""
+		if self.image is not None and self.postings.isStored(id):
+			return self.image.getPostingString(id)
+		return self.postings[id].toString()
+
+	def getTagIdsString(self, id):
+		"""
+		I.getTagIdsString(id) -> Serialized ids of the tags of the element
+		"""
+		if self.image is not None and self.e2t.isStored(id):
+			return self.image.getTagIdsString(id)
+		return _idsToString(sorted(self.e2t[id]))
+
+	def getAttrsString(self, id):
+		"""
+		I.getAttrsString(id) -> Pickled attributes of the element, empty if it has none
+		"""
+		if self.image is not None and self.attrs.isStored(id):
+			return self.image.getAttrsString(id)
+		attrs = self.attrs.get(id)
+		if attrs is None:
+			return ''
+		return cPickle.dumps(attrs, cPickle.HIGHEST_PROTOCOL)
+
+	def getElementKey(self, id):
+		"""
+		I.getElementKey(id) -> L{elementKey} of the element, None for a free id
+		"""
+		if self.image is not None and self.elements.isStored(id):
+			return self.image.getKey(id)
+		element = self.elements[id]
+		if element is None:
+			return None
+		return elementKey(element)
+
+class IndexFormat:
+	"""
+	Format in which L{GPStor} keeps a L{MappedTagIndex}, see the layout at the top of
+	this module
+	"""
+
+	def load(self, f):
+		return MappedTagIndex(IndexImage(f))
+
+	def dump(self, index, f):
+		start = f.tell()
+		offset = HEADER.size
+		f.write('\0' * offset)
+
+		tagEntries = []
+		for id in xrange(len(index.tags)):
+			tag = index.tags[id]
+			if tag is None:
+				tagEntries.append(TAG_ENTRY.pack(0, 0, 0, 0))
+				continue
+
+			name = cPickle.dumps(tag, cPickle.HIGHEST_PROTOCOL)
+			posting = index.getPostingString(id)
+			f.write(name)
+			f.write(posting)
+			tagEntries.append(TAG_ENTRY.pack(offset, len(name), offset + len(name), len(posting)))
+			offset += len(name) + len(posting)
+
+		elementEntries = []
+		attrEntries = []
+		keys = []
+		for id in xrange(len(index.elements)):
+			key = index.getElementKey(id)
+			if key is None:
+				elementEntries.append(ELEMENT_ENTRY.pack(0, 0, 0, 0))
+				attrEntries.append(ATTR_ENTRY.pack(0, 0))
+				continue
+
+			tagIds = index.getTagIdsString(id)
+			attrs = index.getAttrsString(id)
+			f.write(key)
+			f.write(tagIds)
+			f.write(attrs)
+			elementEntries.append(ELEMENT_ENTRY.pack(offset, len(key),
+					offset + len(key), len(tagIds) // ID.size))
+			if attrs:
+				attrEntries.append(ATTR_ENTRY.pack(offset + len(key) + len(tagIds), len(attrs)))
+			else:
+				attrEntries.append(ATTR_ENTRY.pack(0, 0))
+			offset += len(key) + len(tagIds) + len(attrs)
+			keys.append((key, id))
+		keys.sort()
+
+		sections = []
+		for s in (''.join(tagEntries), ''.join(elementEntries),
+				_idsToString([id for key, id in keys]), index.live.toString(),
+				_idsToString(index.freeTagIds), _idsToString(index.freeElementIds),
+				''.join(attrEntries)):
+			f.write(s)
+			sections.append((offset, len(s)))
+			offset += len(s)
+
+		f.seek(start)
+		f.write(HEADER.pack(MAGIC, VERSION, len(index.tags), len(index.elements), len(keys),
+				sections[0][0], sections[1][0], sections[2][0],
+				sections[3][0], sections[3][1],
+				sections[4][0], len(index.freeTagIds),
+				sections[5][0], len(index.freeElementIds),
+				sections[6][0]))
+
+class IndexTagStore(PickleTagStore):
+	"""
+	L{TagStore} keeping a L{TagIndex} in a L{GPStor}, written in the binary format of
+	L{IndexFormat} and read through mmap
+	"""
+
+	SUFFIX = '.idx'
+
+	def createData(self):
+		return MappedTagIndex()
+
+	def createView(self, data):
+		return IndexTagView(data)
+
+	def createFormat(self):
+		return IndexFormat()
+
+def test():
+	import os
+	import random
+	import tempfile
+	from dhtfs.Tagging import TagDelta
+
+	print "Running tests ..."
+	random.seed(0)
+
+	def randomDelta(i):
+		delta = TagDelta()
+		for j in range(random.randint(0, 30)):
+			delta.added.add(('e%d' % random.randint(0, 199), 't%d' % random.randint(0, 19)))
+		for j in range(random.randint(0, 10)):
+			delta.removed.add(('e%d' % random.randint(0, 199), 't%d' % random.randint(0, 19)))
+		if i % 4 == 0:
+			delta.delElements.update(['e%d' % random.randint(0, 199) for j in range(5)])
+			delta.newElements.add(('e', random.randint(0, 9)))
+		if i % 9 == 0:
+			delta.delTags.add('t%d' % random.randint(0, 19))
+			delta.newTags.add('t%d' % random.randint(0, 19))
+		for j in range(random.randint(0, 5)):
+			delta.attrs['e%d' % random.randint(0, 199)] = random.choice([None, {'size': i}])
+		return delta
+
+	def content(index):
+		view = IndexTagView(index)
+		elements = [e for e in view.getAllElements()]
+		return (view.getE2T(), view.getT2E(), dict([(e, view.getAttrs(e)) for e in elements]),
+				sorted([index.elementIds[e] for e in elements]), list(index.live),
+				sorted(index.freeTagIds), sorted(index.freeElementIds))
+
+	def roundTrip(index):
+		# The index is written after some other data and read through mmap
+		fd, name = tempfile.mkstemp()
+		f = os.fdopen(fd, 'w+b')
+		try:
+			f.write('x' * 13)
+			IndexFormat().dump(index, f)
+			f.flush()
+			f.seek(13)
+			return IndexFormat().load(f)
+		finally:
+			f.close()
+			os.remove(name)
+
+	# Test 1
+	index = TagIndex()
+	mapped = MappedTagIndex()
+	for i in range(50):
+		delta = randomDelta(i)
+		index.applyDelta(delta)
+		mapped.applyDelta(delta)
+	mapped = roundTrip(mapped)
+	if content(mapped) == content(index) and mapped.image.getLive() == index.live:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test 2
+	# Changes kept on top of the image are written with the unchanged parts of the image
+	ok = True
+	for i in range(50, 80):
+		delta = randomDelta(i)
+		index.applyDelta(delta)
+		mapped.applyDelta(delta)
+		ok = ok and content(mapped) == content(index)
+		if i % 10 == 0:
+			mapped = roundTrip(mapped)
+			ok = ok and content(mapped) == content(index)
+	mapped = roundTrip(mapped)
+	if ok and content(mapped) == content(index):
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+	# Test 3
+	# The ids of the image are not changed by the index
+	stored = mapped.image.getLive()
+	delta = TagDelta()
+	delta.delElements.update(list(IndexTagView(mapped).getAllElements())[:3])
+	delta.added.add(('new', 't1'))
+	mapped.applyDelta(delta)
+	index.applyDelta(delta)
+	if mapped.image.getLive() == stored and content(mapped) == content(index) and \
+			mapped.attrs.get(mapped.elementIds['new']) is None:
+		print "Test3 succesful"
+	else:
+		print "Test3 Failed"
+
+if __name__ == "__main__":
+	test()
@@ -0,0 +1,122 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import struct
+import threading
+
+try:
+	import ctypes
+	import ctypes.util
+	_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	_libc.inotify_init
+	_libc.inotify_add_watch
+except (ImportError, OSError, AttributeError, TypeError):
+	_libc = None
+
+# Events from <sys/inotify.h>
+IN_MODIFY =	0x00000002
+IN_MOVED_TO =	0x00000080
+IN_CREATE =	0x00000100
+IN_DELETE =	0x00000200
+IN_Q_OVERFLOW =	0x00004000
+IN_IGNORED =	0x00008000
+
+# Header of struct inotify_event: wd, mask, cookie and length of the name
+EVENT = struct.Struct('iIII')
+
+def isAvailable():
+	"""
+	isAvailable() -> True if inotify can be used
+	"""
+	return _libc is not None
+
+class DirectoryWatcher:
+	"""
+	Counts changes of some of the files in a directory, as reported by inotify
+
+	A thread waits for the events of the directory and increments L{changes} whenever
+	one of the watched files is created, written, renamed over or deleted. Users remember
+	the count and only have to look at the files when it changed. Once the watch is lost,
+	for example because the directory was removed, L{alive} becomes False and the
+	count is no longer maintained.
+	"""
+
+	MASK = IN_MODIFY | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+	def __init__(self, path, names):
+		"""
+		@param path: Directory to watch
+		@type path: string
+
+		@param names: Names of the files in the directory to watch
+		@type names: List of str
+		"""
+		if _libc is None:
+			raise OSError('inotify is not available')
+
+		self.names = set(names)
+		self.changes = 0
+		self.alive = True
+
+		self.fd = _libc.inotify_init()
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+
+		if _libc.inotify_add_watch(self.fd, path, DirectoryWatcher.MASK) < 0:
+			err = ctypes.get_errno()
+			os.close(self.fd)
+			raise OSError(err, os.strerror(err))
+
+		self.thread = threading.Thread(target=self.__watch)
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def __watch(self):
+		try:
+			while self.alive:
+				events = os.read(self.fd, 65536)
+				changed = False
+				offset = 0
+				while offset < len(events):
+					wd, mask, cookie, length = EVENT.unpack_from(events, offset)
+					offset += EVENT.size
+					name = events[offset:offset + length].rstrip('\0')
+					offset += length
+
+					if mask & IN_IGNORED:
+						self.alive = False
+					if mask & (IN_Q_OVERFLOW | IN_IGNORED) or name in self.names:
+						changed = True
+
+				if changed:
+					self.changes += 1
+		except OSError:
+			self.alive = False
+
+		os.close(self.fd)
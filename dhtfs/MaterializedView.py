@@ -0,0 +1,280 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import threading
+
+from dhtfs.RWLock import synchronized
+
+class MaterializedView:
+	"""
+	Elements associated with all the tags of a tag set, kept up to date by applying changes
+
+	For each selected element the view keeps its tags, and for each tag the number of
+	selected elements it is associated with. A listing of the tag set is then computed from
+	the view without intersecting any posting lists.
+	"""
+
+	def __init__(self, tags):
+		"""
+		@param tags: Non empty set of tags
+		@type tags: frozenset
+		"""
+		self.tags = tags
+		self.memberTags = None		# selected element -> frozenset of its tags, None if not built
+		self.tagCounts = {}		# tag -> number of selected elements associated with it
+		self.listings = {}		# beRestrictive -> (tags, elements)
+
+	def __repr__(self):
+		return '<MaterializedView of %s>' % sorted(self.tags)
+
+	def isBuilt(self):
+		return self.memberTags is not None
+
+	def build(self, view):
+		"""
+		M.build(view) -> Compute the view from scratch
+
+		@param view: L{TagView<dhtfs.TagStore.TagView>} of the tag database
+		"""
+		self.memberTags = {}
+		for element in view.intersect(list(self.tags)):
+			self.memberTags[element] = frozenset(view.getTagsOf(element))
+		self.tagCounts = view.getTagCounts(self.memberTags.keys())
+		self.listings.clear()
+
+	def clear(self):
+		"""
+		M.clear() -> Forget the selection, the view is built again when it is used next
+		"""
+		self.memberTags = None
+		self.tagCounts = {}
+		self.listings.clear()
+
+	def applyDelta(self, delta, view):
+		"""
+		M.applyDelta(delta, view) -> Update the view for a change
+
+		@param delta: L{TagDelta<dhtfs.Tagging.TagDelta>} which was applied
+		@param view: L{TagView<dhtfs.TagStore.TagView>} showing the data after the change
+		"""
+		if self.memberTags is None:
+			return
+
+		counts = self.tagCounts
+		for element in delta.getElements():
+			old = self.memberTags.pop(element, None)
+			if old is not None:
+				for tag in old:
+					if counts[tag] == 1:
+						del counts[tag]
+					else:
+						counts[tag] -= 1
+
+			if not view.hasElement(element):
+				continue
+			tags = frozenset(view.getTagsOf(element))
+			if self.tags <= tags:
+				self.memberTags[element] = tags
+				for tag in tags:
+					counts[tag] = counts.get(tag, 0) + 1
+
+		self.listings.clear()
+
+	def getTagsAndElements(self, beRestrictive):
+		"""
+		M.getTagsAndElements(beRestrictive) -> (List of tags, List of elements)
+
+		Same result as L{Tagging.getTagsAndElementsForTags<dhtfs.Tagging.Tagging.getTagsAndElementsForTags>}
+		for the tags of the view without a cover.
+		"""
+		tags, elements = self.__getListing(beRestrictive)
+		return list(tags), list(elements)
+
+	def getTags(self, beRestrictive):
+		"""
+		M.getTags(beRestrictive) -> List of tags of L{getTagsAndElements}
+		"""
+		tags, elements = self.__getListing(beRestrictive)
+		return list(tags)
+
+	def __getListing(self, beRestrictive):
+		try:
+			return self.listings[beRestrictive]
+		except KeyError:
+			pass
+
+		size = len(self.memberTags)
+		if beRestrictive:
+			tags = [x for x, count in self.tagCounts.iteritems() if count < size and x not in self.tags]
+		else:
+			tags = [x for x in self.tagCounts if x not in self.tags]
+
+		if beRestrictive and size > 20:
+			# Elements which are not found under any of the tags
+			tagSet = set(tags)
+			elements = [e for e, t in self.memberTags.iteritems() if tagSet.isdisjoint(t)]
+		else:
+			elements = self.memberTags.keys()
+
+		self.listings[beRestrictive] = tags, elements
+		return tags, elements
+
+class MaterializedViews:
+	"""
+	Materialized views of a L{Tagging} instance
+
+	Views are either added explicitly or promoted when their tag set is listed often.
+	Access counts are halved regularly, so that promotion follows recent use. When there are
+	more promoted views than allowed, the least used one is dropped. Views which were added
+	explicitly are never dropped. The views may be used by several threads.
+	"""
+
+	# Number of listings of a tag set after which it gets a view
+	PROMOTE_AFTER = 8
+
+	# Number of listings after which the access counts are halved
+	DECAY_INTERVAL = 1024
+
+	def __init__(self, maxPromoted):
+		"""
+		@param maxPromoted: Maximum number of promoted views, 0 disables promotion
+		@type maxPromoted: int
+		"""
+		self.maxPromoted = maxPromoted
+		self.views = {}			# frozenset of tags -> MaterializedView
+		self.pinned = set([])
+		self.accesses = {}		# frozenset of tags -> number of recent listings
+		self.listings = 0
+		self.version = None
+		self.lock = threading.RLock()
+
+	def __repr__(self):
+		return '<MaterializedViews %s>' % self.views.values()
+
+	def add(self, tags, pinned=True):
+		"""
+		V.add(tags, pinned) -> Add a view for a non empty set of tags
+		"""
+		if tags not in self.views:
+			self.views[tags] = MaterializedView(tags)
+		if pinned:
+			self.pinned.add(tags)
+
+	add = synchronized(add)
+
+	def remove(self, tags):
+		"""
+		V.remove(tags) -> Drop the view of a set of tags
+		"""
+		self.views.pop(tags, None)
+		self.pinned.discard(tags)
+
+	remove = synchronized(remove)
+
+	def getTagSets(self):
+		"""
+		V.getTagSets() -> List of the tag sets which have a view
+		"""
+		return self.views.keys()
+
+	getTagSets = synchronized(getTagSets)
+
+	def get(self, tags, view):
+		"""
+		V.get(tags, view) -> Built L{MaterializedView} of the tag set, None if it has none
+
+		Counts the listing of the tag set, which may promote it to a view. Views are not
+		used while the version of the database is not known.
+
+		@param view: L{TagView<dhtfs.TagStore.TagView>} used if the view has to be built
+		"""
+		self.__countAccess(tags)
+
+		mv = self.views.get(tags)
+		if mv is None or self.version is None:
+			return None
+		if not mv.isBuilt():
+			mv.build(view)
+		return mv
+
+	get = synchronized(get)
+
+	def __countAccess(self, tags):
+		self.listings += 1
+		if self.listings % MaterializedViews.DECAY_INTERVAL == 0:
+			for key, count in self.accesses.items():
+				if count > 1:
+					self.accesses[key] = count // 2
+				else:
+					del self.accesses[key]
+
+		count = self.accesses.get(tags, 0) + 1
+		self.accesses[tags] = count
+		if count < MaterializedViews.PROMOTE_AFTER or tags in self.views or not tags:
+			return
+		if self.maxPromoted <= 0:
+			return
+
+		promoted = [t for t in self.views if t not in self.pinned]
+		if len(promoted) >= self.maxPromoted:
+			leastUsed = min(promoted, key=lambda t: self.accesses.get(t, 0))
+			if self.accesses.get(leastUsed, 0) >= count:
+				return
+			del self.views[leastUsed]
+		self.add(tags, pinned=False)
+
+	def applyDelta(self, delta, view):
+		"""
+		V.applyDelta(delta, view) -> Update all views for a change, see L{MaterializedView.applyDelta}
+		"""
+		for mv in self.views.itervalues():
+			mv.applyDelta(delta, view)
+
+	applyDelta = synchronized(applyDelta)
+
+	def validate(self, version):
+		"""
+		V.validate(version) -> Build all views again if they were computed for a different version
+
+		@param version: Current version of the database, None if it is not known
+		"""
+		if version is None or version != self.version:
+			for mv in self.views.itervalues():
+				mv.clear()
+		self.version = version
+
+	validate = synchronized(validate)
+
+	def setVersion(self, version):
+		"""
+		V.setVersion(version) -> Keep the views for a version created by changes which were
+		already passed to L{applyDelta}
+		"""
+		if version is None:
+			self.validate(version)
+		self.version = version
+
+	setVersion = synchronized(setVersion)
@@ -0,0 +1,426 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+from collections import OrderedDict
+import threading
+import time
+import os
+
+from dhtfs.RWLock import synchronized
+
+class PathCache:
+	"""
+	Bounded cache of the locations which paths of the file system resolve to
+
+	Each path is stored with the tags its resolution depends on, or None if it depends on
+	the listing of its directory. The cache is kept as an index of the L{TagDir<dhtfs.TagHelper.TagDir>},
+	see L{Tagging.addIndex<dhtfs.Tagging.Tagging.addIndex>}. A change drops only the paths
+	depending on one of the tags it touched and those depending on a listing. A change made
+	by someone else drops all paths. The least recently used path is dropped when the cache
+	is full. The cache may be used by several threads.
+	"""
+
+	def __init__(self, size):
+		"""
+		@param size: Maximum number of paths kept, 0 disables the cache
+		@type size: int
+		"""
+		self.size = size
+		self.entries = OrderedDict()	# path -> (location, tags)
+		self.byTag = {}			# tag -> set of paths depending on it
+		self.listings = set([])		# paths depending on the listing of their directory
+		self.version = None
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+		self.lock = threading.RLock()
+
+	def __repr__(self):
+		return '<PathCache of %d/%d paths>' % (len(self.entries), self.size)
+
+	def validate(self, version):
+		if version is None or version != self.version:
+			self.clear()
+		self.version = version
+
+	validate = synchronized(validate)
+
+	def setVersion(self, version):
+		if version is None:
+			self.validate(version)
+		self.version = version
+
+	setVersion = synchronized(setVersion)
+
+	def applyDelta(self, delta, view):
+		if not self.entries:
+			return
+
+		for path in list(self.listings):
+			self.__drop(path)
+			self.invalidations += 1
+		for tag in delta.getTags():
+			for path in list(self.byTag.get(tag, ())):
+				self.__drop(path)
+				self.invalidations += 1
+
+	applyDelta = synchronized(applyDelta)
+
+	def lookup(self, path, view):
+		"""
+		C.lookup(path, view) -> Location path resolves to, None if it is not cached
+		"""
+		try:
+			entry = self.entries.pop(path)
+		except KeyError:
+			self.misses += 1
+			return None
+
+		self.entries[path] = entry
+		self.hits += 1
+		return entry[0]
+
+	lookup = synchronized(lookup)
+
+	def put(self, path, location, tags=None):
+		"""
+		C.put(path, location, tags) -> Store the location a path resolves to
+
+		@param tags: Tags the resolution depends on, None if it depends on the listing of
+			the directory of the path
+		@type tags: frozenset
+		"""
+		if self.size <= 0 or self.version is None:
+			return
+
+		if path in self.entries:
+			self.__drop(path)
+		self.entries[path] = (location, tags)
+		if tags is None:
+			self.listings.add(path)
+		else:
+			for tag in tags:
+				self.byTag.setdefault(tag, set([])).add(path)
+
+		while len(self.entries) > self.size:
+			self.__drop(iter(self.entries).next())
+			self.evictions += 1
+
+	put = synchronized(put)
+
+	def remove(self, path):
+		"""
+		C.remove(path) -> Drop a path from the cache
+		"""
+		if path in self.entries:
+			self.__drop(path)
+
+	remove = synchronized(remove)
+
+	def __drop(self, path):
+		location, tags = self.entries.pop(path)
+		if tags is None:
+			self.listings.discard(path)
+			return
+
+		for tag in tags:
+			paths = self.byTag[tag]
+			paths.discard(path)
+			if not paths:
+				del self.byTag[tag]
+
+	def clear(self):
+		"""
+		C.clear() -> Drop all paths
+		"""
+		self.invalidations += len(self.entries)
+		self.entries.clear()
+		self.byTag.clear()
+		self.listings.clear()
+
+	clear = synchronized(clear)
+
+	def getStats(self):
+		"""
+		C.getStats() -> (hits, misses, evictions, invalidations, number of cached paths)
+		"""
+		return self.hits, self.misses, self.evictions, self.invalidations, len(self.entries)
+
+class AttrCache:
+	"""
+	Bounded cache of the attributes of files in the underlying file system
+
+	Attributes are kept by the location of the file for a number of seconds, like the
+	attribute timeout of FUSE, so that changes made to the files by other means are seen
+	after that time. Changes made through dhtfs drop the attributes of the file they
+	change. The least recently used attributes are dropped when the cache is full. The
+	cache may be used by several threads.
+	"""
+
+	def __init__(self, size, timeout):
+		"""
+		@param size: Maximum number of files whose attributes are kept
+		@type size: int
+
+		@param timeout: Seconds for which attributes are kept, 0 disables the cache
+		@type timeout: float
+		"""
+		self.size = size
+		self.timeout = timeout
+		self.entries = OrderedDict()	# location -> (expiry time, attributes)
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.RLock()
+
+	def __repr__(self):
+		return '<AttrCache of %d/%d files>' % (len(self.entries), self.size)
+
+	def get(self, location):
+		"""
+		C.get(location) -> Cached attributes of the file, None if they are not cached
+		"""
+		try:
+			expires, attrs = self.entries.pop(location)
+		except KeyError:
+			self.misses += 1
+			return None
+
+		if expires < time.time():
+			self.misses += 1
+			return None
+
+		self.entries[location] = (expires, attrs)
+		self.hits += 1
+		return attrs
+
+	get = synchronized(get)
+
+	def put(self, location, attrs):
+		"""
+		C.put(location, attrs) -> Keep the attributes of a file, as returned by os.lstat
+		"""
+		if self.size <= 0 or self.timeout <= 0:
+			return
+
+		self.entries.pop(location, None)
+		self.entries[location] = (time.time() + self.timeout, attrs)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	put = synchronized(put)
+
+	def remove(self, location):
+		"""
+		C.remove(location) -> Drop the attributes of a file which was changed
+		"""
+		self.entries.pop(location, None)
+
+	remove = synchronized(remove)
+
+	def lstat(self, location):
+		"""
+		C.lstat(location) -> Attributes of the file from the cache or from os.lstat
+
+		Raises OSError like os.lstat.
+		"""
+		attrs = self.get(location)
+		if attrs is None:
+			attrs = os.lstat(location)
+			self.put(location, attrs)
+		return attrs
+
+	def lstatAll(self, locations):
+		"""
+		C.lstatAll(locations) -> Dictionary of the attributes of the files which exist
+
+		The files whose attributes are not cached are looked at in the order of their
+		locations, which keeps the lookups of a directory close together.
+		"""
+		result = {}
+		missing = []
+		for location in locations:
+			attrs = self.get(location)
+			if attrs is None:
+				missing.append(location)
+			else:
+				result[location] = attrs
+
+		missing.sort()
+		for location in missing:
+			try:
+				attrs = os.lstat(location)
+			except OSError:
+				continue
+			self.put(location, attrs)
+			result[location] = attrs
+		return result
+
+	def getStats(self):
+		"""
+		C.getStats() -> (hits, misses, number of files whose attributes are cached)
+		"""
+		return self.hits, self.misses, len(self.entries)
+
+def test():
+	import shutil
+	from dhtfs.Tagging import TagDelta
+	from dhtfs.TagHelper import TagDir, TagFile
+
+	TEST_DIR = '/tmp/zzzzzzzzzzzzz_paths'
+
+	print "Running tests ..."
+
+	def consistent(c):
+		# Every path is found under the tags it depends on and nothing else is
+		byTag = {}
+		listings = set([])
+		for path, (location, tags) in c.entries.items():
+			if tags is None:
+				listings.add(path)
+			else:
+				for tag in tags:
+					byTag.setdefault(tag, set([])).add(path)
+		return byTag == c.byTag and listings == c.listings
+
+	# Test 1
+	c = PathCache(3)
+	c.put('/a/f', 'f')
+	ok = c.lookup('/a/f', None) is None
+	c.validate(1)
+	c.put('/a/f', 'f', frozenset(['a', 'f']))
+	c.put('/b/g', 'g', frozenset(['b', 'g']))
+	c.put('/a', 'a')
+	delta = TagDelta()
+	delta.added.add(('x', 'b'))
+	c.applyDelta(delta, None)
+	ok = ok and c.lookup('/a/f', None) == 'f' and c.lookup('/b/g', None) is None
+	ok = ok and c.lookup('/a', None) is None and consistent(c)
+	c.put('/b/g', 'g', frozenset(['b', 'g']))
+	c.put('/c', 'c')
+	c.lookup('/a/f', None)
+	c.put('/d', 'd')
+	ok = ok and c.lookup('/b/g', None) is None and c.lookup('/a/f', None) == 'f' and consistent(c)
+	c.put('/a/f', 'f2', frozenset(['f']))
+	c.remove('/c')
+	ok = ok and c.lookup('/a/f', None) == 'f2' and consistent(c) and 'a' not in c.byTag
+	c.setVersion(2)
+	ok = ok and c.lookup('/a/f', None) == 'f2'
+	c.validate(3)
+	ok = ok and c.getStats()[4] == 0 and consistent(c)
+	if ok:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test 2
+	# Paths resolved through the cache are those resolved without it, after files were
+	# renamed and removed and directories created by this and another instance. Files
+	# depend on their path, directories on the listing of their parent as in Dhtfs.
+	shutil.rmtree(TEST_DIR, True)
+	os.makedirs(TEST_DIR)
+	td = TagDir(TEST_DIR)
+	td.initDB(forceInit=True)
+	other = TagDir(TEST_DIR)
+	cache = PathCache(100)
+	td.addIndex(cache)
+
+	def resolve(path):
+		dirs = [x for x in os.path.dirname(path).split(os.path.sep) if x != '']
+		name = os.path.basename(path)
+		if td.isDir(name):
+			if name in td.getDirsForDirs(dirs) or len(dirs) == 0:
+				return 't_' + name, None
+			return None, None
+		return td.getActualLocation(dirs, name), frozenset(dirs + [name])
+
+	def cachedResolve(path):
+		location = td.lookupIndex(cache, path)
+		if location is None:
+			location, tags = resolve(path)
+			cache.put(path, location, tags)
+		return location
+
+	paths = ['/music', '/rock', '/music/rock', '/rock/music', '/music/a.mp3', '/music/rock/a.mp3',
+			'/rock/a.mp3', '/music/b.mp3', '/pop', '/music/pop', '/music/pop/b.mp3']
+	def check():
+		return [cachedResolve(p) for p in paths] == [resolve(p)[0] for p in paths]
+
+	a = TagFile(os.path.join(TEST_DIR, 'f_1'), 'a.mp3')
+	b = TagFile(os.path.join(TEST_DIR, 'f_2'), 'b.mp3')
+	td.addDirsToFiles([a], ['music', 'rock'])
+	ok = check()
+	# Rename a.mp3 to b.mp3
+	td.delFiles([a])
+	td.addDirsToFiles([TagFile(a.location, 'b.mp3')], ['music', 'rock'])
+	ok = ok and check()
+	# mkdir /music/pop
+	td.createDirs(['pop'])
+	ok = ok and check()
+	td.addDirsToFiles([b], ['music', 'pop'])
+	ok = ok and check()
+	# Rename the directory rock to jazz
+	td.renameDir(['rock'], ['jazz'])
+	ok = ok and check()
+	# unlink /music/pop/b.mp3
+	td.delFiles([b])
+	ok = ok and check()
+	# Changes by another instance
+	other.addDirsToFiles([a], ['rock', 'music'])
+	ok = ok and check()
+	other.delFiles([a], ['music'])
+	ok = ok and check() and consistent(cache)
+	shutil.rmtree(TEST_DIR, True)
+	if ok:
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+	# Test 3
+	c = AttrCache(2, 0.2)
+	st = os.lstat('/')
+	ok = c.lstat('/') == st and c.get('/') == st
+	c.remove('/')
+	ok = ok and c.get('/') is None
+	c.put('/a', 1)
+	c.put('/b', 2)
+	c.get('/a')
+	c.put('/c', 3)
+	ok = ok and c.get('/b') is None and c.get('/a') == 1 and c.get('/c') == 3
+	# Attributes are kept only for the timeout
+	time.sleep(0.3)
+	ok = ok and c.get('/a') is None
+	ok = ok and c.lstatAll(['/', '/nonexistent' + TEST_DIR]) == {'/' : st}
+	c = AttrCache(2, 0)
+	c.put('/a', 1)
+	ok = ok and c.get('/a') is None
+	if ok:
+		print "Test3 succesful"
+	else:
+		print "Test3 Failed"
+
+if __name__ == "__main__":
+	test()
@@ -0,0 +1,457 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+from collections import OrderedDict
+import threading
+
+from dhtfs.RWLock import synchronized
+
+class QueryCache:
+	"""
+	Bounded cache of query results, dropping the least recently used result when it is full
+
+	Results are stored with the tags and elements they depend on. A change of the tag
+	database drops only the results which depend on one of the tags or elements touched by
+	the change. Results are valid for one version of the database as returned by
+	L{TagStore.getVersion<dhtfs.TagStore.TagStore.getVersion>}. When a different version
+	is seen, the database was changed by someone else and all results are dropped.
+	The cache may be used by several threads.
+	"""
+
+	def __init__(self, size):
+		"""
+		@param size: Maximum number of results kept, 0 disables the cache
+		@type size: int
+		"""
+		self.size = size
+		self.entries = OrderedDict()	# key -> (result, tags, elements)
+		self.version = None
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self.lock = threading.RLock()
+
+	def __repr__(self):
+		return '<QueryCache of %d/%d results>' % (len(self.entries), self.size)
+
+	def validate(self, version):
+		"""
+		C.validate(version) -> Drop all results if they were computed for a different version
+
+		@param version: Current version of the database, None if it is not known
+		"""
+		if version is None or version != self.version:
+			self.invalidations += len(self.entries)
+			self.entries.clear()
+		self.version = version
+
+	validate = synchronized(validate)
+
+	def setVersion(self, version):
+		"""
+		C.setVersion(version) -> Keep the results for a version created by changes which were
+		already passed to L{invalidate}
+		"""
+		if version is None:
+			self.validate(version)
+		self.version = version
+
+	setVersion = synchronized(setVersion)
+
+	def get(self, key):
+		"""
+		C.get(key) -> Cached result for key, None if there is none
+		"""
+		try:
+			entry = self.entries.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+
+		self.entries[key] = entry
+		self.hits += 1
+		return entry[0]
+
+	get = synchronized(get)
+
+	def put(self, key, result, tags=None, elements=()):
+		"""
+		C.put(key, result, tags, elements) -> Store the result of a query
+
+		@param tags: Tags the result depends on, None if it depends on all tags
+		@type tags: frozenset
+
+		@param elements: Container of the elements the result depends on
+		"""
+		if self.size <= 0 or self.version is None:
+			return
+
+		self.entries.pop(key, None)
+		self.entries[key] = (result, tags, elements)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	put = synchronized(put)
+
+	def invalidate(self, tags, elements):
+		"""
+		C.invalidate(tags, elements) -> Drop the results depending on any of the tags or elements
+
+		@type tags: set
+		@type elements: set
+		"""
+		for key, (result, dependsOnTags, dependsOnElements) in self.entries.items():
+			if dependsOnTags is None or not dependsOnTags.isdisjoint(tags) or \
+					self.__dependsOn(dependsOnElements, elements):
+				del self.entries[key]
+				self.invalidations += 1
+
+	invalidate = synchronized(invalidate)
+
+	def __dependsOn(self, dependsOnElements, elements):
+		for element in elements:
+			if element in dependsOnElements:
+				return True
+		return False
+
+	def getStats(self):
+		"""
+		C.getStats() -> (hits, misses, invalidations, number of cached results)
+		"""
+		return self.hits, self.misses, self.invalidations, len(self.entries)
+
+class PrefixCache:
+	"""
+	Bounded cache of the intersections of tag paths, kept in a trie of the tags of the path
+
+	Listing or resolving a path deep in the hierarchy looks at all the shorter paths leading
+	to it first. With the intersection of a path cached, the intersection of a path one tag
+	longer takes a single intersection. The least recently used intersection is dropped
+	when the cache is full. A change drops the intersections of all paths containing one of
+	the tags it touched, which is the case for every path whose elements it changed.
+	Versions and threads are handled as in L{QueryCache}.
+	"""
+
+	def __init__(self, size):
+		"""
+		@param size: Maximum number of intersections kept, 0 disables the cache
+		@type size: int
+		"""
+		self.size = size
+		self.root = {}			# tag -> [children, intersection or None]
+		self.entries = OrderedDict()	# path -> node holding its intersection
+		self.version = None
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self.lock = threading.RLock()
+
+	def __repr__(self):
+		return '<PrefixCache of %d/%d intersections>' % (len(self.entries), self.size)
+
+	def validate(self, version):
+		"""
+		C.validate(version) -> Drop all intersections if they were computed for a different version
+
+		@param version: Current version of the database, None if it is not known
+		"""
+		if version is None or version != self.version:
+			self.invalidations += len(self.entries)
+			self.entries.clear()
+			self.root = {}
+		self.version = version
+
+	validate = synchronized(validate)
+
+	def setVersion(self, version):
+		"""
+		C.setVersion(version) -> Keep the intersections for a version created by changes which
+		were already passed to L{invalidate}
+		"""
+		if version is None:
+			self.validate(version)
+		self.version = version
+
+	setVersion = synchronized(setVersion)
+
+	def get(self, path):
+		"""
+		C.get(path) -> (length, intersection) of the longest prefix of path which is cached
+
+		The length is 0 and the intersection None if no prefix is cached.
+
+		@param path: Tuple of tags
+		@type path: tuple
+		"""
+		length, intersection = 0, None
+		children = self.root
+		for i in range(len(path)):
+			node = children.get(path[i])
+			if node is None:
+				break
+			if node[1] is not None:
+				length, intersection = i + 1, node[1]
+			children = node[0]
+
+		if length == 0:
+			self.misses += 1
+		else:
+			self.hits += 1
+			prefix = path[:length]
+			self.entries[prefix] = self.entries.pop(prefix)
+		return length, intersection
+
+	get = synchronized(get)
+
+	def put(self, path, intersection):
+		"""
+		C.put(path, intersection) -> Store the intersection of the tags of a path
+
+		The intersection must not be changed afterwards.
+		"""
+		if self.size <= 0 or self.version is None or len(path) == 0:
+			return
+
+		children = self.root
+		for tag in path:
+			node = children.get(tag)
+			if node is None:
+				node = children[tag] = [{}, None]
+			children = node[0]
+		node[1] = intersection
+
+		self.entries.pop(path, None)
+		self.entries[path] = node
+		while len(self.entries) > self.size:
+			oldest, node = self.entries.popitem(last=False)
+			node[1] = None
+			self.__prune(oldest)
+
+	put = synchronized(put)
+
+	# Remove the nodes along path which lead to no intersection
+	def __prune(self, path):
+		nodes = []
+		children = self.root
+		for tag in path:
+			node = children.get(tag)
+			if node is None:
+				break
+			nodes.append((children, tag, node))
+			children = node[0]
+
+		while nodes:
+			children, tag, node = nodes.pop()
+			if node[0] or node[1] is not None:
+				break
+			del children[tag]
+
+	def invalidate(self, tags):
+		"""
+		C.invalidate(tags) -> Drop the intersections of the paths containing any of the tags
+
+		@type tags: set
+		"""
+		if not self.entries:
+			return
+		self.__invalidate(self.root, (), tags)
+
+	invalidate = synchronized(invalidate)
+
+	def __invalidate(self, children, path, tags):
+		for tag, node in children.items():
+			if tag in tags:
+				del children[tag]
+				self.__drop(node, path + (tag,))
+			else:
+				self.__invalidate(node[0], path + (tag,), tags)
+				if not node[0] and node[1] is None:
+					del children[tag]
+
+	def __drop(self, node, path):
+		if node[1] is not None:
+			del self.entries[path]
+			self.invalidations += 1
+		for tag, child in node[0].iteritems():
+			self.__drop(child, path + (tag,))
+
+	def getStats(self):
+		"""
+		C.getStats() -> (hits, misses, invalidations, number of cached intersections)
+		"""
+		return self.hits, self.misses, self.invalidations, len(self.entries)
+
+def test():
+	import os
+	import random
+	import shutil
+	from dhtfs.Tagging import Tagging
+
+	TEST_DIR = '/tmp/zzzzzzzzzzzzz_cache'
+
+	print "Running tests ..."
+	random.seed(0)
+
+	# Test 1
+	c = QueryCache(3)
+	c.put('a', 1)
+	ok = c.get('a') is None
+	c.validate(1)
+	c.put('a', 1, frozenset(['t1']))
+	c.put('b', 2, frozenset(['t2']), frozenset(['e1']))
+	c.put('c', 3, None)
+	c.invalidate(set(['t3']), set(['e2']))
+	ok = ok and c.get('a') == 1 and c.get('b') == 2 and c.get('c') is None
+	c.put('c', 3, frozenset())
+	c.invalidate(set(['t1']), set())
+	ok = ok and c.get('a') is None and c.get('b') == 2 and c.get('c') == 3
+	c.invalidate(set(), set(['e1']))
+	ok = ok and c.get('b') is None and c.get('c') == 3
+	# The least recently used result is dropped
+	c.put('a', 1, frozenset())
+	c.put('b', 2, frozenset())
+	c.get('c')
+	c.put('d', 4, frozenset())
+	ok = ok and c.get('a') is None and c.get('c') == 3 and c.getStats()[3] == 3
+	c.setVersion(2)
+	ok = ok and c.get('c') == 3
+	c.validate(3)
+	ok = ok and c.get('c') is None and c.getStats()[3] == 0
+	c = QueryCache(0)
+	c.validate(1)
+	c.put('a', 1)
+	ok = ok and c.get('a') is None
+	if ok:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test 2
+	def nodes(children):
+		# Number of nodes of the trie, None if a node leads to no intersection
+		n = 0
+		for tag, (grandChildren, intersection) in children.items():
+			m = nodes(grandChildren)
+			if m is None or (m == 0 and intersection is None):
+				return None
+			n += m + 1
+		return n
+
+	def consistent(c):
+		for path, node in c.entries.items():
+			children = c.root
+			for tag in path:
+				if tag not in children:
+					return False
+				found = children[tag]
+				children = found[0]
+			if found is not node or node[1] is None:
+				return False
+		return nodes(c.root) is not None
+
+	c = PrefixCache(4)
+	c.validate(1)
+	c.put(('a', 'b', 'c'), 'abc')
+	c.put(('a',), 'a')
+	ok = c.get(('a', 'b', 'c', 'd')) == (3, 'abc') and c.get(('a', 'b')) == (1, 'a')
+	ok = ok and c.get(('b',)) == (0, None)
+	c.put(('b', 'c'), 'bc')
+	c.put(('x', 'c', 'y'), 'xcy')
+	c.put(('x', 'y'), 'xy')
+	# ('a', 'b', 'c') is dropped and its nodes below 'a' are pruned
+	ok = ok and consistent(c) and c.root['a'][0] == {} and c.getStats()[3] == 4
+	c.invalidate(set(['c']))
+	ok = ok and consistent(c) and sorted(c.entries.keys()) == [('a',), ('x', 'y')]
+	ok = ok and c.get(('x', 'c', 'y')) == (0, None) and c.get(('b', 'c')) == (0, None)
+	c.invalidate(set(['a', 'y']))
+	ok = ok and c.root == {} and len(c.entries) == 0
+	for i in range(200):
+		path = tuple(random.sample('abcdefgh', random.randint(1, 4)))
+		c.put(path, path)
+		if i % 7 == 0:
+			c.invalidate(set(random.sample('abcdefgh', 1)))
+		ok = ok and consistent(c) and len(c.entries) <= 4
+		length, intersection = c.get(path + ('z',))
+		ok = ok and intersection in (None, path[:length])
+	if ok:
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+	# Test 3
+	# Results of a tagging with caches are those of a tagging without caches, after
+	# changes made by either of them. Callers may change the lists returned to them.
+	ok = True
+	tags = ['t%d' % i for i in range(12)]
+	elements = ['e%d' % i for i in range(80)]
+	for backend in ('pickle', 'index', 'sharded'):
+		shutil.rmtree(TEST_DIR, True)
+		os.makedirs(TEST_DIR)
+		cached = Tagging(TEST_DIR, backend=backend, queryCacheSize=50, prefixCacheSize=20)
+		cached.initDB(forceInit=True)
+		uncached = Tagging(TEST_DIR, queryCacheSize=0, prefixCacheSize=0, maxMaterializedViews=0)
+
+		def queries(t):
+			results = []
+			path = random.sample(tags, 3)
+			for i in range(1, 4):
+				results.append(t.getElements(path[:i]))
+			results.append(t.getElements([]))
+			results.extend(t.getTagsAndElementsForTags(path[:2]))
+			results.extend(t.getTagsAndElementsForTags(path[:1], beRestrictive=True))
+			results.append(t.getTagsForElements(elements[:10]))
+			results.append(list(t.iterElements(path[:2])))
+			return results
+
+		for i in range(150):
+			t = random.choice([cached, cached, uncached])
+			op = random.randint(0, 5)
+			if op < 3:
+				t.addTags(random.sample(elements, random.randint(1, 8)),
+						random.sample(tags, random.randint(1, 3)))
+			elif op == 3:
+				t.delElementsFromTags(random.sample(elements, 3), random.sample(tags, 1))
+			elif op == 4:
+				t.delTagsFromElements(random.sample(tags, 1), random.sample(elements, 20))
+			else:
+				t.delElementsFromTags(random.sample(elements, 1))
+
+			state = random.getstate()
+			expected = queries(uncached)
+			for j in range(2):
+				random.setstate(state)
+				results = queries(cached)
+				ok = ok and [sorted(r) for r in results] == [sorted(r) for r in expected]
+				for r in results:
+					r.append('changed')
+	shutil.rmtree(TEST_DIR, True)
+	if ok:
+		print "Test3 succesful"
+	else:
+		print "Test3 Failed"
+
+if __name__ == "__main__":
+	test()
@@ -0,0 +1,187 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import threading
+import thread
+
+class RWLock:
+	"""
+	Lock which is held either by any number of readers or by a single writer
+
+	Writers are preferred, a reader waits while a writer is waiting, so that a steady
+	stream of readers can not starve the writers. Both locks are reentrant. A thread
+	holding the write lock may also take the read lock, but a thread holding only the
+	read lock must not take the write lock.
+	"""
+
+	def __init__(self):
+		self.cond = threading.Condition(threading.Lock())
+		self.readers = {}		# thread -> number of read locks held
+		self.writer = None		# thread holding the write lock
+		self.writeCount = 0
+		self.waitingWriters = 0
+
+	def __repr__(self):
+		return '<RWLock with %d readers, writer %s>' % (len(self.readers), self.writer)
+
+	def acquireRead(self):
+		"""
+		L.acquireRead() -> Wait until no writer holds or waits for the lock and take a read lock
+		"""
+		me = thread.get_ident()
+		self.cond.acquire()
+		try:
+			if me in self.readers or self.writer == me:
+				self.readers[me] = self.readers.get(me, 0) + 1
+				return
+
+			while self.writer is not None or self.waitingWriters > 0:
+				self.cond.wait()
+			self.readers[me] = 1
+		finally:
+			self.cond.release()
+
+	def releaseRead(self):
+		"""
+		L.releaseRead() -> Release a read lock taken with L{acquireRead}
+		"""
+		me = thread.get_ident()
+		self.cond.acquire()
+		try:
+			count = self.readers[me] - 1
+			if count > 0:
+				self.readers[me] = count
+				return
+
+			del self.readers[me]
+			if not self.readers:
+				self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+	def acquireWrite(self):
+		"""
+		L.acquireWrite() -> Wait until no other thread holds the lock and take the write lock
+		"""
+		me = thread.get_ident()
+		self.cond.acquire()
+		try:
+			if self.writer == me:
+				self.writeCount += 1
+				return
+
+			if me in self.readers:
+				raise RuntimeError("read lock can not be upgraded to the write lock")
+
+			self.waitingWriters += 1
+			try:
+				while self.writer is not None or self.readers:
+					self.cond.wait()
+			finally:
+				self.waitingWriters -= 1
+			self.writer = me
+			self.writeCount = 1
+		finally:
+			self.cond.release()
+
+	def releaseWrite(self):
+		"""
+		L.releaseWrite() -> Release the write lock taken with L{acquireWrite}
+		"""
+		self.cond.acquire()
+		try:
+			self.writeCount -= 1
+			if self.writeCount == 0:
+				self.writer = None
+				self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+class NullLock:
+	"""
+	Lock with the interface of L{RWLock} which does nothing, for objects used by a single thread
+	"""
+
+	def __repr__(self):
+		return '<NullLock>'
+
+	def acquireRead(self):
+		pass
+
+	def releaseRead(self):
+		pass
+
+	def acquireWrite(self):
+		pass
+
+	def releaseWrite(self):
+		pass
+
+# The wrappers below are applied like classmethod, after the definition of the method.
+
+def readLocked(method):
+	"""
+	Wrap a method so that it runs holding the read lock in the attribute rwLock of its object
+	"""
+	def locked(self, *args, **kw):
+		self.rwLock.acquireRead()
+		try:
+			return method(self, *args, **kw)
+		finally:
+			self.rwLock.releaseRead()
+	locked.__name__ = method.__name__
+	locked.__doc__ = method.__doc__
+	return locked
+
+def writeLocked(method):
+	"""
+	Wrap a method so that it runs holding the write lock in the attribute rwLock of its object
+	"""
+	def locked(self, *args, **kw):
+		self.rwLock.acquireWrite()
+		try:
+			return method(self, *args, **kw)
+		finally:
+			self.rwLock.releaseWrite()
+	locked.__name__ = method.__name__
+	locked.__doc__ = method.__doc__
+	return locked
+
+def synchronized(method):
+	"""
+	Wrap a method so that it runs holding the lock in the attribute lock of its object
+
+	Used by the caches, which are changed by lookups made under a read lock.
+	"""
+	def locked(self, *args, **kw):
+		self.lock.acquire()
+		try:
+			return method(self, *args, **kw)
+		finally:
+			self.lock.release()
+	locked.__name__ = method.__name__
+	locked.__doc__ = method.__doc__
+	return locked
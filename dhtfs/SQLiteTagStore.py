@@ -0,0 +1,480 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import time
+import cPickle
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+from dhtfs.GPStor import GPStor
+from dhtfs.TagStore import TagStore, TagView, elementKey
+
+class SQLiteTagView(TagView):
+	"""
+	L{TagView} which runs queries against the SQLite database of a L{SQLiteTagStore}
+	"""
+
+	# Maximum number of parameters used in a single statement
+	MAX_PARAMS = 500
+
+	def __init__(self, store):
+		self.store = store
+		self.conn = store.conn
+
+	def __elementIds(self, elements):
+		ids = []
+		for element in elements:
+			id = self.store.getElementId(element)
+			if id is not None:
+				ids.append(id)
+		return ids
+
+	def __chunks(self, l, size=MAX_PARAMS):
+		for i in range(0, len(l), size):
+			yield l[i:i + size]
+
+	def __elements(self, cur):
+		return set(self.store.getElements([row[0] for row in cur]))
+
+	def getElementsOf(self, tag):
+		cur = self.conn.execute("""SELECT e2t.element FROM e2t JOIN tags ON e2t.tag = tags.id
+					WHERE tags.tag = ?""", (tag,))
+		return self.__elements(cur)
+
+	def getTagsOf(self, element):
+		id = self.store.getElementId(element)
+		if id is None:
+			return set([])
+
+		cur = self.conn.execute("""SELECT tags.tag FROM e2t JOIN tags ON e2t.tag = tags.id
+					WHERE e2t.element = ?""", (id,))
+		return set([row[0] for row in cur])
+
+	def hasTag(self, tag):
+		cur = self.conn.execute("SELECT 1 FROM tags WHERE tag = ?", (tag,))
+		return cur.fetchone() is not None
+
+	def hasElement(self, element):
+		return self.store.getElementId(element) is not None
+
+	def getAllTags(self):
+		return [row[0] for row in self.conn.execute("SELECT tag FROM tags")]
+
+	def getAttrs(self, element):
+		id = self.store.getElementId(element)
+		if id is None:
+			return None
+
+		row = self.conn.execute("SELECT attrs FROM attrs WHERE element = ?", (id,)).fetchone()
+		if row is None:
+			return None
+		return cPickle.loads(str(row[0]))
+
+	def getAllElements(self):
+		cur = self.conn.execute("SELECT id FROM elements")
+		return self.__elements(cur)
+
+	def getTagCount(self, tag):
+		cur = self.conn.execute("""SELECT COUNT(*) FROM e2t JOIN tags ON e2t.tag = tags.id
+					WHERE tags.tag = ?""", (tag,))
+		return cur.fetchone()[0]
+
+	def __plan(self, tags):
+		# Ids and element counts of the tags in one statement, missing tags are left out
+		cur = self.conn.execute("""SELECT tags.tag, tags.id, COUNT(e2t.element)
+					FROM tags LEFT JOIN e2t ON e2t.tag = tags.id
+					WHERE tags.tag IN (%s) GROUP BY tags.id""" % ','.join('?' * len(tags)), tags)
+		stats = dict([(row[0], (row[1], row[2])) for row in cur])
+		plan = [(stats.get(tag, (None, 0))[1], tag) for tag in tags]
+		plan.sort()
+		return plan, stats
+
+	def planIntersection(self, tagList):
+		tags = list(set(tagList))
+		if len(tags) > SQLiteTagView.MAX_PARAMS:
+			return TagView.planIntersection(self, tags)
+
+		return self.__plan(tags)[0]
+
+	def intersect(self, tagList):
+		tags = list(set(tagList))
+		if len(tags) > SQLiteTagView.MAX_PARAMS:
+			return TagView.intersect(self, tags)
+
+		plan, stats = self.__plan(tags)
+		if plan[0][0] == 0:
+			return set([])
+
+		# Scan the rarest tag and probe the primary key for each of the other tags
+		ids = [stats[tag][0] for count, tag in plan]
+		cur = self.conn.execute("""SELECT a.element FROM e2t a WHERE a.tag = ?""" +
+					""" AND EXISTS (SELECT 1 FROM e2t b WHERE b.element = a.element AND b.tag = ?)""" *
+					(len(ids) - 1), ids)
+		return self.__elements(cur)
+
+	def refine(self, elements, tag):
+		# Only the given elements are looked up instead of reading all elements of the tag
+		s1 = set([])
+		for ids in self.__chunks(self.__elementIds(elements)):
+			cur = self.conn.execute("""SELECT e2t.element FROM e2t JOIN tags ON e2t.tag = tags.id
+						WHERE tags.tag = ? AND e2t.element IN (%s)""" % ','.join('?' * len(ids)),
+						[tag] + ids)
+			s1.update(self.__elements(cur))
+		return s1
+
+	def exclude(self, elements, tags):
+		tags = list(set(tags))
+		if len(tags) >= SQLiteTagView.MAX_PARAMS:
+			return TagView.exclude(self, elements, tags)
+
+		tagIds = []
+		for names in self.__chunks(tags):
+			cur = self.conn.execute("SELECT id FROM tags WHERE tag IN (%s)" % ','.join('?' * len(names)),
+						names)
+			tagIds.extend([row[0] for row in cur])
+		if not tagIds:
+			return set(elements)
+
+		# The elements are looked up by the primary key, '+' keeps SQLite from reading
+		# the posting lists of the tags instead
+		tagged = set([])
+		for ids in self.__chunks(self.__elementIds(elements), SQLiteTagView.MAX_PARAMS - len(tagIds)):
+			cur = self.conn.execute("""SELECT DISTINCT element FROM e2t WHERE element IN (%s)
+						AND +tag IN (%s)""" % (','.join('?' * len(ids)), ','.join('?' * len(tagIds))),
+						ids + tagIds)
+			tagged.update([row[0] for row in cur])
+
+		getElementId = self.store.getElementId
+		return set([e for e in elements if getElementId(e) not in tagged])
+
+	def getTagsForElements(self, elements):
+		s1 = set([])
+		for ids in self.__chunks(self.__elementIds(elements)):
+			cur = self.conn.execute("""SELECT DISTINCT tags.tag FROM e2t JOIN tags ON e2t.tag = tags.id
+						WHERE e2t.element IN (%s)""" % ','.join('?' * len(ids)), ids)
+			s1.update([row[0] for row in cur])
+		return s1
+
+	def getTagCounts(self, elements):
+		counts = {}
+		get = counts.get
+		for ids in self.__chunks(self.__elementIds(elements)):
+			cur = self.conn.execute("""SELECT tags.tag, COUNT(*) FROM e2t JOIN tags ON e2t.tag = tags.id
+						WHERE e2t.element IN (%s) GROUP BY tags.id""" % ','.join('?' * len(ids)), ids)
+			for tag, n in cur:
+				counts[tag] = get(tag, 0) + n
+		return counts
+
+	def getE2T(self):
+		e2t = dict([(e, set([])) for e in self.getAllElements()])
+		cur = self.conn.execute("SELECT e2t.element, tags.tag FROM e2t JOIN tags ON e2t.tag = tags.id")
+		for id, tag in cur:
+			e2t[self.store.getElement(id)].add(tag)
+		return e2t
+
+	def getT2E(self):
+		t2e = dict([(t, set([])) for t in self.getAllTags()])
+		cur = self.conn.execute("SELECT e2t.element, tags.tag FROM e2t JOIN tags ON e2t.tag = tags.id")
+		for id, tag in cur:
+			t2e[tag].add(self.store.getElement(id))
+		return t2e
+
+class SQLiteTagStore(TagStore):
+	"""
+	L{TagStore} keeping element/tag associations in a SQLite database
+
+	Elements and tags are kept in the tables 'elements' and 'tags'. The associations are kept
+	in the table 'e2t', which is indexed both by element and by tag, so that only the
+	associations needed by a query are read. Elements are stored pickled. Row ids of
+	elements are never reused, so unpickled elements can be cached by row id. The pickled
+	attributes of elements are kept in the table 'attrs'.
+
+	The database uses write ahead logging, so readers are not blocked by a writer.
+	"""
+
+	# Suffix added to the name of the database file
+	SUFFIX = '.sqlite'
+
+	# Seconds to wait for the lock held by another writer
+	TIMEOUT = 60
+
+	SCHEMA = """
+		CREATE TABLE IF NOT EXISTS elements (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			element BLOB NOT NULL UNIQUE
+		);
+		CREATE TABLE IF NOT EXISTS tags (
+			id INTEGER PRIMARY KEY,
+			tag TEXT NOT NULL UNIQUE
+		);
+		CREATE TABLE IF NOT EXISTS e2t (
+			element INTEGER NOT NULL REFERENCES elements(id),
+			tag INTEGER NOT NULL REFERENCES tags(id),
+			PRIMARY KEY (element, tag)
+		) WITHOUT ROWID;
+		CREATE INDEX IF NOT EXISTS t2e ON e2t (tag, element);
+		CREATE TABLE IF NOT EXISTS attrs (
+			element INTEGER PRIMARY KEY REFERENCES elements(id),
+			attrs BLOB NOT NULL
+		);
+	"""
+
+	def checkSetup(cls, db_path, db_file):
+		return os.path.isfile(os.path.join(db_path, db_file + cls.SUFFIX))
+
+	checkSetup = classmethod(checkSetup)
+
+	def getFiles(cls, db_path, db_file):
+		path = os.path.join(db_path, db_file + cls.SUFFIX)
+		return [path, path + '-wal', path + '-shm']
+
+	getFiles = classmethod(getFiles)
+
+	def __init__(self, db_path, db_file, journal=False, commitWindow=0, watch=False):
+		"""
+		@param journal: Ignored. SQLite keeps its own journal.
+		@type journal: bool
+
+		@param commitWindow: Ignored. SQLite decides itself when the write ahead log is synced.
+		@type commitWindow: float
+
+		@param watch: Ignored. Changes are detected with the data version of SQLite.
+		@type watch: bool
+		"""
+		if sqlite3 is None:
+			raise ImportError("sqlite3 module is required for the SQLite tag store")
+
+		self.dbFile = os.path.join(db_path, db_file + SQLiteTagStore.SUFFIX)
+		self.conn = None
+		self.dataVersion = None
+		self.elements = {}
+		self.elementIds = {}
+		self.changes = 0
+		self.commits = 0
+		self.mutations = 0
+		self.startTime = time.time()
+
+	def __repr__(self):
+		return 'SQLite database at %s' % self.dbFile
+
+	def __connect(self):
+		if self.conn is None:
+			# The connection is shared by the threads of a threaded Tagging, which
+			# does not let queries run during a transaction
+			self.conn = sqlite3.connect(self.dbFile, timeout=SQLiteTagStore.TIMEOUT,
+					isolation_level=None, check_same_thread=False)
+			self.conn.text_factory = str
+			self.conn.execute("PRAGMA journal_mode=WAL")
+			self.conn.execute("PRAGMA synchronous=NORMAL")
+			self.conn.executescript(SQLiteTagStore.SCHEMA)
+
+	def getElement(self, id):
+		"""
+		S.getElement(id) -> Element stored with the given row id
+		"""
+		try:
+			return self.elements[id]
+		except KeyError:
+			cur = self.conn.execute("SELECT element FROM elements WHERE id = ?", (id,))
+			element = cPickle.loads(str(cur.fetchone()[0]))
+			self.elements[id] = element
+			self.elementIds[element] = id
+			return element
+
+	def getElements(self, ids):
+		"""
+		S.getElements(ids) -> List of the elements stored with the given row ids
+
+		Elements which were not read before are read with one statement for many ids.
+		"""
+		elements = self.elements
+		missing = [id for id in ids if id not in elements]
+		for i in range(0, len(missing), SQLiteTagView.MAX_PARAMS):
+			chunk = missing[i:i + SQLiteTagView.MAX_PARAMS]
+			cur = self.conn.execute("SELECT id, element FROM elements WHERE id IN (%s)" %
+						','.join('?' * len(chunk)), chunk)
+			for id, key in cur:
+				element = cPickle.loads(str(key))
+				elements[id] = element
+				self.elementIds[element] = id
+
+		return map(elements.__getitem__, ids)
+
+	def getElementId(self, element, create=False):
+		"""
+		S.getElementId(element, create) -> Row id of the element, None if it does not exist
+
+		@param create: Add the element if it does not exist. Only allowed in a transaction.
+		@type create: bool
+		"""
+		try:
+			return self.elementIds[element]
+		except KeyError:
+			pass
+
+		key = sqlite3.Binary(elementKey(element))
+		row = self.conn.execute("SELECT id FROM elements WHERE element = ?", (key,)).fetchone()
+		if row is not None:
+			id = row[0]
+		elif create:
+			id = self.conn.execute("INSERT INTO elements (element) VALUES (?)", (key,)).lastrowid
+		else:
+			return None
+
+		self.elements[id] = element
+		self.elementIds[element] = id
+		return id
+
+	def __getTagId(self, tag, create=False):
+		row = self.conn.execute("SELECT id FROM tags WHERE tag = ?", (tag,)).fetchone()
+		if row is not None:
+			return row[0]
+		elif create:
+			return self.conn.execute("INSERT INTO tags (tag) VALUES (?)", (tag,)).lastrowid
+		else:
+			return None
+
+	def __checkVersion(self):
+		# Elements may have been deleted and added again by other connections
+		version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+		if version != self.dataVersion:
+			self.elementIds.clear()
+			self.dataVersion = version
+
+	def __forgetElement(self, element):
+		try:
+			del self.elements[self.elementIds.pop(element)]
+		except KeyError:
+			pass
+
+	def initDB(self):
+		self.__connect()
+		self.conn.execute("BEGIN IMMEDIATE")
+		self.conn.execute("DELETE FROM e2t")
+		self.conn.execute("DELETE FROM attrs")
+		self.conn.execute("DELETE FROM elements")
+		self.conn.execute("DELETE FROM tags")
+		self.conn.execute("COMMIT")
+		self.elements.clear()
+		self.elementIds.clear()
+
+	def getView(self):
+		try:
+			self.__connect()
+			self.__checkVersion()
+		except sqlite3.Error:
+			return GPStor.GPS_ERR_NOSETUP, None
+
+		return GPStor.GPS_ERR_SUCCESS, SQLiteTagView(self)
+
+	def getViewRW(self):
+		try:
+			self.__connect()
+			self.conn.execute("BEGIN IMMEDIATE")
+			self.__checkVersion()
+		except sqlite3.Error:
+			return GPStor.GPS_ERR_NO_LOCK, None
+
+		return GPStor.GPS_ERR_SUCCESS, SQLiteTagView(self)
+
+	def applyDelta(self, delta):
+		self.changes += 1
+
+		for element, tag in delta.removed:
+			elementId = self.getElementId(element)
+			tagId = self.__getTagId(tag)
+			if elementId is not None and tagId is not None:
+				self.conn.execute("DELETE FROM e2t WHERE element = ? AND tag = ?",
+						(elementId, tagId))
+
+		for element in delta.delElements:
+			elementId = self.getElementId(element)
+			if elementId is not None:
+				self.conn.execute("DELETE FROM e2t WHERE element = ?", (elementId,))
+				self.conn.execute("DELETE FROM attrs WHERE element = ?", (elementId,))
+				self.conn.execute("DELETE FROM elements WHERE id = ?", (elementId,))
+				self.__forgetElement(element)
+
+		for tag in delta.delTags:
+			tagId = self.__getTagId(tag)
+			if tagId is not None:
+				self.conn.execute("DELETE FROM e2t WHERE tag = ?", (tagId,))
+				self.conn.execute("DELETE FROM tags WHERE id = ?", (tagId,))
+
+		for element in delta.newElements:
+			self.getElementId(element, create=True)
+
+		for tag in delta.newTags:
+			self.__getTagId(tag, create=True)
+
+		tagIds = {}
+		for element, tag in delta.added:
+			try:
+				tagId = tagIds[tag]
+			except KeyError:
+				tagId = tagIds[tag] = self.__getTagId(tag, create=True)
+			self.conn.execute("INSERT OR IGNORE INTO e2t (element, tag) VALUES (?, ?)",
+					(self.getElementId(element, create=True), tagId))
+
+		for element, attrs in delta.attrs.items():
+			elementId = self.getElementId(element)
+			if elementId is None:
+				continue
+			if attrs is None:
+				self.conn.execute("DELETE FROM attrs WHERE element = ?", (elementId,))
+			else:
+				data = sqlite3.Binary(cPickle.dumps(attrs, cPickle.HIGHEST_PROTOCOL))
+				self.conn.execute("INSERT OR REPLACE INTO attrs (element, attrs) VALUES (?, ?)",
+						(elementId, data))
+
+	def commit(self):
+		changes, self.changes = self.changes, 0
+		try:
+			self.conn.execute("COMMIT")
+		except sqlite3.Error:
+			self.conn.execute("ROLLBACK")
+			self.elements.clear()
+			self.elementIds.clear()
+			return GPStor.GPS_ERR_CORRUPT_DB
+
+		if changes > 0:
+			self.commits += 1
+			self.mutations += changes
+		return GPStor.GPS_ERR_SUCCESS
+
+	def getCommitStats(self):
+		return self.commits, self.mutations, time.time() - self.startTime
+
+	def getVersion(self):
+		# The data version of SQLite only counts commits of other connections
+		if self.dataVersion is None:
+			return None
+		return self.dataVersion, self.commits
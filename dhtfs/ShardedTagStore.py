@@ -0,0 +1,720 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import os
+import fcntl
+import tempfile
+import time
+import zlib
+
+from dhtfs.GPStor import GPStor
+from dhtfs.TagStore import TagStore, TagView, elementKey
+
+def shardOf(item, shards):
+	"""
+	shardOf(item, shards) -> Number of the shard keeping the item
+
+	The number is computed from the pickled item, so it does not change between processes.
+	"""
+	return (zlib.crc32(elementKey(item)) & 0xffffffff) % shards
+
+class ShardDelta:
+	"""
+	Part of a L{TagDelta<dhtfs.Tagging.TagDelta>} which is written to a single shard
+
+	A shard keeps only one of the maps of the tag dictionary, 'e2t' or 't2e'. The delta is
+	applied to a tag dictionary made of that map and an empty map in place of the other one.
+	Element shards also keep the 'e2a' map of the elements.
+	"""
+
+	def __init__(self, delta, key):
+		self.delta = delta
+		self.key = key
+
+	def apply(self, data):
+		tagDict = { 'e2t' : {}, 't2e' : {} }
+		tagDict[self.key] = data[self.key]
+		if self.key == 'e2t':
+			tagDict['e2a'] = data['e2a']
+		self.delta.apply(tagDict)
+
+class ShardedTagView(TagView):
+	"""
+	L{TagView} over the shards of a L{ShardedTagStore}
+
+	Shards are loaded when they are first needed and kept for the lifetime of the view.
+	The view of a transaction sees the changes applied so far, which are kept by the store
+	as copies of the entries they touched.
+	"""
+
+	def __init__(self, store, e2t=None, t2e=None, e2a=None):
+		self.store = store
+		self.e2t = e2t or {}		# element -> set of tags, None for removed elements
+		self.t2e = t2e or {}		# tag -> set of elements, None for removed tags
+		self.e2a = e2a or {}		# element -> attributes, None for dropped attributes
+		self.maps = {}
+
+	def __map(self, shards, key, index):
+		try:
+			return self.maps[(key, index)]
+		except KeyError:
+			pass
+
+		err, data = shards[index].getDataRO()
+		if err != GPStor.GPS_ERR_SUCCESS:
+			m = {}
+		else:
+			m = data[key]
+		self.maps[(key, index)] = m
+		return m
+
+	def getT2EMap(self, tag):
+		"""
+		V.getT2EMap(tag) -> Stored 't2e' map of the shard which keeps tag
+		"""
+		return self.__map(self.store.tagShards, 't2e', shardOf(tag, ShardedTagStore.SHARDS))
+
+	def getE2TMap(self, element):
+		"""
+		V.getE2TMap(element) -> Stored 'e2t' map of the shard which keeps element
+		"""
+		return self.__map(self.store.elementShards, 'e2t', shardOf(element, ShardedTagStore.SHARDS))
+
+	def getE2AMap(self, element):
+		"""
+		V.getE2AMap(element) -> Stored 'e2a' map of the shard which keeps element
+		"""
+		return self.__map(self.store.elementShards, 'e2a', shardOf(element, ShardedTagStore.SHARDS))
+
+	def __allMaps(self, shards, key):
+		return [self.__map(shards, key, i) for i in range(len(shards))]
+
+	def __all(self, shards, key, changes):
+		items = set([])
+		for m in self.__allMaps(shards, key):
+			items.update(m.iterkeys())
+		for item, value in changes.iteritems():
+			if value is None:
+				items.discard(item)
+			else:
+				items.add(item)
+		return items
+
+	def getElementsOf(self, tag):
+		if tag in self.t2e:
+			return self.t2e[tag] or set([])
+		return self.getT2EMap(tag).get(tag, set([]))
+
+	def getTagsOf(self, element):
+		if element in self.e2t:
+			return self.e2t[element] or set([])
+		return self.getE2TMap(element).get(element, set([]))
+
+	def hasTag(self, tag):
+		if tag in self.t2e:
+			return self.t2e[tag] is not None
+		return tag in self.getT2EMap(tag)
+
+	def hasElement(self, element):
+		if element in self.e2t:
+			return self.e2t[element] is not None
+		return element in self.getE2TMap(element)
+
+	def getAttrs(self, element):
+		if element in self.e2a:
+			return self.e2a[element]
+		return self.getE2AMap(element).get(element)
+
+	def getAllTags(self):
+		return list(self.__all(self.store.tagShards, 't2e', self.t2e))
+
+	def getAllElements(self):
+		return self.__all(self.store.elementShards, 'e2t', self.e2t)
+
+	def __tagsOfElements(self, elements):
+		# Looking up every element in all element shards is cheaper than computing
+		# the shard of each element
+		maps = self.__allMaps(self.store.elementShards, 'e2t')
+		for element in elements:
+			if element in self.e2t:
+				if self.e2t[element]:
+					yield self.e2t[element]
+				continue
+			for m in maps:
+				tags = m.get(element)
+				if tags is not None:
+					yield tags
+					break
+
+	def getTagsForElements(self, elements):
+		s1 = set([])
+		for tags in self.__tagsOfElements(elements):
+			s1.update(tags)
+
+		return s1
+
+	def getTagCounts(self, elements):
+		counts = {}
+		get = counts.get
+		for tags in self.__tagsOfElements(elements):
+			for tag in tags:
+				counts[tag] = get(tag, 0) + 1
+
+		return counts
+
+class ShardedTagStore(TagStore):
+	"""
+	L{TagStore} partitioning the tag dictionary into shards, each kept in its own L{GPStor}
+
+	Posting lists ('t2e') are assigned to L{SHARDS} tag shards by a hash of the tag and the
+	tags of elements ('e2t') to as many element shards by a hash of the element. A view loads
+	only the shards it needs, so reading one tag loads a single shard.
+
+	Changes of a transaction are collected in memory and written on L{commit}, which locks
+	and rewrites only the shards touched by the changes. Writers changing disjoint sets of
+	tags and elements do not wait for each other. Locks are taken in a fixed order, element
+	shards before tag shards, so writers can not deadlock.
+
+	A crash during a commit may leave the change written to only some of the shards. Before
+	a commit writes more than one shard it creates an intent file listing the shards, which
+	is locked while the commit is written and removed after the last shard was written.
+	Intent files which are left unlocked are reported by L{getIncompleteCommits}. With a
+	commit window of the shards a crash of the system may still lose the end of a commit.
+	"""
+
+	# Number of tag shards and of element shards. Changing it requires converting the database.
+	SHARDS = 16
+
+	# Suffixes added to the name of the database file for tag and element shards
+	TAG_SUFFIX = '.t%02d'
+	ELEMENT_SUFFIX = '.e%02d'
+
+	# Prefix added to the name of the database file for intent files of commits
+	COMMIT_PREFIX = '.commit.'
+
+	def __shardFiles(cls, db_file):
+		return [db_file + cls.TAG_SUFFIX % i for i in range(cls.SHARDS)] + \
+			[db_file + cls.ELEMENT_SUFFIX % i for i in range(cls.SHARDS)]
+
+	__shardFiles = classmethod(__shardFiles)
+
+	def checkSetup(cls, db_path, db_file):
+		for name in cls.__shardFiles(db_file):
+			if not GPStor.checkSetup(db_path=db_path, db_file=name):
+				return False
+		return True
+
+	checkSetup = classmethod(checkSetup)
+
+	def getFiles(cls, db_path, db_file):
+		files = []
+		for name in cls.__shardFiles(db_file):
+			path = os.path.join(db_path, name)
+			files.extend([path, path + '.lock', path + GPStor.JOURNAL_SUFFIX])
+		files.extend(cls.__intentFiles(db_path, db_file))
+		return files
+
+	getFiles = classmethod(getFiles)
+
+	def __intentFiles(cls, db_path, db_file):
+		# Names of temporary files have no dots, which leaves out renamed files
+		prefix = db_file + cls.COMMIT_PREFIX
+		try:
+			names = os.listdir(db_path)
+		except OSError:
+			return []
+		return [os.path.join(db_path, name) for name in sorted(names)
+				if name.startswith(prefix) and '.' not in name[len(prefix):]]
+
+	__intentFiles = classmethod(__intentFiles)
+
+	def getIncompleteCommits(cls, db_path, db_file):
+		commits = []
+		for path in cls.__intentFiles(db_path, db_file):
+			try:
+				f = file(path, 'r')
+			except IOError:
+				continue
+			try:
+				# The intent file of a commit which is being written is locked
+				try:
+					fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except IOError:
+					continue
+				# The file is empty until the commit took its lock
+				names = f.read().split()
+				if names and os.path.exists(path):
+					commits.append(names)
+			finally:
+				f.close()
+		return commits
+
+	getIncompleteCommits = classmethod(getIncompleteCommits)
+
+	def __init__(self, db_path, db_file, journal=False, commitWindow=0, watch=False):
+		"""
+		The options are passed to the L{GPStor} of every shard. See L{PickleTagStore<dhtfs.TagStore.PickleTagStore>}.
+		"""
+		self.tagShards = [GPStor(db_path=db_path, db_file=db_file + self.TAG_SUFFIX % i,
+					journal=journal, commitWindow=commitWindow, watch=watch)
+				for i in range(self.SHARDS)]
+		self.elementShards = [GPStor(db_path=db_path, db_file=db_file + self.ELEMENT_SUFFIX % i,
+					journal=journal, commitWindow=commitWindow, watch=watch)
+				for i in range(self.SHARDS)]
+		self.db_path = db_path
+		self.db_file = db_file
+		self.view = None
+		self.pending = None
+		self.version = None
+		self.startTime = time.time()
+		self.commits = 0
+		self.mutations = 0
+
+	def __repr__(self):
+		return '<ShardedTagStore %r>' % self.tagShards[0]
+
+	def initDB(self):
+		for shard in self.tagShards:
+			shard.getDataRW()
+			shard.writeData({ 't2e' : {} })
+		for shard in self.elementShards:
+			shard.getDataRW()
+			shard.writeData({ 'e2t' : {}, 'e2a' : {} })
+
+	def getView(self):
+		err = self.__checkShards()
+		if err != GPStor.GPS_ERR_SUCCESS:
+			return err, None
+
+		return err, ShardedTagView(self)
+
+	def getViewRW(self):
+		# No shard is locked before the commit
+		err = self.__checkShards()
+		if err != GPStor.GPS_ERR_SUCCESS:
+			return err, None
+
+		self.pending = None
+		self.view = ShardedTagView(self, {}, {}, {})
+		return err, self.view
+
+	def __checkShards(self):
+		# Views can not report errors, so missing shards are detected up front. The version
+		# is taken from the files, so that shards which are not loaded need not be read.
+		versions = [shard.getVersion(current=True) for shard in self.tagShards + self.elementShards]
+		if None in versions:
+			self.version = None
+			return GPStor.GPS_ERR_NOSETUP
+
+		self.version = tuple(versions)
+		return GPStor.GPS_ERR_SUCCESS
+
+	def applyDelta(self, delta):
+		view = self.view
+
+		# Copy the entries touched by the delta, so that the delta can be applied
+		# to them without changing the stored maps
+		elements = delta.getElements()
+		tags = delta.getTags()
+
+		e2t = {}
+		for element in elements:
+			if element not in view.e2t:
+				stored = view.getE2TMap(element).get(element)
+				if stored is not None:
+					stored = set(stored)
+				view.e2t[element] = stored
+			if view.e2t[element] is not None:
+				e2t[element] = view.e2t[element]
+
+		t2e = {}
+		for tag in tags:
+			if tag not in view.t2e:
+				stored = view.getT2EMap(tag).get(tag)
+				if stored is not None:
+					stored = set(stored)
+				view.t2e[tag] = stored
+			if view.t2e[tag] is not None:
+				t2e[tag] = view.t2e[tag]
+
+		delta.apply({ 'e2t' : e2t, 't2e' : t2e })
+
+		for element in elements:
+			view.e2t[element] = e2t.get(element)
+		for tag in tags:
+			view.t2e[tag] = t2e.get(tag)
+		for element in delta.delElements:
+			view.e2a[element] = None
+		view.e2a.update(delta.attrs)
+
+		if self.pending is None:
+			self.pending = delta
+		else:
+			self.pending.merge(delta)
+		self.mutations += 1
+
+	def commit(self):
+		pending, self.pending = self.pending, None
+		self.view = None
+
+		if pending is None or pending.isEmpty():
+			return GPStor.GPS_ERR_SUCCESS
+
+		err = self.__write(pending)
+		if err == GPStor.GPS_ERR_SUCCESS:
+			self.commits += 1
+		return err
+
+	def __lock(self, shards, indexes, locked):
+		data = {}
+		for i in sorted(indexes):
+			err, data[i] = shards[i].getDataRW()
+			if err != GPStor.GPS_ERR_SUCCESS:
+				shards[i].release()
+				for shard in locked:
+					shard.release()
+				return err, None
+			locked.append(shards[i])
+		return GPStor.GPS_ERR_SUCCESS, data
+
+	def __beginCommit(self, names):
+		# Create the intent file of a commit writing to the shards with the given file
+		# names. The file is locked until it is closed.
+		fd, path = tempfile.mkstemp(prefix=self.db_file + self.COMMIT_PREFIX, dir=self.db_path)
+		f = os.fdopen(fd, 'w')
+		fcntl.flock(f, fcntl.LOCK_EX)
+		f.write(''.join([name + '\n' for name in names]))
+		f.flush()
+		os.fsync(f.fileno())
+		fd = os.open(self.db_path, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+		return f, path
+
+	def __endCommit(self, intent, complete):
+		f, path = intent
+		if complete:
+			os.remove(path)
+		f.close()
+
+	def __write(self, delta):
+		# Shards are locked in a fixed order: element shards before tag shards, each
+		# in ascending order. The changes are then checked against the locked data,
+		# since the delta was computed from a view which did not hold any lock.
+		shards = self.SHARDS
+		elementShard = {}
+		for element in delta.getElements().union(delta.attrs):
+			elementShard[element] = shardOf(element, shards)
+
+		locked = []
+		if delta.delTags:
+			# Elements of a removed tag can only be found in its tag shard
+			indexes = range(shards)
+		else:
+			indexes = set(elementShard.values())
+		err, elementData = self.__lock(self.elementShards, indexes, locked)
+		if err != GPStor.GPS_ERR_SUCCESS:
+			self.version = None
+			return err
+
+		for element in delta.delElements:
+			for tag in elementData[elementShard[element]]['e2t'].get(element, ()):
+				delta.removed.add((element, tag))
+
+		tagShard = {}
+		for tag in delta.getTags():
+			tagShard[tag] = shardOf(tag, shards)
+
+		err, tagData = self.__lock(self.tagShards, set(tagShard.values()), locked)
+		if err != GPStor.GPS_ERR_SUCCESS:
+			self.version = None
+			return err
+
+		# The version is only kept if no other process changed the shards since the view
+		# was taken, as such changes are not known to the caller
+		allShards = self.tagShards + self.elementShards
+		if self.version is not None:
+			for shard in locked:
+				if shard.getVersion(current=True) != self.version[allShards.index(shard)]:
+					self.version = None
+					break
+
+		for tag in delta.delTags:
+			for element in tagData[tagShard[tag]]['t2e'].get(tag, ()):
+				delta.removed.add((element, tag))
+				if element not in elementShard:
+					elementShard[element] = shardOf(element, shards)
+
+		elementDeltas = {}
+		tagDeltas = {}
+		def deltaOf(deltas, i):
+			if i not in deltas:
+				deltas[i] = delta.__class__()
+			return deltas[i]
+
+		for pairs, attr in ((delta.removed, 'removed'), (delta.added, 'added')):
+			for element, tag in pairs:
+				getattr(deltaOf(elementDeltas, elementShard[element]), attr).add((element, tag))
+				getattr(deltaOf(tagDeltas, tagShard[tag]), attr).add((element, tag))
+		for element in delta.delElements:
+			deltaOf(elementDeltas, elementShard[element]).delElements.add(element)
+		for element in delta.newElements:
+			deltaOf(elementDeltas, elementShard[element]).newElements.add(element)
+		for tag in delta.delTags:
+			deltaOf(tagDeltas, tagShard[tag]).delTags.add(tag)
+		for tag in delta.newTags:
+			deltaOf(tagDeltas, tagShard[tag]).newTags.add(tag)
+
+		# Attributes of elements which another writer removed meanwhile are not kept
+		newElements = delta.newElements.union([e for (e, t) in delta.added])
+		for element, attrs in delta.attrs.items():
+			i = elementShard[element]
+			if element in newElements or element in elementData[i]['e2t']:
+				deltaOf(elementDeltas, i).attrs[element] = attrs
+
+		intent = None
+		if len(elementDeltas) + len(tagDeltas) > 1:
+			intent = self.__beginCommit([self.db_file + self.ELEMENT_SUFFIX % i for i in sorted(elementDeltas)] +
+					[self.db_file + self.TAG_SUFFIX % i for i in sorted(tagDeltas)])
+
+		result = GPStor.GPS_ERR_SUCCESS
+		written = True
+		for shardList, data, deltas, key in ((self.elementShards, elementData, elementDeltas, 'e2t'),
+						(self.tagShards, tagData, tagDeltas, 't2e')):
+			for i in sorted(data.keys()):
+				if i in deltas:
+					err = shardList[i].writeDelta(ShardDelta(deltas[i], key))
+					if err != GPStor.GPS_ERR_SUCCESS:
+						written = False
+				else:
+					err = shardList[i].release()
+				if err != GPStor.GPS_ERR_SUCCESS and result == GPStor.GPS_ERR_SUCCESS:
+					result = err
+
+		if intent is not None:
+			self.__endCommit(intent, written)
+
+		if self.version is not None:
+			versions = list(self.version)
+			for shard in locked:
+				versions[allShards.index(shard)] = shard.getVersion()
+			self.version = tuple(versions)
+
+		return result
+
+	def sync(self):
+		for shard in self.tagShards + self.elementShards:
+			shard.sync()
+
+	def getCommitStats(self):
+		return self.commits, self.mutations, time.time() - self.startTime
+
+	def getVersion(self):
+		return self.version
+
+def test():
+	import random
+	import shutil
+	from dhtfs.Tagging import Tagging
+
+	TEST_DIR = '/tmp/zzzzzzzzzzzzz_sharded'
+
+	print "Running tests ..."
+	random.seed(0)
+
+	def newTagging(name, backend):
+		path = os.path.join(TEST_DIR, name)
+		shutil.rmtree(path, True)
+		os.makedirs(path)
+		t = Tagging(path, backend=backend)
+		t.initDB(forceInit=True)
+		return t
+
+	def content(t):
+		e2t = t.getTagsDict()
+		return e2t, t.getElementsDict(), dict([(e, t.getAttrs(e)) for e in e2t])
+
+	def operate(t, r, elements, tags):
+		# Apply a random change, the random generator decides the same change for
+		# every tagging
+		op = r.randint(0, 9)
+		if op < 5:
+			t.addTags(r.sample(elements, r.randint(1, 5)), r.sample(tags, r.randint(0, 3)))
+		elif op == 5:
+			t.delElementsFromTags(r.sample(elements, 2), r.sample(tags, r.randint(0, 2)))
+		elif op == 6:
+			t.delTagsFromElements(r.sample(tags, 1), r.sample(elements, r.randint(0, 3)))
+		elif op == 7:
+			t.renameTag(r.choice(tags), r.choice(tags))
+		else:
+			t.setAttrs(dict([(e, r.choice([None, (op, e)])) for e in r.sample(elements, 3)]))
+
+	# Test 1
+	# Commits spreading over many shards give the same result as a single store
+	sharded = newTagging('sharded', 'sharded')
+	pickled = newTagging('pickle', 'pickle')
+	elements = ['e%d' % i for i in range(100)]
+	tags = ['t%d' % i for i in range(30)]
+	ok = True
+	for i in range(300):
+		state = random.getstate()
+		operate(sharded, random, elements, tags)
+		random.setstate(state)
+		operate(pickled, random, elements, tags)
+		if i % 50 == 0:
+			ok = ok and content(sharded) == content(pickled)
+	# Removing a tag of every element changes all element shards
+	sharded.addTags(elements, ['everywhere'])
+	pickled.addTags(elements, ['everywhere'])
+	sharded.delTagsFromElements(['everywhere'])
+	pickled.delTagsFromElements(['everywhere'])
+	ok = ok and content(sharded) == content(pickled)
+	ok = ok and content(Tagging(sharded.db_path)) == content(pickled)
+	ok = ok and Tagging.getIncompleteCommits(sharded.db_path) == []
+	if ok:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test 2
+	# Writers in several processes, on disjoint and on overlapping shards
+	writers = 4
+	ok = True
+	for overlapping in (False, True):
+		sharded = newTagging('sharded', 'sharded')
+		pickled = newTagging('pickle', 'pickle')
+		work = []
+		for w in range(writers):
+			if overlapping:
+				ownElements = ['w%d_%d' % (w, i) for i in range(20)] + ['shared%d' % i for i in range(5)]
+				ownTags = ['tag%d' % w, 'common']
+			else:
+				ownElements = [e for e in ['w%d_%d' % (w, i) for i in range(400)]
+						if shardOf(e, ShardedTagStore.SHARDS) % writers == w][:20]
+				ownTags = [t for t in ['tag%d_%d' % (w, i) for i in range(100)]
+						if shardOf(t, ShardedTagStore.SHARDS) % writers == w][:3]
+			work.append((ownElements, ownTags))
+
+		def run(t, w):
+			ownElements, ownTags = work[w]
+			for i in range(40):
+				t.addTags(ownElements[i % 20:i % 20 + 2] + ownElements[20:][i % 5:i % 5 + 1],
+						ownTags[i % 2:])
+				if i % 10 == 9:
+					t.delElementsFromTags([ownElements[i % 20]], [])
+
+		pids = []
+		for w in range(writers):
+			pid = os.fork()
+			if pid == 0:
+				try:
+					run(Tagging(sharded.db_path), w)
+				finally:
+					os._exit(0)
+			pids.append(pid)
+		for w in range(writers):
+			run(pickled, w)
+		for pid in pids:
+			os.waitpid(pid, 0)
+		ok = ok and content(Tagging(sharded.db_path)) == content(pickled)
+	if ok:
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+	# Test 3
+	# A commit interrupted after it was written to some of its shards is reported
+	sharded = newTagging('sharded', 'sharded')
+	store = ShardedTagStore(sharded.db_path, Tagging.DB_FILE)
+	intent = store._ShardedTagStore__beginCommit(['a', 'b'])
+	ok = ShardedTagStore.getIncompleteCommits(sharded.db_path, Tagging.DB_FILE) == []
+	store._ShardedTagStore__endCommit(intent, True)
+	ok = ok and ShardedTagStore.getIncompleteCommits(sharded.db_path, Tagging.DB_FILE) == []
+
+	pid = os.fork()
+	if pid == 0:
+		try:
+			writeDelta = GPStor.writeDelta
+			written = []
+			def crashingWriteDelta(self, delta):
+				if written:
+					os._exit(0)
+				written.append(delta)
+				return writeDelta(self, delta)
+			GPStor.writeDelta = crashingWriteDelta
+			Tagging(sharded.db_path).addTags(elements, ['crash'])
+		finally:
+			os._exit(0)
+	os.waitpid(pid, 0)
+	commits = Tagging.getIncompleteCommits(sharded.db_path)
+	ok = ok and len(commits) == 1 and len(commits[0]) > 2
+	ok = ok and sharded.getElements(['crash']) != elements
+	sharded.addTags(elements, ['after'])
+	ok = ok and Tagging.getIncompleteCommits(sharded.db_path) == commits
+	if ok:
+		print "Test3 succesful"
+	else:
+		print "Test3 Failed"
+
+	# Test 4
+	# Changes made in one transaction give the same result as the changes committed one
+	# by one, also for a tag which is created and emptied again in the transaction
+	sharded = newTagging('sharded', 'sharded')
+	pickled = newTagging('pickle', 'pickle')
+	for t in (sharded, pickled):
+		t.addTags(['keep'], ['x'])
+	sharded.setWriteCaching()
+	sharded.addTags(['e'], ['new'])
+	sharded.delElementsFromTags(['e'], ['new'])
+	sharded.doneWriteCaching()
+	pickled.addTags(['e'], ['new'])
+	pickled.delElementsFromTags(['e'], ['new'])
+	ok = sorted(sharded.getElementsDict().keys()) == ['new', 'x']
+	ok = ok and content(sharded) == content(pickled)
+	elements = elements[:20]
+	tags = tags[:8]
+	for i in range(100):
+		state = random.getstate()
+		sharded.setWriteCaching()
+		for j in range(5):
+			operate(sharded, random, elements, tags)
+		sharded.doneWriteCaching()
+		random.setstate(state)
+		for j in range(5):
+			operate(pickled, random, elements, tags)
+		ok = ok and content(sharded) == content(pickled)
+	ok = ok and content(Tagging(sharded.db_path)) == content(pickled)
+	if ok:
+		print "Test4 succesful"
+	else:
+		print "Test4 Failed"
+
+	shutil.rmtree(TEST_DIR, True)
+
+if __name__ == "__main__":
+	test()
@@ -29,7 +29,11 @@ import md5
 import os
 import logging
 import stat
+import threading
+from collections import OrderedDict
 from dhtfs.Tagging import Tagging
+from dhtfs.BloomFilter import BloomFilter
+from dhtfs.RWLock import readLocked, writeLocked, synchronized
 
 class TagFile:
 	"""
@@ -68,6 +72,191 @@ class TagFile:
 		else:
 			return True
 
+class FileNameIndex:
+	"""
+	Index of the files of a L{TagDir} by their names
+
+	The index is built from all files when it is first used and then updated by every
+	change made through the L{TagDir}, see L{Tagging.addIndex<dhtfs.Tagging.Tagging.addIndex>}.
+	"""
+
+	def __init__(self):
+		self.files = None		# name -> set of files, None if not built
+		self.version = None
+		self.lock = threading.RLock()
+
+	def __repr__(self):
+		if self.files is None:
+			return '<FileNameIndex not built>'
+		return '<FileNameIndex of %d names>' % len(self.files)
+
+	def validate(self, version):
+		if version is None or version != self.version:
+			self.files = None
+		self.version = version
+
+	validate = synchronized(validate)
+
+	def setVersion(self, version):
+		if version is None:
+			self.validate(version)
+		self.version = version
+
+	setVersion = synchronized(setVersion)
+
+	def applyDelta(self, delta, view):
+		if self.files is None:
+			return
+
+		for f in delta.getElements():
+			if view.hasElement(f):
+				self.files.setdefault(f.name, set([])).add(f)
+			else:
+				files = self.files.get(f.name)
+				if files is not None:
+					files.discard(f)
+					if not files:
+						del self.files[f.name]
+
+	applyDelta = synchronized(applyDelta)
+
+	def lookup(self, name, view):
+		"""
+		I.lookup(name, view) -> List of the files with the given name
+		"""
+		if self.version is None:
+			# The index can not be kept without knowing when it became invalid
+			return [f for f in view.getAllElements() if f.name == name]
+
+		if self.files is None:
+			self.files = {}
+			for f in view.getAllElements():
+				self.files.setdefault(f.name, set([])).add(f)
+
+		return list(self.files.get(name, []))
+
+	lookup = synchronized(lookup)
+
+class MissingPathCache:
+	"""
+	Cache of the paths of a L{TagDir} which were found not to exist
+
+	Paths are recorded with the generation of the data in which they were looked up. The
+	generation changes with every change made through the L{TagDir} and whenever the
+	database was changed by someone else, which drops all recorded paths at once. The
+	least recently recorded path is dropped when the cache is full.
+
+	Optionally a L{BloomFilter<dhtfs.BloomFilter.BloomFilter>} of the names of all files
+	and directories tells about most names that they do not exist anywhere, without
+	having to record them.
+	"""
+
+	def __init__(self, size, useFilter=False):
+		"""
+		@param size: Maximum number of paths recorded, 0 disables recording paths
+		@type size: int
+
+		@param useFilter: Keep a Bloom filter of the names of all files and directories
+		@type useFilter: bool
+		"""
+		self.size = size
+		self.useFilter = useFilter
+		self.entries = OrderedDict()	# (dirs, name) -> generation
+		self.generation = 0
+		self.filter = None
+		self.version = None
+		self.lock = threading.RLock()
+		self.hits = 0
+		self.misses = 0
+		self.filtered = 0
+
+	def __repr__(self):
+		return '<MissingPathCache of %d/%d paths>' % (len(self.entries), self.size)
+
+	def validate(self, version):
+		if version is None or version != self.version:
+			self.generation += 1
+			self.filter = None
+		self.version = version
+
+	validate = synchronized(validate)
+
+	def setVersion(self, version):
+		if version is None:
+			self.validate(version)
+		self.version = version
+
+	setVersion = synchronized(setVersion)
+
+	def applyDelta(self, delta, view):
+		self.generation += 1
+		if self.filter is None:
+			return
+
+		# Names are never removed from the filter
+		for f in delta.getElements():
+			self.filter.add(f.name)
+		for tag in delta.getTags():
+			self.filter.add(tag)
+		if self.filter.isFull():
+			self.filter = None
+
+	applyDelta = synchronized(applyDelta)
+
+	def lookup(self, path, view):
+		"""
+		C.lookup(path, view) -> True if the path (dirs, name) is known not to exist
+		"""
+		if self.version is None:
+			return False
+
+		if self.useFilter:
+			if self.filter is None:
+				self.__buildFilter(view)
+			if path[1] not in self.filter:
+				self.filtered += 1
+				return True
+
+		if self.entries.get(path) == self.generation:
+			self.hits += 1
+			return True
+
+		self.misses += 1
+		return False
+
+	lookup = synchronized(lookup)
+
+	def __buildFilter(self, view):
+		tags = view.getAllTags()
+		elements = view.getAllElements()
+
+		# Leave room for names added later
+		self.filter = BloomFilter(2 * (len(tags) + len(elements)) + 1024)
+		for tag in tags:
+			self.filter.add(tag)
+		for f in elements:
+			self.filter.add(f.name)
+
+	def add(self, path):
+		"""
+		C.add(path) -> Record that the path (dirs, name) does not exist in the current generation
+		"""
+		if self.size <= 0 or self.version is None:
+			return
+
+		self.entries.pop(path, None)
+		self.entries[path] = self.generation
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	add = synchronized(add)
+
+	def getStats(self):
+		"""
+		C.getStats() -> (hits, misses, names rejected by the filter, number of recorded paths)
+		"""
+		return self.hits, self.misses, self.filtered, len(self.entries)
+
 class TagDir(Tagging):
 	"""
 	This class extends Tagging and implements functions which help in mapping tags to directories
@@ -75,20 +264,42 @@ class TagDir(Tagging):
 
 	DEFAULT_DIR_MODE = (stat.S_IRWXO | stat.S_IRUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IWRITE)
 
+	# Default number of paths recorded as missing
+	MISSING_CACHE_SIZE = 1024
+
+	def __init__(self, db_path=os.getcwd(), db_file=Tagging.DB_FILE, missingCacheSize=MISSING_CACHE_SIZE,
+			nameFilter=False, **kw):
+		"""
+		TagDir() -> object of class TagDir
+
+		See L{Tagging} for the other parameters.
+
+		@param missingCacheSize: Number of paths which were found not to exist that are kept
+			until a change is made. 0 disables the cache.
+		@type missingCacheSize: int
+
+		@param nameFilter: Keep a Bloom filter of all file and directory names, so that names
+			which do not exist anywhere are rejected without looking at the directories.
+		@type nameFilter: bool
+		"""
+		Tagging.__init__(self, db_path, db_file, **kw)
+		self.nameIndex = FileNameIndex()
+		self.addIndex(self.nameIndex)
+		self.missingPaths = MissingPathCache(missingCacheSize, nameFilter)
+		self.addIndex(self.missingPaths)
+
 	def __str__(self):
 		return 'Directory helper for ' + Tagging.__str__(self)
 
 	def __createActualDirs(self, dirs, mode):
-		allDirs = self.getAllDirs()
-		dirs = [x for x in dirs if x not in allDirs]
+		dirs = [x for x in dirs if not self.isDir(x)]
 		for dir in dirs:
 			dirname = os.path.join(self.db_path, 't_' + dir)
 			if not os.path.isdir(dirname):
 				os.mkdir(dirname, mode)
 
 	def __delActualDirs(self, dirs):
-		allDirs = self.getAllDirs()
-		dirs = [x for x in dirs if x in allDirs]
+		dirs = [x for x in dirs if self.isDir(x)]
 		for dir in dirs:
 			dirname = os.path.join(self.db_path, 't_' + dir)
 			if os.path.isdir(dirname):
@@ -111,6 +322,8 @@ class TagDir(Tagging):
 		if [dirs1[-1] != dirs2[-1]]:
 			self.__renameActualDir(dirs1[-1], dirs2[-1])
 
+	renameDir = writeLocked(renameDir)
+
 	def addDirsToFiles(self, fileList, dirList, mode=DEFAULT_DIR_MODE):
 		"""
 		Associates the specified directories to the specified files
@@ -127,6 +340,8 @@ class TagDir(Tagging):
 		self.__createActualDirs(dirList, mode)
 		Tagging.addTags(self, fileList, dirList)
 
+	addDirsToFiles = writeLocked(addDirsToFiles)
+
 	def createDirs(self, dirs, mode=DEFAULT_DIR_MODE):
 		"""
 		Create Directories
@@ -140,6 +355,8 @@ class TagDir(Tagging):
 		self.__createActualDirs(dirs, mode)
 		Tagging.addTags(self, newTagList=dirs)
 
+	createDirs = writeLocked(createDirs)
+
 	def delDirs(self, dirs):
 		"""
 		Delete Directories
@@ -150,6 +367,8 @@ class TagDir(Tagging):
 		self.__delActualDirs(dirs)
 		Tagging.delTagsFromElements(self, dirs)
 
+	delDirs = writeLocked(delDirs)
+
 	def delFilesFromDirs(self, files, dirs):
 		"""
 		Delete files from directories
@@ -164,6 +383,8 @@ class TagDir(Tagging):
 		self.__delActualDirs(dirs)
 		Tagging.delTagsFromElements(self, dirs, files)
 
+	delFilesFromDirs = writeLocked(delFilesFromDirs)
+
 	def delFiles(self, files, dirs=[]):
 		"""
 		Delete files
@@ -173,6 +394,8 @@ class TagDir(Tagging):
 		"""
 
 		Tagging.delElementsFromTags(self, files, tagList=dirs)
+
+	delFiles = writeLocked(delFiles)
 		
 	def getAllDirs(self):
 		"""
@@ -182,7 +405,7 @@ class TagDir(Tagging):
 		@rtype: List of str
 		"""
 
-		return Tagging.getTagsForTags(self, tagList = [])
+		return Tagging.getAllTags(self)
 
 	def getDirsForFiles(self, files):
 		"""
@@ -210,7 +433,7 @@ class TagDir(Tagging):
 
 		return Tagging.getTagsForTags(self, dirList)
 
-	def getDirsAndFilesForDirs(self, dirList, beRestrictive=False, getCover=False):
+	def getDirsAndFilesForDirs(self, dirList, beRestrictive=False, getCover=False, coverLimit=None):
 		"""
 		Get files contained in all the directories specified in dirList. Also get list of other directories which contain ANY of these files
 
@@ -239,11 +462,30 @@ class TagDir(Tagging):
 
 		@type getCover: bool
 
+		@param coverLimit: Maximum number of directories returned with getCover. Files which are
+			not contained in these directories are returned as files. Defaults to no limit.
+		@type coverLimit: int
+
 		@return: A tuple of list of directories and list of files
 		@rtype: (List of str, List of instances of L{TagFile})
 		"""
 
-		return Tagging.getTagsAndElementsForTags(self, dirList, beRestrictive, getCover)
+		return Tagging.getTagsAndElementsForTags(self, dirList, beRestrictive, getCover, coverLimit)
+
+	def iterDirsAndFilesForDirs(self, dirList, beRestrictive=False, getCover=False, coverLimit=None,
+			limit=None, cursor=None, offset=0):
+		"""
+		Iterate over the result of L{getDirsAndFilesForDirs} in a stable order
+
+		Files are returned as (L{Tagging.ELEMENT<dhtfs.Tagging.Tagging.ELEMENT>}, file) ordered
+		by name, followed by the directories as (L{Tagging.TAG<dhtfs.Tagging.Tagging.TAG>}, dir).
+		See L{Tagging.iterElements<dhtfs.Tagging.Tagging.iterElements>} for limit, cursor and offset.
+
+		@return: Iterator over the files and directories
+		@rtype: L{ResultIterator<dhtfs.Tagging.ResultIterator>}
+		"""
+		return Tagging.iterTagsAndElementsForTags(self, dirList, beRestrictive, getCover, coverLimit,
+				limit, cursor, offset)
 
 	def getAllFiles(self):
 		"""
@@ -267,6 +509,20 @@ class TagDir(Tagging):
 		"""
 		return Tagging.getElements(self, dirList)
 
+	def iterFilesForDirs(self, dirList, limit=None, cursor=None, offset=0):
+		"""
+		Iterate over the files which are contained in all of the given directories, ordered by name
+
+		See L{Tagging.iterElements<dhtfs.Tagging.Tagging.iterElements>} for limit, cursor and offset.
+
+		@return: Iterator over the files
+		@rtype: L{ResultIterator<dhtfs.Tagging.ResultIterator>}
+		"""
+		return Tagging.iterElements(self, dirList, limit, cursor, offset)
+
+	def getSortKey(self, f):
+		return f.name, f.location
+
 	def isDir(self, fname):
 		"""
 		Check whether the specified name is the name of a directory
@@ -277,18 +533,67 @@ class TagDir(Tagging):
 		@return: True is fname is a directory, False otherwise
 		@rtype: bool
 		"""
-		if fname in self.getAllDirs():
+		if Tagging.tagExists(self, fname):
 			return True
 		else:
 			return False
 
+	def getFilesByName(self, names):
+		"""
+		Get the files with the given names
+
+		@param names: File names
+		@type names: List of str
+
+		@return: List of files
+		@rtype: List of instances of L{TagFile}
+		"""
+		files = []
+		for name in set(names):
+			files.extend(Tagging.lookupIndex(self, self.nameIndex, name))
+		return files
+
+	def isMissing(self, dirs, name):
+		"""
+		Check whether a path is known not to exist, see L{addMissing}
+
+		@param dirs: Directories of the path
+		@type dirs: List of str
+
+		@param name: Name of the file or directory
+		@type name: str
+
+		@return: True if the path does not exist, False if it is not known
+		@rtype: bool
+		"""
+		return Tagging.lookupIndex(self, self.missingPaths, (tuple(dirs), name))
+
+	def addMissing(self, dirs, name):
+		"""
+		Record that a path does not exist until the next change
+		"""
+		self.missingPaths.add((tuple(dirs), name))
+
+	def getMissingCacheStats(self):
+		"""
+		Get the statistics of the cache of missing paths
+
+		@return: (hits, misses, names rejected by the filter, number of recorded paths)
+		@rtype: C{(int, int, int, int)}
+		"""
+		return self.missingPaths.getStats()
+
 	def getActualLocation(self, dirs, filename):
-		filesInDir = Tagging.getElements(self, dirs)
-		matchingFiles = [x for x in filesInDir if x.name == filename]
+		# Only the files with the name are checked for the directories
+		matchingFiles = Tagging.lookupIndex(self, self.nameIndex, filename)
+		if len(matchingFiles) != 0:
+			matchingFiles = Tagging.getElements(self, dirs, matchingFiles)
 		if len(matchingFiles) == 0:
 			return None
 		else:
 			return matchingFiles[0].location
+
+	getActualLocation = readLocked(getActualLocation)
 		
 def getLogger(name):
 	logging.basicConfig(level=logging.DEBUG,
@@ -334,5 +639,44 @@ def main():
 
 	print x
 
+	# Paths recorded as missing are forgotten after changes made through this or
+	# another instance
+	td.addMissing(['root'], 'file4')
+	td.addMissing(['other'], 'file1')
+	ok = td.isMissing(['root'], 'file4') and td.isMissing(['other'], 'file1')
+	td.createDirs(['other'])
+	ok = ok and not td.isMissing(['root'], 'file4') and not td.isMissing(['other'], 'file1')
+	td.addMissing(['root'], 'file4')
+	other = TagDir(testDirectory)
+	other.addDirsToFiles([TagFile(os.path.join(testDirectory, 'file4'), 'file4')], ['root'])
+	ok = ok and not td.isMissing(['root'], 'file4')
+	if ok:
+		print 'Test 2 passed'
+	else:
+		print 'Test 2 failed'
+
+	# Names which are not in the Bloom filter are missing in every directory
+	td = TagDir(testDirectory, nameFilter=True)
+	ok = td.isMissing([], 'nothere') and td.isMissing(['root'], 'nothere')
+	ok = ok and not td.isMissing(['root'], 'file1') and not td.isMissing([], 'root')
+	td.addDirsToFiles([TagFile(os.path.join(testDirectory, 'nothere'), 'nothere')], ['root'])
+	ok = ok and not td.isMissing(['root'], 'nothere')
+	if ok:
+		print 'Test 3 passed'
+	else:
+		print 'Test 3 failed'
+
+	# A filter which received more names than it was sized for is built again
+	many = [TagFile(os.path.join(testDirectory, 'many%d' % i), 'many%d' % i) for i in range(2000)]
+	td.addDirsToFiles(many, ['many'])
+	full = td.missingPaths.filter is None
+	ok = not td.isMissing(['many'], 'many1999') and td.missingPaths.filter is not None
+	ok = ok and len([f for f in many if td.isMissing(['many'], f.name)]) == 0
+	ok = ok and td.isMissing(['many'], 'none')
+	if full and ok:
+		print 'Test 4 passed'
+	else:
+		print 'Test 4 failed'
+
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,543 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from itertools import imap
+from dhtfs.Bitmap import Bitmap
+from dhtfs.TagStore import TagView
+
+class TagIndex:
+	"""
+	Index of the associations between elements and tags
+
+	Elements and tags are interned to dense integer ids. The elements associated with a tag
+	are kept in a compressed L{Bitmap} of element ids, so intersections, unions and
+	cardinalities of posting lists are computed on bitmaps without hashing any element.
+	The ids of removed elements and tags are reused.
+
+	The index is changed by applying L{TagDelta<dhtfs.Tagging.TagDelta>} objects.
+	"""
+
+	def __init__(self):
+		self.elements = []		# element id -> element, None for free ids
+		self.elementIds = {}		# element -> element id
+		self.freeElementIds = []
+		self.tags = []			# tag id -> tag, None for free ids
+		self.tagIds = {}		# tag -> tag id
+		self.freeTagIds = []
+		self.postings = {}		# tag id -> Bitmap of element ids
+		self.tagCounts = {}		# tag id -> number of element ids in the posting list
+		self.e2t = {}			# element id -> set of tag ids
+		self.attrs = {}			# element id -> attributes of the element
+		self.live = Bitmap()		# ids of all elements
+
+	def __repr__(self):
+		return '<TagIndex of %d elements and %d tags>' % (len(self.elementIds), len(self.tagIds))
+
+	def internElement(self, element):
+		"""
+		I.internElement(element) -> id of the element, adding it if required
+		"""
+		try:
+			return self.elementIds[element]
+		except KeyError:
+			pass
+
+		if self.freeElementIds:
+			id = self.freeElementIds.pop()
+			self.elements[id] = element
+		else:
+			id = len(self.elements)
+			self.elements.append(element)
+
+		self.elementIds[element] = id
+		self.e2t[id] = set([])
+		self.live.add(id)
+		return id
+
+	def internTag(self, tag):
+		"""
+		I.internTag(tag) -> id of the tag, adding it if required
+		"""
+		try:
+			return self.tagIds[tag]
+		except KeyError:
+			pass
+
+		if self.freeTagIds:
+			id = self.freeTagIds.pop()
+			self.tags[id] = tag
+		else:
+			id = len(self.tags)
+			self.tags.append(tag)
+
+		self.tagIds[tag] = id
+		self.postings[id] = Bitmap()
+		self.tagCounts[id] = 0
+		return id
+
+	def __dropElement(self, id):
+		for tagId in self.e2t.pop(id):
+			self.postings[tagId].discard(id)
+			self.tagCounts[tagId] -= 1
+		self.__dropAttrs(id)
+		del self.elementIds[self.elements[id]]
+		self.elements[id] = None
+		self.freeElementIds.append(id)
+		self.live.discard(id)
+
+	def __dropAttrs(self, id):
+		if id in self.attrs:
+			del self.attrs[id]
+
+	def __dropTag(self, id):
+		for elementId in self.postings.pop(id):
+			self.e2t[elementId].discard(id)
+		self.tagCounts.pop(id)
+		del self.tagIds[self.tags[id]]
+		self.tags[id] = None
+		self.freeTagIds.append(id)
+
+	def applyDelta(self, delta):
+		"""
+		I.applyDelta(delta) -> Apply a L{TagDelta<dhtfs.Tagging.TagDelta>} to the index
+		"""
+
+		# Changes to posting lists are collected per tag, so that each bitmap is
+		# changed only once
+		removed = {}
+		for element, tag in delta.removed:
+			elementId = self.elementIds.get(element)
+			tagId = self.tagIds.get(tag)
+			if elementId is not None and tagId is not None:
+				tagIds = self.e2t[elementId]
+				if tagId in tagIds:
+					tagIds.discard(tagId)
+					removed.setdefault(tagId, []).append(elementId)
+
+		for tagId, elementIds in removed.items():
+			self.postings[tagId] -= Bitmap(elementIds)
+			self.tagCounts[tagId] -= len(elementIds)
+
+		for element in delta.delElements:
+			elementId = self.elementIds.get(element)
+			if elementId is not None:
+				self.__dropElement(elementId)
+
+		for tag in delta.delTags:
+			tagId = self.tagIds.get(tag)
+			if tagId is not None:
+				self.__dropTag(tagId)
+
+		for element in delta.newElements:
+			self.internElement(element)
+
+		for tag in delta.newTags:
+			self.internTag(tag)
+
+		added = {}
+		for element, tag in delta.added:
+			elementId = self.internElement(element)
+			tagId = self.internTag(tag)
+			tagIds = self.e2t[elementId]
+			if tagId not in tagIds:
+				tagIds.add(tagId)
+				added.setdefault(tagId, []).append(elementId)
+
+		for tagId, elementIds in added.items():
+			self.postings[tagId] |= Bitmap(elementIds)
+			self.tagCounts[tagId] += len(elementIds)
+
+		for element, attrs in delta.attrs.items():
+			elementId = self.elementIds.get(element)
+			if elementId is None:
+				continue
+			if attrs is None:
+				self.__dropAttrs(elementId)
+			else:
+				self.attrs[elementId] = attrs
+
+class ElementSet:
+	"""
+	Set of elements of a L{TagIndex}, kept as a L{Bitmap} of element ids
+
+	Supports the operations of python sets used by L{Tagging}. Operations with other
+	element sets of the same index work on the bitmaps only. In place operations never
+	change the bitmap they started with, so element sets can share the posting lists
+	of the index.
+	"""
+
+	def __init__(self, index, bitmap):
+		self.index = index
+		self.bitmap = bitmap
+
+	def __repr__(self):
+		return 'ElementSet(%s)' % list(self)
+
+	def __ids(self, other):
+		if isinstance(other, ElementSet):
+			return other.bitmap
+		ids = self.index.elementIds
+		return Bitmap([ids[e] for e in other if e in ids])
+
+	def __len__(self):
+		return len(self.bitmap)
+
+	def __nonzero__(self):
+		return bool(self.bitmap)
+
+	def __iter__(self):
+		return imap(self.index.elements.__getitem__, self.bitmap)
+
+	def __contains__(self, element):
+		id = self.index.elementIds.get(element)
+		return id is not None and id in self.bitmap
+
+	def __and__(self, other):
+		return ElementSet(self.index, self.bitmap & self.__ids(other))
+
+	def __or__(self, other):
+		return ElementSet(self.index, self.bitmap | self.__ids(other))
+
+	def __sub__(self, other):
+		return ElementSet(self.index, self.bitmap - self.__ids(other))
+
+	def __eq__(self, other):
+		return self.bitmap == self.__ids(other)
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __le__(self, other):
+		return self.bitmap.isSubset(self.__ids(other))
+
+	def __lt__(self, other):
+		ids = self.__ids(other)
+		return len(self.bitmap) < len(ids) and self.bitmap.isSubset(ids)
+
+	def __ge__(self, other):
+		return self.__ids(other).isSubset(self.bitmap)
+
+	def __gt__(self, other):
+		ids = self.__ids(other)
+		return len(ids) < len(self.bitmap) and ids.isSubset(self.bitmap)
+
+	def copy(self):
+		return ElementSet(self.index, self.bitmap.copy())
+
+	def clear(self):
+		self.bitmap = Bitmap()
+
+	def intersection_update(self, other):
+		self.bitmap = self.bitmap & self.__ids(other)
+
+	def difference_update(self, other):
+		self.bitmap = self.bitmap - self.__ids(other)
+
+	def update(self, other):
+		self.bitmap = self.bitmap | self.__ids(other)
+
+	def __iand__(self, other):
+		self.intersection_update(other)
+		return self
+
+	def __isub__(self, other):
+		self.difference_update(other)
+		return self
+
+	def __ior__(self, other):
+		self.update(other)
+		return self
+
+	def andCardinality(self, other):
+		"""
+		E.andCardinality(other) -> len(E & other) without building the intersection
+		"""
+		return self.bitmap.andCardinality(self.__ids(other))
+
+class IndexTagView(TagView):
+	"""
+	L{TagView} over a L{TagIndex}. Sets of elements are returned as L{ElementSet} objects.
+	"""
+
+	def __init__(self, index):
+		self.index = index
+
+	def __tagNames(self, tagIds):
+		tags = self.index.tags
+		return set([tags[id] for id in tagIds])
+
+	def getElementsOf(self, tag):
+		tagId = self.index.tagIds.get(tag)
+		if tagId is None:
+			return ElementSet(self.index, Bitmap())
+		return ElementSet(self.index, self.index.postings[tagId])
+
+	def getTagsOf(self, element):
+		elementId = self.index.elementIds.get(element)
+		if elementId is None:
+			return set([])
+		return self.__tagNames(self.index.e2t[elementId])
+
+	def hasTag(self, tag):
+		return tag in self.index.tagIds
+
+	def hasElement(self, element):
+		return element in self.index.elementIds
+
+	def getAllTags(self):
+		return self.index.tagIds.keys()
+
+	def getAllElements(self):
+		return ElementSet(self.index, self.index.live.copy())
+
+	def getAttrs(self, element):
+		elementId = self.index.elementIds.get(element)
+		if elementId is None:
+			return None
+		return self.index.attrs.get(elementId)
+
+	def getTagCount(self, tag):
+		tagId = self.index.tagIds.get(tag)
+		if tagId is None:
+			return 0
+		return self.index.tagCounts[tagId]
+
+	def getOverlapCount(self, tag, elements):
+		return self.getElementsOf(tag).andCardinality(elements)
+
+	def intersect(self, tagList):
+		# Posting lists are read only when they are intersected, so an empty
+		# intersection stops before the posting lists of the larger tags are loaded.
+		# Bitmaps choose between merging and probing for every pair of containers.
+		plan = self.planIntersection(tagList)
+		if plan[0][0] == 0:
+			return ElementSet(self.index, Bitmap())
+
+		tagIds = self.index.tagIds
+		postings = self.index.postings
+		bitmap = postings[tagIds[plan[0][1]]]
+		for count, tag in plan[1:]:
+			bitmap = bitmap & postings[tagIds[tag]]
+			if not bitmap:
+				break
+
+		return ElementSet(self.index, bitmap)
+
+	def getTagsForElements(self, elements):
+		if isinstance(elements, ElementSet):
+			# For large sets it is cheaper to look for the tags whose posting lists
+			# intersect the set than to collect the tags of every element
+			if len(elements) > len(self.index.tagIds):
+				postings = self.index.postings
+				return set([tag for tag, id in self.index.tagIds.iteritems()
+						if postings[id].intersects(elements.bitmap)])
+			elementIds = elements.bitmap
+		else:
+			elementIds = [self.index.elementIds[e] for e in elements if e in self.index.elementIds]
+
+		tagIds = set([])
+		e2t = self.index.e2t
+		for id in elementIds:
+			tagIds.update(e2t[id])
+
+		return self.__tagNames(tagIds)
+
+	def getTagCounts(self, elements):
+		tags = self.index.tags
+		if isinstance(elements, ElementSet):
+			# Same choice as in getTagsForElements
+			if len(elements) > len(self.index.tagIds):
+				postings = self.index.postings
+				tagIds = self.index.tagIds.items()
+				n = elements.bitmap.andCardinalities([postings[id] for tag, id in tagIds])
+				return dict([(tag, count) for (tag, id), count in zip(tagIds, n) if count])
+			elementIds = elements.bitmap
+		else:
+			elementIds = [self.index.elementIds[e] for e in elements if e in self.index.elementIds]
+
+		counts = {}
+		get = counts.get
+		e2t = self.index.e2t
+		for id in elementIds:
+			for tagId in e2t[id]:
+				counts[tagId] = get(tagId, 0) + 1
+
+		return dict([(tags[id], n) for id, n in counts.iteritems()])
+
+	def getE2T(self):
+		elements = self.index.elements
+		return dict([(elements[id], self.__tagNames(tagIds)) for id, tagIds in self.index.e2t.items()])
+
+	def getT2E(self):
+		elements = self.index.elements
+		tags = self.index.tags
+		return dict([(tags[id], set([elements[e] for e in posting]))
+				for id, posting in self.index.postings.items()])
+
+def test():
+	import random
+	from dhtfs.Tagging import TagDelta
+
+	print "Running tests ..."
+	random.seed(0)
+
+	# The same changes are applied to the index and to a dictionary of sets
+	index = TagIndex()
+	view = IndexTagView(index)
+	e2t = {}
+	tags = set()
+	attrs = {}
+
+	def apply(delta):
+		index.applyDelta(delta)
+		for e, t in delta.removed:
+			if e in e2t:
+				e2t[e].discard(t)
+		for e in delta.delElements:
+			if e in e2t:
+				del e2t[e]
+				attrs.pop(e, None)
+		for t in delta.delTags:
+			tags.discard(t)
+			for ts in e2t.values():
+				ts.discard(t)
+		for e in delta.newElements:
+			e2t.setdefault(e, set())
+		tags.update(delta.newTags)
+		for e, t in delta.added:
+			e2t.setdefault(e, set()).add(t)
+			tags.add(t)
+		for e, a in delta.attrs.items():
+			if e in e2t:
+				if a is None:
+					attrs.pop(e, None)
+				else:
+					attrs[e] = a
+
+	def elementsOf(t):
+		return set([e for e, ts in e2t.items() if t in ts])
+
+	def check():
+		allTags = ['t%d' % i for i in range(30)]
+		if set(view.getAllTags()) != tags or set(view.getAllElements()) != set(e2t):
+			return False
+		for t in allTags:
+			if view.hasTag(t) != (t in tags) or set(view.getElementsOf(t)) != elementsOf(t):
+				return False
+			if view.getTagCount(t) != len(elementsOf(t)):
+				return False
+		for e in ['e%d' % i for i in range(300)]:
+			if view.hasElement(e) != (e in e2t) or view.getTagsOf(e) != e2t.get(e, set()):
+				return False
+			if view.getAttrs(e) != attrs.get(e):
+				return False
+		for i in range(20):
+			tagList = random.sample(allTags, random.randint(1, 3))
+			expected = set(e2t)
+			for t in tagList:
+				expected &= elementsOf(t)
+			result = view.intersect(tagList)
+			if set(result) != expected or len(result) != len(expected):
+				return False
+			if view.getOverlapCount(allTags[i], result) != len(expected & elementsOf(allTags[i])):
+				return False
+			for elements in [result, list(expected), view.getAllElements()]:
+				elements = set(elements)
+				counts = {}
+				for e in elements:
+					for t in e2t[e]:
+						counts[t] = counts.get(t, 0) + 1
+				if view.getTagsForElements(elements) != set(counts):
+					return False
+				if view.getTagCounts(elements) != counts:
+					return False
+				elements = ElementSet(index, Bitmap([index.elementIds[e] for e in elements]))
+				if view.getTagsForElements(elements) != set(counts):
+					return False
+				if view.getTagCounts(elements) != counts:
+					return False
+		ids = set(index.elementIds.values())
+		return index.live == Bitmap(ids) and len(ids) == len(e2t) and \
+				len([e for e in index.elements if e is not None]) == len(e2t)
+
+	# Test 1
+	ok = True
+	for i in range(200):
+		delta = TagDelta()
+		for j in range(random.randint(0, 40)):
+			delta.added.add(('e%d' % random.randint(0, 299), 't%d' % random.randint(0, 29)))
+		for j in range(random.randint(0, 20)):
+			delta.removed.add(('e%d' % random.randint(0, 299), 't%d' % random.randint(0, 29)))
+		if i % 5 == 0:
+			delta.delElements.update(['e%d' % random.randint(0, 299) for j in range(5)])
+			delta.newElements.add('e%d' % random.randint(0, 299))
+		if i % 17 == 0:
+			delta.delTags.add('t%d' % random.randint(0, 29))
+			delta.newTags.add('t%d' % random.randint(0, 29))
+		for j in range(random.randint(0, 3)):
+			delta.attrs['e%d' % random.randint(0, 299)] = random.choice([None, (i, j)])
+		apply(delta)
+		if i % 20 == 0:
+			ok = ok and check()
+	ok = ok and check()
+	if ok:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test 2
+	# Element sets behave like python sets and never change the posting lists
+	ok = True
+	postings = dict([(id, b.copy()) for id, b in index.postings.items()])
+	for i in range(50):
+		t1, t2 = random.sample(['t%d' % j for j in range(30)], 2)
+		a, b = view.getElementsOf(t1), view.getElementsOf(t2)
+		s1, s2 = elementsOf(t1), elementsOf(t2)
+		ok = ok and set(a & b) == s1 & s2 and set(a | b) == s1 | s2 and set(a - b) == s1 - s2
+		ok = ok and set(a & s2) == s1 & s2 and set(a - s2) == s1 - s2
+		ok = ok and a.andCardinality(b) == len(s1 & s2)
+		ok = ok and (a <= b) == (s1 <= s2) and (a < b) == (s1 < s2) and \
+				(a >= b) == (s1 >= s2) and (a > b) == (s1 > s2) and (a == s1) and not (a != s1)
+		c = a.copy()
+		c &= b
+		c |= a
+		c -= b
+		ok = ok and set(c) == s1 - s2
+		a.intersection_update(b)
+		a.update(s2)
+		a.difference_update(s1)
+		ok = ok and set(a) == s2 - s1
+		a.clear()
+		ok = ok and not a and len(a) == 0
+	ok = ok and postings == index.postings
+	if ok:
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+if __name__ == "__main__":
+	test()
@@ -0,0 +1,513 @@
+# Copyright (c) 2006, Mayuresh Phadke
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+#         * Redistributions of source code must retain the above copyright
+#           notice, this list of conditions and the following disclaimer.
+#         * Redistributions in binary form must reproduce the above copyright
+#           notice, this list of conditions and the following disclaimer in the
+# 	    documentation and/or other materials provided with the distribution.
+#         * Neither the name of 'QualEx Systems' nor the names of its
+# 	    contributors may be used to endorse or promote products derived from
+# 	    this software without specific prior written permission.
+# 
+#         THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import heapq
+import cPickle
+import cStringIO
+from dhtfs.GPStor import GPStor
+
+def elementKey(element):
+	"""
+	elementKey(element) -> String identifying the element in stores which keep elements on disk
+
+	Equal elements are pickled to the same string, so the memo of the pickler is not used.
+	"""
+	f = cStringIO.StringIO()
+	p = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+	p.fast = 1
+	p.dump(element)
+	return f.getvalue()
+
+class TagView:
+	"""
+	Read access to the tag database kept by a L{TagStore}
+
+	A view is obtained from L{TagStore.getView} or L{TagStore.getViewRW} and is meant to be
+	used for the duration of a single operation.
+
+	Subclasses have to implement the primitive functions L{getElementsOf}, L{getTagsOf},
+	L{hasTag}, L{hasElement}, L{getAllTags} and L{getAllElements}. The other functions have
+	default implementations in terms of the primitives which may be overridden by stores that
+	can do better.
+
+	Sets returned by L{getElementsOf} and L{getTagsOf} belong to the store and must not be
+	changed. All other functions return new objects.
+	"""
+
+	# L{intersect} looks up the tags of the elements found so far instead of reading the
+	# posting list of the next tag when the posting list is this many times larger.
+	# None if reading posting lists is never more expensive than looking up elements.
+	PROBE_RATIO = None
+
+	def getElementsOf(self, tag):
+		"""
+		V.getElementsOf(tag) -> Set of elements associated with tag. Empty if tag does not exist.
+		"""
+		raise NotImplementedError
+
+	def getTagsOf(self, element):
+		"""
+		V.getTagsOf(element) -> Set of tags associated with element. Empty if element does not exist.
+		"""
+		raise NotImplementedError
+
+	def hasTag(self, tag):
+		"""
+		V.hasTag(tag) -> True if tag exists
+		"""
+		raise NotImplementedError
+
+	def hasElement(self, element):
+		"""
+		V.hasElement(element) -> True if element exists
+		"""
+		raise NotImplementedError
+
+	def getAllTags(self):
+		"""
+		V.getAllTags() -> List of all tags
+		"""
+		raise NotImplementedError
+
+	def getAllElements(self):
+		"""
+		V.getAllElements() -> Set of all elements
+		"""
+		raise NotImplementedError
+
+	def getTagCount(self, tag):
+		"""
+		V.getTagCount(tag) -> Number of elements associated with tag
+		"""
+		return len(self.getElementsOf(tag))
+
+	def getOverlapCount(self, tag, elements):
+		"""
+		V.getOverlapCount(tag, elements) -> Number of the given elements associated with tag
+
+		@param elements: Set of elements as returned by the view
+		"""
+		return len(self.getElementsOf(tag) & elements)
+
+	def planIntersection(self, tagList):
+		"""
+		V.planIntersection(tagList) -> List of (count, tag) in the order in which the tags are intersected
+
+		Tags are ordered by the number of their elements, smallest first, so that the cost of
+		an intersection is bound by the size of its rarest tag. Duplicate tags are dropped.
+		The intersection is empty if the first count is zero.
+
+		@param tagList: Non empty list of tags
+		@type tagList: List
+		"""
+		plan = [(self.getTagCount(tag), tag) for tag in set(tagList)]
+		plan.sort()
+		return plan
+
+	def intersect(self, tagList):
+		"""
+		V.intersect(tagList) -> Set of elements associated with all the tags in tagList
+
+		The tags are intersected in the order of L{planIntersection}, stopping as soon as
+		the intersection is empty.
+
+		@param tagList: Non empty list of tags
+		@type tagList: List
+		"""
+		plan = self.planIntersection(tagList)
+		if plan[0][0] == 0:
+			return set([])
+		if len(plan) == 1:
+			return set(self.getElementsOf(plan[0][1]))
+
+		# Every step builds a new set, so the elements of the rarest tag are not copied
+		# before the first intersection
+		s1 = self.getElementsOf(plan[0][1])
+		for count, tag in plan[1:]:
+			if self.PROBE_RATIO is not None and count > len(s1) * self.PROBE_RATIO:
+				s1 = set([e for e in s1 if tag in self.getTagsOf(e)])
+			else:
+				s1 = s1 & self.getElementsOf(tag)
+			if not s1:
+				break
+
+		return s1
+
+	def refine(self, elements, tag):
+		"""
+		V.refine(elements, tag) -> Set of the given elements which are associated with tag
+
+		Extends an intersection by one more tag without changing it.
+
+		@param elements: Set of elements as returned by the view
+		"""
+		return elements & self.getElementsOf(tag)
+
+	def exclude(self, elements, tags):
+		"""
+		V.exclude(elements, tags) -> Set of the given elements which are associated with none of the tags
+
+		@param elements: Set of elements as returned by the view
+		@param tags: Tags to exclude
+		@type tags: List
+		"""
+		remaining = elements.copy()
+		for tag in tags:
+			if not remaining:
+				break
+			remaining.difference_update(self.getElementsOf(tag))
+
+		return remaining
+
+	def getTagsForElements(self, elements):
+		"""
+		V.getTagsForElements(elements) -> Set of tags associated with any of the elements
+		"""
+		s1 = set([])
+		for element in elements:
+			s1.update(self.getTagsOf(element))
+
+		return s1
+
+	def getTagCounts(self, elements):
+		"""
+		V.getTagCounts(elements) -> Dictionary which maps the tags of the elements to the number of elements they are associated with
+
+		The tags are counted in a single pass over the tags of the elements.
+
+		@param elements: Set of elements as returned by the view
+		"""
+		counts = {}
+		get = counts.get
+		for element in elements:
+			for tag in self.getTagsOf(element):
+				counts[tag] = get(tag, 0) + 1
+
+		return counts
+
+	def getCover(self, tags, elements, limit=None):
+		"""
+		V.getCover(tags, elements, limit) -> (cover, uncovered)
+
+		Choose tags which between them cover the elements, greedily taking the tag which
+		covers most of the elements not covered so far. The number of newly covered elements
+		of a tag only shrinks as tags are chosen, so it is kept in a heap and recomputed only
+		when the tag comes to the top (lazy greedy).
+
+		@param tags: Tags to choose from
+		@type tags: List
+
+		@param elements: Set of elements as returned by the view
+		@param limit: Maximum number of tags in the cover, None for no limit
+		@type limit: int
+
+		@return: The chosen tags in the order they were chosen and the set of elements
+			not covered by them
+		"""
+		uncovered = elements.copy()
+
+		# Only the elements to be covered are counted, so that the cover does not depend
+		# on elements outside of them
+		heap = [(-self.getOverlapCount(tag, uncovered), tag) for tag in tags]
+		heapq.heapify(heap)
+
+		cover = []
+		while heap and uncovered and (limit is None or len(cover) < limit):
+			bound, tag = heapq.heappop(heap)
+			gain = self.getOverlapCount(tag, uncovered)
+			if gain == 0:
+				continue
+			if heap and gain < -heap[0][0]:
+				heapq.heappush(heap, (-gain, tag))
+				continue
+
+			cover.append(tag)
+			uncovered.difference_update(self.getElementsOf(tag))
+
+		return cover, uncovered
+
+	def getAttrs(self, element):
+		"""
+		V.getAttrs(element) -> Attributes kept with the element, None if there are none
+		"""
+		return None
+
+	def getE2T(self):
+		"""
+		V.getE2T() -> Dictionary which maps elements to sets of tags
+		"""
+		return dict([(e, set(self.getTagsOf(e))) for e in self.getAllElements()])
+
+	def getT2E(self):
+		"""
+		V.getT2E() -> Dictionary which maps tags to sets of elements
+		"""
+		return dict([(t, set(self.getElementsOf(t))) for t in self.getAllTags()])
+
+class TagStore:
+	"""
+	Interface for the storage backends used by L{Tagging}
+
+	A store keeps the associations between elements and tags. Data is read through a
+	L{TagView}. Changes are made in a transaction which is started with L{getViewRW},
+	receives any number of L{TagDelta<dhtfs.Tagging.TagDelta>} objects through
+	L{applyDelta} and ends with L{commit}. Changes are visible to the view of the
+	transaction as soon as they are applied.
+
+	All functions returning error codes use the error codes of L{GPStor}.
+	"""
+
+	def checkSetup(cls, db_path, db_file):
+		"""
+		S.checkSetup(db_path, db_file) -> True if the store is set up at the given location
+		"""
+		raise NotImplementedError
+
+	checkSetup = classmethod(checkSetup)
+
+	def getFiles(cls, db_path, db_file):
+		"""
+		S.getFiles(db_path, db_file) -> List of paths of the files which may be used by the store
+		"""
+		raise NotImplementedError
+
+	getFiles = classmethod(getFiles)
+
+	def getIncompleteCommits(cls, db_path, db_file):
+		"""
+		S.getIncompleteCommits(db_path, db_file) -> List of the commits which were interrupted
+		after they were written to only a part of the database
+
+		Every commit is given as the list of the names of the files it was written to.
+		Stores which write a commit to a single file have no incomplete commits.
+		"""
+		return []
+
+	getIncompleteCommits = classmethod(getIncompleteCommits)
+
+	def initDB(self):
+		"""
+		S.initDB() -> Create an empty database, replacing any existing one
+		"""
+		raise NotImplementedError
+
+	def getView(self):
+		"""
+		S.getView() -> (errorcode, L{TagView})
+		"""
+		raise NotImplementedError
+
+	def getViewRW(self):
+		"""
+		S.getViewRW() -> (errorcode, L{TagView})
+
+		Start a transaction. Other writers wait until the transaction is committed.
+		"""
+		raise NotImplementedError
+
+	def applyDelta(self, delta):
+		"""
+		S.applyDelta(delta) -> Apply a change to the current transaction
+		"""
+		raise NotImplementedError
+
+	def commit(self):
+		"""
+		S.commit() -> errorcode
+
+		Make the changes of the current transaction persistent and end it.
+		"""
+		raise NotImplementedError
+
+	def sync(self):
+		"""
+		S.sync() -> Make committed changes durable which are still waiting for their commit window
+		"""
+		pass
+
+	def getCommitStats(self):
+		"""
+		S.getCommitStats() -> (commits, mutations, seconds)
+
+		Number of durable writes, number of changes written by them and the number of
+		seconds since the store was opened. See L{GPStor.getCommitStats}.
+		"""
+		raise NotImplementedError
+
+	def getVersion(self):
+		"""
+		S.getVersion() -> Version of the data seen by the last view, None if it is not known
+
+		The version changes whenever the data changes. It is only compared for equality.
+		"""
+		return None
+
+class DictTagView(TagView):
+	"""
+	L{TagView} over a tag dictionary in the format described in L{Tagging}
+	"""
+
+	def __init__(self, tagDict):
+		self.tagDict = tagDict
+
+	def getElementsOf(self, tag):
+		return self.tagDict['t2e'].get(tag, set([]))
+
+	def getTagsOf(self, element):
+		return self.tagDict['e2t'].get(element, set([]))
+
+	def hasTag(self, tag):
+		return tag in self.tagDict['t2e']
+
+	def hasElement(self, element):
+		return element in self.tagDict['e2t']
+
+	def getAllTags(self):
+		return self.tagDict['t2e'].keys()
+
+	def getAllElements(self):
+		return set(self.tagDict['e2t'].keys())
+
+	def getAttrs(self, element):
+		# Databases created before attributes were kept have no 'e2a'
+		return self.tagDict.get('e2a', {}).get(element)
+
+	def getE2T(self):
+		return self.tagDict['e2t'].copy()
+
+	def getT2E(self):
+		return self.tagDict['t2e'].copy()
+
+class PickleTagStore(TagStore):
+	"""
+	L{TagStore} keeping the whole tag dictionary in a L{GPStor}
+
+	Subclasses may keep the data in a different format by overriding L{createData},
+	L{createView} and L{createFormat}. The data object has to support the deltas passed
+	to L{applyDelta}.
+	"""
+
+	# Suffix added to the name of the database file
+	SUFFIX = ''
+
+	def checkSetup(cls, db_path, db_file):
+		return GPStor.checkSetup(db_path=db_path, db_file=db_file + cls.SUFFIX)
+
+	checkSetup = classmethod(checkSetup)
+
+	def getFiles(cls, db_path, db_file):
+		path = os.path.join(db_path, db_file + cls.SUFFIX)
+		return [path, path + '.lock', path + GPStor.JOURNAL_SUFFIX]
+
+	getFiles = classmethod(getFiles)
+
+	def __init__(self, db_path, db_file, journal=False, commitWindow=0, watch=False):
+		"""
+		@param journal: Log changes in a journal instead of rewriting the store. See L{GPStor}.
+		@type journal: bool
+
+		@param commitWindow: Time in seconds during which journaled changes share a single
+			durable write. See L{GPStor}.
+		@type commitWindow: float
+
+		@param watch: Learn about changes of the store through inotify. See L{GPStor}.
+		@type watch: bool
+		"""
+		self.tagDB = GPStor(db_path=db_path, db_file=db_file + self.SUFFIX, journal=journal,
+				storeFormat=self.createFormat(), commitWindow=commitWindow, watch=watch)
+		self.tagDict = None
+		self.pending = None
+
+	def __repr__(self):
+		return repr(self.tagDB)
+
+	def createData(self):
+		"""
+		S.createData() -> Data stored in an empty database
+		"""
+		return { 'e2t' : {}, 't2e' : {}, 'e2a' : {} }
+
+	def createView(self, data):
+		"""
+		S.createView(data) -> L{TagView} over the stored data
+		"""
+		return DictTagView(data)
+
+	def createFormat(self):
+		"""
+		S.createFormat() -> Format in which L{GPStor} writes the data, None for a pickle
+		"""
+		return None
+
+	def initDB(self):
+		self.tagDB.getDataRW()
+		self.tagDB.writeData(self.createData())
+
+	def getView(self):
+		err, tagDict = self.tagDB.getDataRO()
+		if err != GPStor.GPS_ERR_SUCCESS:
+			return err, None
+
+		return err, self.createView(tagDict)
+
+	def getViewRW(self):
+		err, self.tagDict = self.tagDB.getDataRW()
+		if err != GPStor.GPS_ERR_SUCCESS:
+			self.tagDB.release()
+			return err, None
+
+		self.pending = None
+		return err, self.createView(self.tagDict)
+
+	def applyDelta(self, delta):
+		# Keep the in memory dictionary current for the rest of the transaction. The merged
+		# delta has the effect of applying the deltas one after another, so GPStor applying
+		# it again to this dictionary on commit leaves the dictionary unchanged.
+		delta.apply(self.tagDict)
+		if self.pending is None:
+			self.pending = delta
+		else:
+			self.pending.merge(delta)
+
+	def commit(self):
+		pending, self.pending = self.pending, None
+		self.tagDict = None
+
+		if pending is None or pending.isEmpty():
+			return self.tagDB.release()
+
+		return self.tagDB.writeDelta(pending)
+
+	def sync(self):
+		self.tagDB.sync()
+
+	def getCommitStats(self):
+		return self.tagDB.getCommitStats()
+
+	def getVersion(self):
+		return self.tagDB.getVersion()
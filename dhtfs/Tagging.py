@@ -26,7 +26,285 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from dhtfs.GPStor import GPStor
+from dhtfs.TagStore import PickleTagStore, elementKey
+from dhtfs.SQLiteTagStore import SQLiteTagStore
+from dhtfs.IndexFile import IndexTagStore
+from dhtfs.ShardedTagStore import ShardedTagStore
+from dhtfs.QueryCache import QueryCache, PrefixCache
+from dhtfs.MaterializedView import MaterializedViews
+from dhtfs.RWLock import RWLock, NullLock, readLocked, writeLocked, synchronized
 import os
+import threading
+import bisect
+
+class TagDelta:
+	"""
+	Compact description of a change to the tag dictionary of L{Tagging}
+
+	Mutations of L{Tagging} are expressed as deltas and only the delta is passed to the
+	storage layer, so that stores, replicas and caches can apply the change without
+	looking at the whole dictionary.
+
+	A delta consists of ::
+		added		- set of (element, tag) pairs which are associated
+		removed		- set of (element, tag) pairs which are no longer associated
+		newElements	- elements which are added without any tags
+		newTags		- tags which are added without any elements
+		delElements	- elements which are removed from the element to tag mapping
+		delTags		- tags which are removed from the tag to element mapping
+		attrs		- dictionary mapping elements to their new attributes, None
+				  if the attributes of the element are dropped
+
+	Removals are applied before additions. The attributes of removed elements are dropped.
+	"""
+
+	def __init__(self):
+		self.added = set()
+		self.removed = set()
+		self.newElements = set()
+		self.newTags = set()
+		self.delElements = set()
+		self.delTags = set()
+		self.attrs = {}
+
+	def __repr__(self):
+		return '<TagDelta added=%s removed=%s newElements=%s newTags=%s delElements=%s delTags=%s attrs=%s>' % \
+			(self.added, self.removed, self.newElements, self.newTags, self.delElements, self.delTags,
+			 self.attrs)
+
+	def isEmpty(self):
+		"""
+		D.isEmpty() -> True if the delta does not change anything
+		"""
+		return not (self.added or self.removed or self.newElements or self.newTags or
+				self.delElements or self.delTags or self.attrs)
+
+	def changesTags(self):
+		"""
+		D.changesTags() -> True if the delta changes more than the attributes of elements
+		"""
+		return bool(self.added or self.removed or self.newElements or self.newTags or
+				self.delElements or self.delTags)
+
+	def getTags(self):
+		"""
+		D.getTags() -> Set of tags touched by this delta
+		"""
+		tags = set([t for (e, t) in self.added])
+		tags.update([t for (e, t) in self.removed])
+		tags.update(self.newTags)
+		tags.update(self.delTags)
+		return tags
+
+	def getElements(self):
+		"""
+		D.getElements() -> Set of elements touched by this delta
+		"""
+		elements = set([e for (e, t) in self.added])
+		elements.update([e for (e, t) in self.removed])
+		elements.update(self.newElements)
+		elements.update(self.delElements)
+		return elements
+
+	def merge(self, delta):
+		"""
+		D.merge(delta) -> Extend this delta with a delta describing a later change
+
+		@param delta: Delta to be applied after this one
+		@type delta: L{TagDelta}
+		"""
+		# A pair which is dropped again only cancels the association, the element and
+		# the tag created by adding it still exist unless they are deleted as well
+		cancelled = self.added & delta.removed
+		if delta.delElements:
+			cancelled.update([(e, t) for (e, t) in self.added if e in delta.delElements])
+		if delta.delTags:
+			cancelled.update([(e, t) for (e, t) in self.added if t in delta.delTags])
+		self.added.difference_update(cancelled)
+		self.newElements.update([e for (e, t) in cancelled])
+		self.newTags.update([t for (e, t) in cancelled])
+
+		self.removed.update(delta.removed)
+
+		if delta.delElements:
+			self.newElements.difference_update(delta.delElements)
+			self.delElements.update(delta.delElements)
+
+		if delta.delTags:
+			self.newTags.difference_update(delta.delTags)
+			self.delTags.update(delta.delTags)
+
+		self.added.update(delta.added)
+		self.newElements.update(delta.newElements)
+		self.newTags.update(delta.newTags)
+
+		for element in delta.delElements:
+			self.attrs.pop(element, None)
+		self.attrs.update(delta.attrs)
+
+	def apply(self, tagDict):
+		"""
+		D.apply(tagDict) -> Apply the change to a tag dictionary in place
+
+		@param tagDict: Dictionary in the format described in L{Tagging}, or an object
+			with an applyDelta(delta) method keeping the data in a different format
+		@type tagDict: dict
+		"""
+		if not isinstance(tagDict, dict):
+			tagDict.applyDelta(self)
+			return
+
+		e2t = tagDict['e2t']
+		t2e = tagDict['t2e']
+
+		for element, tag in self.removed:
+			try:
+				e2t[element].discard(tag)
+			except KeyError:
+				pass
+			try:
+				t2e[tag].discard(element)
+			except KeyError:
+				pass
+
+		for element in self.delElements:
+			e2t.pop(element, None)
+
+		for tag in self.delTags:
+			t2e.pop(tag, None)
+
+		for element in self.newElements:
+			e2t.setdefault(element, set([]))
+
+		for tag in self.newTags:
+			t2e.setdefault(tag, set([]))
+
+		for element, tag in self.added:
+			e2t.setdefault(element, set([])).add(tag)
+			t2e.setdefault(tag, set([])).add(element)
+
+		if self.delElements or self.attrs:
+			e2a = tagDict.setdefault('e2a', {})
+			for element in self.delElements:
+				e2a.pop(element, None)
+			for element, attrs in self.attrs.items():
+				if attrs is None:
+					e2a.pop(element, None)
+				else:
+					e2a[element] = attrs
+
+class TagNameIndex:
+	"""
+	Set of the names of all tags, kept up to date by the changes made through L{Tagging}
+
+	The set is read from the database when it is first used and after the database was
+	changed by someone else. See L{Tagging.addIndex}.
+	"""
+
+	def __init__(self):
+		self.tags = None		# set of tags, None if not built
+		self.version = None
+		self.lock = threading.RLock()
+
+	def __repr__(self):
+		if self.tags is None:
+			return '<TagNameIndex not built>'
+		return '<TagNameIndex of %d tags>' % len(self.tags)
+
+	def validate(self, version):
+		if version is None or version != self.version:
+			self.tags = None
+		self.version = version
+
+	validate = synchronized(validate)
+
+	def setVersion(self, version):
+		if version is None:
+			self.validate(version)
+		self.version = version
+
+	setVersion = synchronized(setVersion)
+
+	def applyDelta(self, delta, view):
+		if self.tags is None:
+			return
+
+		for tag in delta.getTags():
+			if view.hasTag(tag):
+				self.tags.add(tag)
+			else:
+				self.tags.discard(tag)
+
+	applyDelta = synchronized(applyDelta)
+
+	def getTags(self, view):
+		"""
+		I.getTags(view) -> Set of all tags, which must not be changed
+		"""
+		if self.version is None:
+			return set(view.getAllTags())
+		if self.tags is None:
+			self.tags = set(view.getAllTags())
+		return self.tags
+
+	getTags = synchronized(getTags)
+
+	def lookup(self, tag, view):
+		"""
+		I.lookup(tag, view) -> True if the tag exists
+		"""
+		if self.tags is None and self.version is None:
+			return view.hasTag(tag)
+		return tag in self.getTags(view)
+
+	lookup = synchronized(lookup)
+
+class ResultIterator:
+	"""
+	Iterator over the result of a query in a stable order, see L{Tagging.iterElements}
+
+	The result is kept as a sorted list of keys and the list of the items they belong to,
+	the whole result is computed before the first item is returned.
+	After items were taken, L{cursor} is the key of the last item taken. An iterator for
+	the same query created with this cursor continues after that item, even if items were
+	added or removed meanwhile.
+	"""
+
+	def __init__(self, entries, limit=None, cursor=None, offset=0):
+		"""
+		@param entries: (sorted list of keys, list of items), which must not be changed
+		@type entries: C{(List, List)}
+
+		@param limit: Maximum number of items returned, None for no limit
+		@type limit: int
+
+		@param cursor: Return the items after the item with this key, None to start
+			with the first item
+		@param offset: Number of items skipped at the start
+		@type offset: int
+		"""
+		self.keys, self.items = entries
+		self.position = offset
+		if cursor is not None:
+			self.position += bisect.bisect_right(self.keys, cursor)
+		self.end = len(self.keys)
+		if limit is not None:
+			self.end = min(self.end, self.position + limit)
+		self.cursor = cursor
+
+	def __repr__(self):
+		return '<ResultIterator at %d of %d items>' % (self.position, len(self.keys))
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		if self.position >= self.end:
+			raise StopIteration
+		i = self.position
+		self.position += 1
+		self.cursor = self.keys[i]
+		return self.items[i]
 
 class Tagging:
 	"""
@@ -34,7 +312,9 @@ class Tagging:
 
 	The dictionary maintains mapping from tags to elements as well as elements to tags
 
-	The class uses persistent store provided by L{GPStor}
+	The class keeps its data in a storage backend implementing L{TagStore<dhtfs.TagStore.TagStore>}.
+	The backends are listed in L{Tagging.BACKENDS}. By default the tag dictionary is kept in
+	a persistent store provided by L{GPStor}.
 
 	The format of the tag dictionary is as follows ::
 		dict = { 
@@ -48,11 +328,75 @@ class Tagging:
 					'tag4': ['element8', 'element3', 'element3', ...],
 					'tag7': ['element9', 'element5', 'element3', ...]
 				},
+			'e2a' :	{
+					'element1': attributes1,
+					'element3': attributes3
+				},
 		}
+
+	The attributes kept with an element in 'e2a' are set with L{setAttrs}. They are
+	not interpreted by the class and are dropped when the element is removed.
 	"""
 
 	DB_FILE = '.tag.db'
 
+	# Available storage backends
+	BACKENDS = {
+		'pickle' : PickleTagStore,
+		'sqlite' : SQLiteTagStore,
+		'index' : IndexTagStore,
+		'sharded' : ShardedTagStore,
+	}
+
+	# Backend used for new databases
+	DEFAULT_BACKEND = 'pickle'
+
+	# Number of query results kept by default
+	QUERY_CACHE_SIZE = 128
+
+	# Default number of intersections of tag paths kept for resolving deeper paths
+	PREFIX_CACHE_SIZE = 256
+
+	# Kinds of the items returned by iterTagsAndElementsForTags, elements come first
+	ELEMENT = 0
+	TAG = 1
+
+	# Default number of materialized views created for frequently listed tag sets
+	MAX_MATERIALIZED_VIEWS = 8
+
+	# Largest list of elements which getElements checks element by element
+	PROBE_ELEMENTS = 32
+
+	def getBackend(cls, db_path=None, db_file=None):
+		"""
+		Get the name of the storage backend used by the Tagging setup in the given directory
+
+		@param db_path:	The path where the Tagging setup is expected.
+				Default is to use the path of the current working directory.
+		@type db_path: string
+
+		@param db_file: The name of the file which is used to store the Tagging database
+				Defaults to L{Tagging.DB_FILE}
+		@type db_file: string
+
+		@rtype: C{str}
+		@return: Name of the backend from L{Tagging.BACKENDS}, None if Tagging is not setup.
+		"""
+
+		if not db_path:
+			db_path = os.getcwd()
+
+		if not db_file:
+			db_file = cls.DB_FILE
+
+		for backend in sorted(cls.BACKENDS.keys()):
+			if cls.BACKENDS[backend].checkSetup(db_path, db_file):
+				return backend
+
+		return None
+
+	getBackend = classmethod(getBackend)
+
 	def checkSetup(cls, db_path=None, db_file=None):
 		"""
 		Check if Tagging is setup in the given directory
@@ -75,10 +419,111 @@ class Tagging:
 		if not db_file:
 			db_file = cls.DB_FILE
 
-		return GPStor.checkSetup(db_path=db_path, db_file=db_file)
+		return cls.getBackend(db_path=db_path, db_file=db_file) is not None
 	
 	checkSetup = classmethod(checkSetup)
 
+	def getIncompleteCommits(cls, db_path=None, db_file=None):
+		"""
+		Find the commits which were written to only a part of the Tagging database
+
+		A process which is killed while it commits a change to a database kept in several
+		files, like the one of the sharded backend, may leave the change in only some of the
+		files. See L{TagStore.getIncompleteCommits<dhtfs.TagStore.TagStore.getIncompleteCommits>}.
+
+		@param db_path:	The path where the Tagging setup is expected.
+				Default is to use the path of the current working directory.
+		@type db_path: string
+
+		@param db_file: The name of the file which is used to store the Tagging database
+				Defaults to L{Tagging.DB_FILE}
+		@type db_file: string
+
+		@rtype: C{list}
+		@return: List of the incomplete commits, each given as the list of the names of
+			the files it was to be written to.
+		"""
+
+		if not db_path:
+			db_path = os.getcwd()
+
+		if not db_file:
+			db_file = cls.DB_FILE
+
+		backend = cls.getBackend(db_path=db_path, db_file=db_file)
+		if backend is None:
+			return []
+
+		return cls.BACKENDS[backend].getIncompleteCommits(db_path, db_file)
+
+	getIncompleteCommits = classmethod(getIncompleteCommits)
+
+	def convertDB(cls, backend, db_path=None, db_file=None):
+		"""
+		Convert the Tagging database in the given directory to a different storage backend
+
+		The database of the old backend is left in place with the suffix '.old'
+		appended to its files.
+
+		@param backend: Name of the new backend from L{Tagging.BACKENDS}
+		@type backend: string
+
+		@param db_path:	The path where the Tagging setup is expected.
+				Default is to use the path of the current working directory.
+		@type db_path: string
+
+		@param db_file: The name of the file which is used to store the Tagging database
+				Defaults to L{Tagging.DB_FILE}
+		@type db_file: string
+
+		@rtype: C{bool}
+		@return: True if the database was converted, False otherwise.
+		"""
+
+		if not db_path:
+			db_path = os.getcwd()
+
+		if not db_file:
+			db_file = cls.DB_FILE
+
+		oldBackend = cls.getBackend(db_path=db_path, db_file=db_file)
+		if oldBackend is None or oldBackend == backend:
+			return False
+
+		err, view = cls.BACKENDS[oldBackend](db_path, db_file).getView()
+		if err != 0:
+			return False
+
+		delta = TagDelta()
+		for element, tags in view.getE2T().items():
+			if len(tags) == 0:
+				delta.newElements.add(element)
+			delta.added.update([(element, tag) for tag in tags])
+			attrs = view.getAttrs(element)
+			if attrs is not None:
+				delta.attrs[element] = attrs
+		for tag, elements in view.getT2E().items():
+			if len(elements) == 0:
+				delta.newTags.add(tag)
+
+		store = cls.BACKENDS[backend](db_path, db_file)
+		store.initDB()
+		err, view = store.getViewRW()
+		if err != 0:
+			return False
+		store.applyDelta(delta)
+		if store.commit() != 0:
+			return False
+
+		# Move the old database out of the way
+		for path in cls.BACKENDS[oldBackend].getFiles(db_path, db_file):
+			if os.path.exists(path):
+				os.rename(path, path + '.old')
+
+		return True
+
+	convertDB = classmethod(convertDB)
+
 	def __str__(self):
 		return 'Tagging API with %s' % str(self.tagDB)
 
@@ -86,26 +531,81 @@ class Tagging:
 		return 'Tagging API with %s' % str(self.tagDB)
 		
 	# Constructor
-	def __init__(self, db_path=os.getcwd(), db_file=DB_FILE, logger=None):
+	def __init__(self, db_path=os.getcwd(), db_file=DB_FILE, logger=None, journal=False, backend=None,
+			commitWindow=0, watch=False, queryCacheSize=QUERY_CACHE_SIZE,
+			maxMaterializedViews=MAX_MATERIALIZED_VIEWS, prefixCacheSize=PREFIX_CACHE_SIZE, threaded=False):
 		"""
 		Tagging() -> object of class Tagging
 
 		@param db_path: Path to database. Defaults to empty string
 		@type db_path: string
+
+		@param journal: Log changes to the database in a journal instead of rewriting it.
+			See L{GPStor}.
+		@type journal: bool
+
+		@param backend: Name of the storage backend from L{Tagging.BACKENDS}. Defaults to the
+			backend of the existing database or L{Tagging.DEFAULT_BACKEND} for new databases.
+		@type backend: string
+
+		@param commitWindow: Time in seconds during which journaled changes are collected and
+			made durable by a single write. See L{GPStor}.
+		@type commitWindow: float
+
+		@param watch: Learn about changes of the database through inotify instead of checking
+			the database files on every read. See L{GPStor}.
+		@type watch: bool
+
+		@param queryCacheSize: Number of results of L{getElements}, L{getTagsForElements} and
+			L{getTagsAndElementsForTags} which are kept until a change makes them invalid.
+			0 disables the cache.
+		@type queryCacheSize: int
+
+		@param maxMaterializedViews: Number of materialized views which are created for tag sets
+			that are listed often, in addition to those added by L{addMaterializedView}.
+			0 disables the promotion of tag sets.
+		@type maxMaterializedViews: int
+
+		@param prefixCacheSize: Number of intersections of lists of tags which are kept, so that
+			the intersection of a list extending a cached list by a few tags takes only a few
+			intersections. 0 disables the cache.
+		@type prefixCacheSize: int
+
+		@param threaded: Allow the instance to be used by several threads. Queries then run
+			concurrently under the read lock of an L{RWLock<dhtfs.RWLock.RWLock>} while
+			changes take its write lock and run one at a time.
+		@type threaded: bool
 		"""
 
 		self.db_path = db_path
 		self.db_file = db_file
+		self.journal = journal
+		self.commitWindow = commitWindow
+		self.watch = watch
 
-		if GPStor.checkSetup(db_path=self.db_path, db_file=self.db_file):
-			self.tagDB = GPStor(db_path=self.db_path, db_file=self.db_file)
+		existingBackend = Tagging.getBackend(db_path=self.db_path, db_file=self.db_file)
+		self.backend = backend or existingBackend or Tagging.DEFAULT_BACKEND
+
+		if existingBackend is not None and existingBackend == self.backend:
+			self.tagDB = self.__createStore()
 		else:
 			self.tagDB = None
 
 		self.useWriteCache = False
-		self.tagDict = {}
+		self.queryCache = QueryCache(queryCacheSize)
+		self.indexes = []
+		self.views = MaterializedViews(maxMaterializedViews)
+		self.addIndex(self.views)
+		self.tagNames = TagNameIndex()
+		self.addIndex(self.tagNames)
+		self.prefixCache = PrefixCache(prefixCacheSize)
 		self.logger = logger
 
+		if threaded:
+			self.rwLock = RWLock()
+		else:
+			self.rwLock = NullLock()
+
 	##### Helper functions
 	
 	def __removeValueFromTag(self, tag):
@@ -119,27 +619,200 @@ class Tagging:
 		(tag, value) = valueTag.split(':', 1)
 		return (tag, value)
 
+	def __createStore(self):
+		return Tagging.BACKENDS[self.backend](self.db_path, self.db_file, journal=self.journal,
+				commitWindow=self.commitWindow, watch=self.watch)
+
+	##### Functions for implementing the query caches and the materialized views
+
+	# Drop cached results and views if the database was changed by someone else
+	def __validate(self, version):
+		self.queryCache.validate(version)
+		self.prefixCache.validate(version)
+		for index in self.indexes:
+			index.validate(version)
+
+	# Get a view for a query which may use the query cache
+	def __getView(self):
+		err, view = self.tagDB.getView()
+		if err == 0:
+			self.__validate(self.tagDB.getVersion())
+		return err, view
+
+	# Commit the current transaction. Results changed by it were already dropped
+	# from the query cache and the views were updated, the others stay valid for the
+	# new version.
+	def __commit(self):
+		self.tagDB.commit()
+		version = self.tagDB.getVersion()
+		self.queryCache.setVersion(version)
+		self.prefixCache.setVersion(version)
+		for index in self.indexes:
+			index.setVersion(version)
+
+	# Intersect the tags in the order of the list, starting with the longest prefix of the
+	# list whose intersection is cached. The result must not be changed.
+	def __intersectPath(self, view, tagList):
+		path = tuple(tagList)
+		length, intersection = self.prefixCache.get(path)
+		if length == 0:
+			if len(path) == 1:
+				intersection = view.intersect(tagList)
+				self.prefixCache.put(path, intersection)
+				return intersection
+
+			# The parent is intersected in the order of the plan and kept for its siblings
+			length = len(path) - 1
+			intersection = view.intersect(tagList[:length])
+			self.prefixCache.put(path[:length], intersection)
+
+		while length < len(path):
+			if not intersection:
+				break
+			intersection = view.refine(intersection, path[length])
+			length += 1
+			self.prefixCache.put(path[:length], intersection)
+
+		return intersection
+
+	def getQueryCacheStats(self):
+		"""
+		T.getQueryCacheStats() -> (hits, misses, invalidations, number of cached results)
+		"""
+		return self.queryCache.getStats()
+
+	def getPrefixCacheStats(self):
+		"""
+		T.getPrefixCacheStats() -> (hits, misses, invalidations, number of cached intersections)
+		"""
+		return self.prefixCache.getStats()
+
+	def addIndex(self, index):
+		"""
+		T.addIndex(index) -> Keep an index derived from the tag database up to date on every change
+
+		The index must have the methods ::
+			validate(version)	- Drop the index if it was built for a different version
+						  of the database, None if the version is not known
+			setVersion(version)	- Keep the index for a version created by changes which
+						  were already applied to it
+			applyDelta(delta, view)	- Update the index for a L{TagDelta} which was applied,
+						  view shows the data after the change
+
+		See L{MaterializedViews<dhtfs.MaterializedView.MaterializedViews>} for an example.
+		"""
+		self.indexes.append(index)
+
+	def lookupIndex(self, index, key):
+		"""
+		T.lookupIndex(index, key) -> Result of index.lookup(key, view) for an index added with L{addIndex}
+
+		The index is validated against the current version of the database first.
+		"""
+		err, view = self.__getView()
+		if err != 0:
+			return []
+		return index.lookup(key, view)
+
+	lookupIndex = readLocked(lookupIndex)
+
+	def addMaterializedView(self, tagList):
+		"""
+		T.addMaterializedView(tagList) -> Keep the listing of the tags up to date on every change
+
+		L{getTagsAndElementsForTags} for the tags is then answered without intersecting the
+		tags. The view is kept until it is removed with L{removeMaterializedView}.
+
+		@param tagList: Non empty list of tags
+		@type tagList: List
+		"""
+		if len(tagList) != 0:
+			self.views.add(frozenset(tagList))
+
+	def removeMaterializedView(self, tagList):
+		"""
+		T.removeMaterializedView(tagList) -> Stop keeping the listing of the tags
+		"""
+		self.views.remove(frozenset(tagList))
+
+	def getMaterializedViews(self):
+		"""
+		T.getMaterializedViews() -> List of the lists of tags which have a materialized view
+		"""
+		return [list(tags) for tags in self.views.getTagSets()]
+
 	##### Functions for implementing write cache
 	
-	def __getTagDictRW(self):
+	def __getViewRW(self):
 		if self.useWriteCache:
-			return 0, self.tagDict
+			return 0, self.writeCacheView
 		else:
-			return self.tagDB.getDataRW()
+			err, view = self.tagDB.getViewRW()
+			if err == 0:
+				self.__validate(self.tagDB.getVersion())
+			return err, view
 	
-	def __writeTagDict(self, tagDict):
-		if self.useWriteCache:
-			self.tagDict = tagDict
+	# Pass the change to the store. Must be called with the view returned by __getViewRW,
+	# which shows the change once it is applied.
+	def __writeTagDelta(self, view, delta):
+		if delta.isEmpty():
+			pass
+		elif not delta.changesTags():
+			# Attributes are not seen by queries, caches and indexes
+			self.tagDB.applyDelta(delta)
 		else:
-			self.tagDB.writeData(tagDict)
+			self.tagDB.applyDelta(delta)
+			tags = delta.getTags()
+			self.queryCache.invalidate(tags, delta.getElements())
+			self.prefixCache.invalidate(tags)
+			for index in self.indexes:
+				index.applyDelta(delta, view)
+
+		if not self.useWriteCache:
+			self.__commit()
 
+	# The write lock is held from setWriteCaching until doneWriteCaching
 	def setWriteCaching(self):
-		self.useWriteCache = True
-		err, self.tagDict = self.tagDB.getDataRW()
+		self.rwLock.acquireWrite()
+		if self.useWriteCache:
+			# Write caching was already started by this thread
+			self.rwLock.releaseWrite()
+			return
+
+		err, self.writeCacheView = self.tagDB.getViewRW()
+		if err == 0:
+			self.useWriteCache = True
+			self.__validate(self.tagDB.getVersion())
+		else:
+			self.rwLock.releaseWrite()
 
 	def doneWriteCaching(self):
-		self.useWriteCache = False	
-		self.tagDB.writeData(self.tagDict)
+		if self.useWriteCache:
+			self.useWriteCache = False	
+			self.writeCacheView = None
+			try:
+				self.__commit()
+			finally:
+				self.rwLock.releaseWrite()
+
+	def sync(self):
+		"""
+		T.sync() -> Make changes durable which are still waiting for their commit window
+		"""
+		if self.tagDB is not None:
+			self.tagDB.sync()
+
+	def getCommitStats(self):
+		"""
+		T.getCommitStats() -> (commits, mutations, seconds)
+
+		@return: Number of durable writes of the database, number of changes written by them and
+			the number of seconds since the database was opened
+		@rtype: C{(int, int, float)}
+		"""
+		if self.tagDB is None:
+			return 0, 0, 0.0
+		return self.tagDB.getCommitStats()
 
 	##### Book keeping operations
 
@@ -151,12 +824,21 @@ class Tagging:
 		@param forceInit: Initialize even if database exists
 		@type forceInit: boolean
 		"""
-		if GPStor.checkSetup(db_path=self.db_path, db_file=self.db_file) and not forceInit:
+		existingBackend = Tagging.getBackend(db_path=self.db_path, db_file=self.db_file)
+		if existingBackend is not None and not forceInit:
 			return
 
-		self.tagDB = GPStor(db_path=self.db_path, db_file=self.db_file)
-		self.tagDB.getDataRW()
-		self.tagDB.writeData({ 'e2t' : {}, 't2e' : {}, 'e2a' : {} })
+		# Remove a database kept by a different backend
+		if existingBackend is not None and existingBackend != self.backend:
+			for path in Tagging.BACKENDS[existingBackend].getFiles(self.db_path, self.db_file):
+				if os.path.exists(path):
+					os.remove(path)
+
+		self.tagDB = self.__createStore()
+		self.tagDB.initDB()
+		self.__validate(None)
+
+	initDB = writeLocked(initDB)
 
 	###### Add, Delete, Rename tags
 
@@ -175,30 +857,16 @@ class Tagging:
 		if len(elementList) == 0 and len(newTagList) == 0:
 			return
 
-		err, tagDict = self.__getTagDictRW()
+		err, view = self.__getViewRW()
 		if err != 0:
 			return
 		
 		# Remove blank tags
 		newTagList = [x for x in newTagList if x != '']
 
-		# Create element to tag mapping
-		for element in elementList:
-			try:
-				tagDict['e2t'][element].update(newTagList)
-			except KeyError:
-				tagDict['e2t'][element] = set(newTagList)
+		self.__writeTagDelta(view, self.__addTagsDelta(view, elementList, newTagList))
 
-		# Create tag to element mapping
-		# Do not store the value part of the tag in the tag to element mapping
-
-		for tag in newTagList:
-			try:
-				tagDict['t2e'][tag].update(elementList)
-			except KeyError:
-				tagDict['t2e'][tag] = set(elementList)
-
-		self.__writeTagDict(tagDict)
+	addTags = writeLocked(addTags)
 	
 	# delete Elements
 	def delElementsFromTags(self, elementList, tagList = []):
@@ -212,35 +880,13 @@ class Tagging:
 		@type tagList: List
 		"""
 
-		err, tagDict = self.__getTagDictRW()
+		err, view = self.__getViewRW()
 		if err != 0:
 			return
 
-		if len(tagList) == 0:
-			for tag in tagDict['t2e'].keys():
-				tagDict['t2e'][tag].difference_update(elementList)
-
-			for element in elementList:
-				try:
-					del tagDict['e2t'][element]
-				except KeyError:
-					pass
-		else:
-			for tag in tagList:
-				try:
-					tagDict['t2e'][tag].difference_update(elementList)
-				except KeyError:
-					pass
-
-			for element in elementList:
-				try:
-					tagDict['e2t'][element].difference_update(tagList)
-					if len(tagDict['e2t'][element]) == 0:
-						del tagDict['e2t'][element]
-				except KeyError:
-					pass
-
-		self.__writeTagDict(tagDict)
+		self.__writeTagDelta(view, self.__delElementsDelta(view, elementList, tagList))
+
+	delElementsFromTags = writeLocked(delElementsFromTags)
 	
 	# delete tags from the DB
 	def delTagsFromElements(self, tagList, elementList = []):
@@ -253,35 +899,13 @@ class Tagging:
 		@param tagList: List of tags to delete from elements.
 		@type tagList: List
 		"""
-		err, tagDict = self.__getTagDictRW()
+		err, view = self.__getViewRW()
 		if err != 0:
 			return
-		
-		if len(elementList) == 0:
-			for element in tagDict['e2t'].keys():
-				tagDict['e2t'][element].difference_update(tagList)
-
-			for tag in tagList:
-				try:
-					del tagDict['t2e'][tag]
-				except KeyError:
-					pass
-		else:
-			for element in elementList:
-				try:
-					tagDict['e2t'][element].difference_update(tagList)
-				except KeyError:
-					pass
-
-			for tag in tagList:
-				try:
-					tagDict['t2e'][tag].difference_update(elementList)
-					if len(tagDict['t2e'][tag]) == 0:
-						del tagDict['t2e'][tag]
-				except KeyError:
-					pass
-
-		self.__writeTagDict(tagDict)
+
+		self.__writeTagDelta(view, self.__delTagsDelta(view, tagList, elementList))
+
+	delTagsFromElements = writeLocked(delTagsFromElements)
 	
 	def renameTag(self, oldTagName, newTagName):
 		"""
@@ -294,10 +918,143 @@ class Tagging:
 		@type newTagName: string
 		"""
 
-		elementList = self.getElements(tagList=[oldTagName])
+		err, view = self.__getViewRW()
+		if err != 0:
+			return
+
+		if oldTagName == newTagName:
+			self.__writeTagDelta(view, TagDelta())
+			return
+
+		elementList = list(view.getElementsOf(oldTagName))
+
+		delta = self.__delTagsDelta(view, [oldTagName], [])
+		delta.merge(self.__addTagsDelta(view, elementList, [newTagName]))
+		self.__writeTagDelta(view, delta)
+
+	renameTag = writeLocked(renameTag)
+
+	##### Attributes of elements
+
+	def setAttrs(self, elementAttrs):
+		"""
+		T.setAttrs(elementAttrs) -> Keep attributes with elements
+
+		The attributes are kept until they are set again or the element is deleted.
+		Attributes of elements which do not exist are ignored. Changing attributes does not
+		change the results of any query.
+
+		@param elementAttrs: Dictionary mapping elements to their attributes. The attributes
+			can be any object which can be pickled, None drops the attributes of an element.
+		@type elementAttrs: dict
+		"""
+		err, view = self.__getViewRW()
+		if err != 0:
+			return
+
+		delta = TagDelta()
+		for element, attrs in elementAttrs.items():
+			if view.hasElement(element) and view.getAttrs(element) != attrs:
+				delta.attrs[element] = attrs
+
+		self.__writeTagDelta(view, delta)
+
+	setAttrs = writeLocked(setAttrs)
+
+	def getAttrs(self, element):
+		"""
+		T.getAttrs(element) -> Attributes kept with the element by L{setAttrs}
+
+		@return: The attributes, None if the element has none
+		"""
+		err, view = self.__getView()
+		if err != 0:
+			return None
+
+		return view.getAttrs(element)
+
+	getAttrs = readLocked(getAttrs)
 
-		self.delTagsFromElements(elementList=[], tagList=[oldTagName])
-		self.addTags(elementList, [newTagName])
+	def getAttrsForElements(self, elements):
+		"""
+		T.getAttrsForElements(elements) -> Attributes kept with the elements by L{setAttrs}
+
+		@return: Dictionary mapping elements to their attributes, elements without
+			attributes are left out
+		@rtype: C{dict}
+		"""
+		err, view = self.__getView()
+		if err != 0:
+			return {}
+
+		result = {}
+		for element in elements:
+			attrs = view.getAttrs(element)
+			if attrs is not None:
+				result[element] = attrs
+		return result
+
+	getAttrsForElements = readLocked(getAttrsForElements)
+
+	##### Functions for computing deltas
+	#
+	# These functions describe a change to the data seen through view without modifying it.
+	# Only the element/tag pairs which actually change are recorded.
+
+	def __addTagsDelta(self, view, elementList, tagList):
+		delta = TagDelta()
+
+		for element in elementList:
+			if view.hasElement(element):
+				tags = view.getTagsOf(element)
+			else:
+				if len(tagList) == 0:
+					delta.newElements.add(element)
+				tags = ()
+			delta.added.update([(element, tag) for tag in tagList if tag not in tags])
+
+		if len(elementList) == 0:
+			delta.newTags.update([tag for tag in tagList if not view.hasTag(tag)])
+
+		return delta
+
+	def __delElementsDelta(self, view, elementList, tagList):
+		delta = TagDelta()
+		tagSet = set(tagList)
+
+		for element in elementList:
+			if not view.hasElement(element):
+				continue
+			tags = view.getTagsOf(element)
+
+			if len(tagSet) == 0:
+				delta.removed.update([(element, tag) for tag in tags])
+				delta.delElements.add(element)
+			else:
+				delta.removed.update([(element, tag) for tag in tags & tagSet])
+				if not (tags - tagSet):
+					delta.delElements.add(element)
+
+		return delta
+
+	def __delTagsDelta(self, view, tagList, elementList):
+		delta = TagDelta()
+		elementSet = set(elementList)
+
+		for tag in tagList:
+			if not view.hasTag(tag):
+				continue
+			elements = view.getElementsOf(tag)
+
+			if len(elementSet) == 0:
+				delta.removed.update([(element, tag) for element in elements])
+				delta.delTags.add(tag)
+			else:
+				delta.removed.update([(element, tag) for element in elements & elementSet])
+				if not (elements - elementSet):
+					delta.delTags.add(tag)
+
+		return delta
 
 	####### Get tagging information
 
@@ -317,11 +1074,13 @@ class Tagging:
 		@rtype: C{dict}
 		"""
 		
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.tagDB.getView()
 		if err != 0:
 			return {}
 
-		return tagDict['e2t'].copy()
+		return view.getE2T()
+
+	getTagsDict = readLocked(getTagsDict)
 			
 	# Get a python dictionary which contains list of elements for each tag
 	def getElementsDict(self):
@@ -338,11 +1097,13 @@ class Tagging:
 		@return: Dictionary of element to tag mapping
 		@rtype: C{dict}
 		"""
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.tagDB.getView()
 		if err != 0:
 			return {}
 
-		return tagDict['t2e'].copy()
+		return view.getT2E()
+
+	getElementsDict = readLocked(getElementsDict)
 
 	# Get all the tags associated with the given elements
 	def getTagsForElements(self, elementList=[], filterList=[], filter=None):
@@ -363,27 +1124,26 @@ class Tagging:
 		@return: List of tags
 		@rtype: C{list}
 		"""
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.__getView()
 		if err != 0:
 			return []
 
 		if len(elementList) == 0:
-			return tagDict['t2e'].keys()
-
-		# Each element is associated with a list of tags
-		# Get an union of all the tags associated with the elements
-		# in the list
-		#
-		# Do not use the value part of the tag
-		#
-		# s1.update Updates a set with the union of itself and another
-		s1 = tagDict['e2t'].get(elementList[0], set([])).copy()
-
-		for element in elementList[1:]:
-			try:
-				s1.update(tagDict['e2t'][element])
-			except KeyError:
-				pass
+			return view.getAllTags()
+
+		# The result only depends on the tags of the elements
+		elementSet = frozenset(elementList)
+		key = ('getTagsForElements', elementSet)
+		tags = self.queryCache.get(key)
+		if tags is None:
+			# Each element is associated with a list of tags
+			# Get an union of all the tags associated with the elements
+			# in the list
+			#
+			# Do not use the value part of the tag
+			tags = view.getTagsForElements(elementList)
+			self.queryCache.put(key, tags, frozenset(), elementSet)
+		s1 = set(tags)
 
 		if filter == 'in':
 			s1.intersection_update(filterList)
@@ -394,7 +1154,9 @@ class Tagging:
 		l = list(s1)
 		return l
 
-	def getTagsForTags(self, tagList=[], beRestrictive=False, getCover=False):
+	getTagsForElements = readLocked(getTagsForElements)
+
+	def getTagsForTags(self, tagList=[], beRestrictive=False, getCover=False, coverLimit=None):
 		"""
 		T.getTagsForTags() -> Get a list of tags associated with the given tags
 
@@ -426,14 +1188,18 @@ class Tagging:
 
 		@type getCover: bool
 
+		@param coverLimit: Maximum number of tags returned with getCover. Elements which are
+			not covered by these tags are returned as elements. Defaults to no limit.
+		@type coverLimit: int
+
 		@return: List of Tags
 		@rtype: C{list}
 		"""
 	
-		retTagList, e = self.getTagsAndElementsForTags(tagList, beRestrictive, getCover)	
+		retTagList, e = self.getTagsAndElementsForTags(tagList, beRestrictive, getCover, coverLimit)
 		return retTagList
 	
-	def getTagsAndElementsForTags(self, tagList=[], beRestrictive=False, getCover=False):
+	def getTagsAndElementsForTags(self, tagList=[], beRestrictive=False, getCover=False, coverLimit=None):
 		"""
 		T.getTagsAndElementsForTags() -> Get a list of tags and elements associated with the given tags
 
@@ -466,58 +1232,79 @@ class Tagging:
 
 		@type getCover: bool
 
+		@param coverLimit: Maximum number of tags returned with getCover. Elements which are
+			not covered by these tags are returned as elements. Defaults to no limit.
+		@type coverLimit: int
+
 		@return: Tuple (List of Tags, List of Elements)
 		@rtype: C{(List, List)}
 		"""
 
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.__getView()
 		if err != 0:
 			return [], []
 
-		if len(tagList) == 0:
-			retTagList = tagDict['t2e'].keys()
-			intersection_set = set(tagDict['e2t'].keys())
+		# The result depends on the tags of the path and on the tags of the selected
+		# elements. The order of the tags in the path does not matter.
+		key = ('getTagsAndElementsForTags', frozenset(tagList), beRestrictive, getCover, coverLimit)
+		result = self.queryCache.get(key)
+		if result is None:
+			result, tags, elements = self.__getTagsAndElementsForTags(view, tagList, beRestrictive,
+					getCover, coverLimit)
+			self.queryCache.put(key, result, tags, elements)
+
+		return list(result[0]), list(result[1])
+
+	getTagsAndElementsForTags = readLocked(getTagsAndElementsForTags)
+
+	# Compute the result of getTagsAndElementsForTags without the query cache. Returns the
+	# result with the tags and elements it depends on, see QueryCache.put.
+	def __getTagsAndElementsForTags(self, view, tagList, beRestrictive, getCover, coverLimit):
+		mv = None
+		if len(tagList) != 0 and not self.useWriteCache:
+			mv = self.views.get(frozenset(tagList), view)
+
+		if mv is not None and not getCover:
+			# The listing is kept by a materialized view
+			return mv.getTagsAndElements(beRestrictive), frozenset(tagList), mv.memberTags
+		elif len(tagList) == 0:
+			retTagList = view.getAllTags()
+			intersection_set = view.getAllElements()
+		elif mv is not None:
+			# Only the elements are needed in the format of the view for the cover
+			intersection_set = self.__intersectPath(view, tagList)
+			retTagList = mv.getTags(False)
+		elif beRestrictive:
+			intersection_set = self.__intersectPath(view, tagList)
+
+			# Tags associated with all the selected elements would not restrict the selection.
+			# All tags of the selection are counted in one pass.
+			intersection_set_len = len(intersection_set)
+			tagSet = set(tagList)
+			retTagList = [x for x, count in view.getTagCounts(intersection_set).iteritems()
+					if count < intersection_set_len and x not in tagSet]
 		else:
-			intersection_set = tagDict['t2e'].get(tagList[0], set([])).copy()
-
-			for tag in tagList[1:]:
-				try:
-					intersection_set.intersection_update(tagDict['t2e'][tag])
-				except KeyError:
-					intersection_set.clear()
-
-			retTagSet = set([])
-			for e in intersection_set:
-				retTagSet.update(tagDict['e2t'][e])
-				
+			intersection_set = self.__intersectPath(view, tagList)
+
+			retTagSet = view.getTagsForElements(intersection_set)
 			retTagSet.difference_update(tagList)
 			retTagList = list(retTagSet)
 
-		if beRestrictive:
-			if len(tagList) != 0:
-				intersection_set_len = len(intersection_set)
-				retTagList = [x for x in retTagList
-						if len(tagDict['t2e'][x] & intersection_set) < intersection_set_len]
-		elif getCover:
-			l = retTagList
-			l.sort(key = lambda x: len(tagDict['t2e'][x]), reverse = True)
-			cover = []
-			while len(l) > 1:
-				biggestSet = l[0]
-				otherSets = l[1:]
-				l = [x for x in otherSets if not tagDict['t2e'][biggestSet] > tagDict['t2e'][x]]
-				cover.append(biggestSet)
-
-			retTagList = cover + l
-
 		remainingElements = intersection_set
 
-		if (getCover or beRestrictive) and len(remainingElements) > 20:
-			for tag in retTagList:
-				remainingElements.difference_update(tagDict['t2e'][tag])
+		if getCover and not beRestrictive:
+			# The cover also tells which elements are left over
+			retTagList, uncovered = view.getCover(retTagList, intersection_set, coverLimit)
+			if len(intersection_set) > 20:
+				remainingElements = uncovered
+		elif beRestrictive and len(remainingElements) > 20:
+			remainingElements = view.exclude(intersection_set, retTagList)
+
+		retElementList = list(remainingElements)
+		if len(tagList) == 0:
+			return (retTagList, retElementList), None, ()
+		return (retTagList, retElementList), frozenset(tagList), intersection_set
 
-		return retTagList, list(remainingElements)
-		
 	# Get tags associated with all the elements
 	def getCommonTags(self, elementList=[]):
 		"""
@@ -531,21 +1318,22 @@ class Tagging:
 		"""
 		if len(elementList) == 0:
 			return []
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.tagDB.getView()
 		if err != 0:
 			return []
 
-		s1 = tagDict['e2t'].get(elementList[0], set([])).copy()
+		s1 = set(view.getTagsOf(elementList[0]))
 
 		for element in elementList[1:]:
-			try:
-				s1.intersection_update(tagDict['e2t'][element])
-			except KeyError:
+			if not view.hasElement(element):
 				s1.clear()
 				break
+			s1.intersection_update(view.getTagsOf(element))
 
 		return list(s1)
 
+	getCommonTags = readLocked(getCommonTags)
+
 	# get frequency of the specified tag
 	def getTagsFrequency(self, tagList = [], sortOrder=None):
 		"""
@@ -561,7 +1349,7 @@ class Tagging:
 		@return: List of Tuples of the form (tag, frequency)
 		@rtype: C{list}
 		"""
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.tagDB.getView()
 		if err != 0:
 			return []
 
@@ -570,7 +1358,7 @@ class Tagging:
 
 		retList = []
 		for tag in tagList:
-			freq = len(tagDict['t2e'].get(tag, []))
+			freq = view.getTagCount(tag)
 			retList.append((tag, freq))
 
 		if sortOrder:
@@ -578,6 +1366,8 @@ class Tagging:
 			
 		return retList
 
+	getTagsFrequency = readLocked(getTagsFrequency)
+
 	def getElements(self, tagList=[], elementList=[]):
 		"""
 		T.getElements(tagList, elementList) -> Get a subset of elements from elementList such that the elements are tagged with tags from tagList
@@ -592,38 +1382,36 @@ class Tagging:
 		@rtype: C{list}
 		"""
 
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.__getView()
 		if err != 0:
 			return []
 
-		if len(tagList) == 0:
-			if len(elementList) > 0:
-				return elementList
-			else:
-				return tagDict['e2t'].keys()
-
-		# Initialize a set with list of elements
-		s1 = tagDict['t2e'].get(tagList[0], set([])).copy()
-		try:
+		if len(tagList) == 0 and len(elementList) > 0:
+			return elementList
 
-			# For each tag in the tag list, get elements asociated with the tag
-			# the existing set of elements will be intersected with elements associated
-			# with the current tag
-			for tag in tagList[1:]:
-				s1.intersection_update(tagDict['t2e'][tag])
+		if 0 < len(elementList) <= Tagging.PROBE_ELEMENTS:
+			# Looking at the tags of a few elements is cheaper than intersecting the tags
+			tagSet = set(tagList)
+			return [e for e in elementList if view.hasElement(e) and tagSet.issubset(view.getTagsOf(e))]
 
-			if len(elementList) > 0:
-				s1.intersection_update(set(elementList))
+		key = ('getElements', frozenset(tagList))
+		l = self.queryCache.get(key)
+		if l is None:
+			if len(tagList) == 0:
+				l = list(view.getAllElements())
+				self.queryCache.put(key, l)
+			else:
+				# Get the elements which are associated with all the tags in the tag list
+				l = list(self.__intersectPath(view, tagList))
+				self.queryCache.put(key, l, frozenset(tagList))
 
-		except KeyError:
-			s1.clear()
+		if len(elementList) > 0:
+			elementSet = set(elementList)
+			return [e for e in l if e in elementSet]
 
-		# s1 now contains those elements which are associated with all the tags
-		# in the tag list
+		return list(l)
 
-		# Convert the set to list
-		l = list(s1)
-		return l
+	getElements = readLocked(getElements)
 
 	def elementExists(self, element):
 		"""
@@ -635,14 +1423,13 @@ class Tagging:
 		@return: True is element exists, False otherwise
 		@rtype: C{bool}
 		"""
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.tagDB.getView()
 		if err != 0:
 			return ""
 			
-		if element in tagDict['e2t'].keys():
-			return True
-		else:
-			return False
+		return view.hasElement(element)
+
+	elementExists = readLocked(elementExists)
 
 	def tagExists(self, tag):
 		"""
@@ -654,14 +1441,145 @@ class Tagging:
 		@return: True if Tag exists, False otherwise
 		@rtype: C{bool}
 		"""
-		err, tagDict = self.tagDB.getDataRO()
+		err, view = self.__getView()
 		if err != 0:
 			return ""
 			
-		if tag in tagDict['t2e'].keys():
-			return True
-		else:
-			return False
+		return self.tagNames.lookup(tag, view)
+
+	tagExists = readLocked(tagExists)
+
+	def getAllTags(self):
+		"""
+		T.getAllTags() -> Get a list of all tags
+
+		Unlike L{getTagsForTags} with an empty list of tags this does not look at the elements.
+
+		@return: List of tags
+		@rtype: C{list}
+		"""
+		err, view = self.__getView()
+		if err != 0:
+			return []
+
+		return list(self.tagNames.getTags(view))
+
+	getAllTags = readLocked(getAllTags)
+
+	##### Iterators over query results
+	#
+	# The iterators only paginate: a result is computed and sorted as a whole the first
+	# time it is asked for and kept in the query cache, so that taking the following
+	# pages only costs the size of the page. The posting lists are not walked in their
+	# stored order, only the index backend keeps them ordered and its ids are not kept
+	# when a store is converted, so they could not be used as cursors.
+
+	def getSortKey(self, element):
+		"""
+		T.getSortKey(element) -> Key ordering the elements returned by the iterators
+
+		Strings are ordered by themselves, other elements by their pickled form.
+		Distinct elements must have distinct keys.
+		"""
+		if isinstance(element, basestring):
+			return element
+		return elementKey(element)
+
+	def __sortEntries(self, keyedItems):
+		keyedItems.sort(key=lambda x: x[0])
+		return [k for k, item in keyedItems], [item for k, item in keyedItems]
+
+	def iterElements(self, tagList=[], limit=None, cursor=None, offset=0):
+		"""
+		T.iterElements(tagList, limit, cursor, offset) -> L{ResultIterator} over the elements tagged with all tags in tagList
+
+		The elements are returned in the order of L{getSortKey}.
+
+		@param tagList: List of tags. Defaults to all elements
+		@type tagList: List
+
+		@param limit: Maximum number of elements returned, None for no limit
+		@type limit: int
+
+		@param cursor: Continue after the element with this key, the cursor of an earlier
+			iterator. None starts with the first element.
+
+		@param offset: Number of elements skipped
+		@type offset: int
+		"""
+		err, view = self.__getView()
+		if err != 0:
+			return ResultIterator(([], []), limit, cursor, offset)
+
+		key = ('iterElements', frozenset(tagList))
+		entries = self.queryCache.get(key)
+		if entries is None:
+			if len(tagList) == 0:
+				elements, tags = view.getAllElements(), None
+			else:
+				elements, tags = self.__intersectPath(view, tagList), frozenset(tagList)
+			entries = self.__sortEntries([(self.getSortKey(e), e) for e in elements])
+			self.queryCache.put(key, entries, tags)
+
+		return ResultIterator(entries, limit, cursor, offset)
+
+	iterElements = readLocked(iterElements)
+
+	def iterTagsForElements(self, elementList=[], limit=None, cursor=None, offset=0):
+		"""
+		T.iterTagsForElements(elementList, limit, cursor, offset) -> L{ResultIterator} over the tags associated with any of the elements
+
+		The tags are returned in sorted order. See L{iterElements} for the other parameters.
+
+		@param elementList: List of elements. Defaults to all tags
+		@type elementList: List
+		"""
+		err, view = self.__getView()
+		if err != 0:
+			return ResultIterator(([], []), limit, cursor, offset)
+
+		elementSet = frozenset(elementList)
+		key = ('iterTagsForElements', elementSet)
+		entries = self.queryCache.get(key)
+		if entries is None:
+			if len(elementList) == 0:
+				tags = sorted(self.tagNames.getTags(view))
+				self.queryCache.put(key, (tags, tags))
+			else:
+				tags = sorted(view.getTagsForElements(elementList))
+				self.queryCache.put(key, (tags, tags), frozenset(), elementSet)
+			entries = tags, tags
+
+		return ResultIterator(entries, limit, cursor, offset)
+
+	iterTagsForElements = readLocked(iterTagsForElements)
+
+	def iterTagsAndElementsForTags(self, tagList=[], beRestrictive=False, getCover=False, coverLimit=None,
+			limit=None, cursor=None, offset=0):
+		"""
+		T.iterTagsAndElementsForTags(tagList, beRestrictive, getCover, coverLimit, limit, cursor, offset) -> L{ResultIterator} over the result of L{getTagsAndElementsForTags}
+
+		Returns (L{Tagging.ELEMENT}, element) for the elements followed by (L{Tagging.TAG}, tag)
+		for the tags. Elements are ordered by L{getSortKey} and tags by themselves.
+		See L{iterElements} for the other parameters.
+		"""
+		err, view = self.__getView()
+		if err != 0:
+			return ResultIterator(([], []), limit, cursor, offset)
+
+		key = ('iterTagsAndElementsForTags', frozenset(tagList), beRestrictive, getCover, coverLimit)
+		entries = self.queryCache.get(key)
+		if entries is None:
+			(retTagList, retElementList), tags, elements = self.__getTagsAndElementsForTags(view,
+					tagList, beRestrictive, getCover, coverLimit)
+			keyedItems = [((Tagging.ELEMENT, self.getSortKey(e)), (Tagging.ELEMENT, e)) for e in retElementList]
+			keyedItems.extend([((Tagging.TAG, t), (Tagging.TAG, t)) for t in retTagList])
+			entries = self.__sortEntries(keyedItems)
+			self.queryCache.put(key, entries, tags, elements)
+
+		return ResultIterator(entries, limit, cursor, offset)
+
+	iterTagsAndElementsForTags = readLocked(iterTagsAndElementsForTags)
 
 def main():
 		tagging = Tagging("/tmp")
@@ -684,6 +1602,182 @@ def main():
 		print tagging.getElements(['pictures'])
 		print tagging.getTagsForElements(['1.txt'])
 
+def test():
+	import random
+	import copy
+	import shutil
+	import tempfile
+
+	def randomDelta(rand, tagDict):
+		e2t = tagDict['e2t']
+		t2e = tagDict['t2e']
+		elements = rand.sample(['e%d' % i for i in range(8)], rand.randint(0, 3))
+		tags = rand.sample(['t%d' % i for i in range(5)], rand.randint(0, 3))
+		delta = TagDelta()
+		op = rand.randint(0, 3)
+		if op == 0:
+			for element in elements:
+				if element not in e2t and not tags:
+					delta.newElements.add(element)
+				delta.added.update([(element, tag) for tag in tags
+						if tag not in e2t.get(element, ())])
+			if not elements:
+				delta.newTags.update([tag for tag in tags if tag not in t2e])
+		elif op == 1:
+			for element in elements:
+				if element not in e2t:
+					continue
+				removed = e2t[element] & set(tags or e2t[element])
+				delta.removed.update([(element, tag) for tag in removed])
+				if not (e2t[element] - removed):
+					delta.delElements.add(element)
+		elif op == 2:
+			for tag in tags:
+				if tag not in t2e:
+					continue
+				removed = t2e[tag] & set(elements or t2e[tag])
+				delta.removed.update([(element, tag) for element in removed])
+				if not (t2e[tag] - removed):
+					delta.delTags.add(tag)
+		else:
+			for element in elements:
+				if element in e2t:
+					delta.attrs[element] = rand.choice([None, rand.randint(0, 9)])
+		return delta
+
+	# Test1: Merging deltas has the same effect as applying them one after another,
+	# also when the merged delta is applied again to the result
+	rand = random.Random(1)
+	ok = True
+	for run in range(300):
+		initial = {'e2t' : {}, 't2e' : {}, 'e2a' : {}}
+		for i in range(rand.randint(0, 4)):
+			randomDelta(rand, initial).apply(initial)
+		expected = copy.deepcopy(initial)
+		merged = None
+		for i in range(rand.randint(1, 6)):
+			delta = randomDelta(rand, expected)
+			delta.apply(expected)
+			if merged is None:
+				merged = copy.deepcopy(delta)
+			else:
+				merged.merge(copy.deepcopy(delta))
+		result = copy.deepcopy(initial)
+		merged.apply(result)
+		again = copy.deepcopy(expected)
+		merged.apply(again)
+		if result != expected or again != expected:
+			ok = False
+			break
+	if ok:
+		print "Test1 succesful"
+	else:
+		print "Test1 Failed"
+
+	# Test2: A tag created and emptied again within one transaction is kept in the
+	# database as an empty tag, as if the changes had been written one by one
+	ok = True
+	for backend, journal in [('pickle', False), ('pickle', True), ('index', True), ('sqlite', False),
+			('sharded', True)]:
+		path = tempfile.mkdtemp()
+		try:
+			tagging = Tagging(path, backend=backend, journal=journal)
+			tagging.initDB(forceInit=True)
+			tagging.addTags(['keep'], ['x'])
+			tagging.setWriteCaching()
+			tagging.addTags(['e'], ['new'])
+			tagging.delElementsFromTags(['e'], ['new'])
+			tagging.doneWriteCaching()
+			tagging.sync()
+			for t in [tagging, Tagging(path)]:
+				if sorted(t.getElementsDict().keys()) != ['new', 'x'] or t.getTagsDict().keys() != ['keep']:
+					ok = False
+		finally:
+			shutil.rmtree(path, True)
+	if ok:
+		print "Test2 succesful"
+	else:
+		print "Test2 Failed"
+
+	# Test3: Random transactions give the same database as the changes made one by one
+	ok = True
+	for backend, journal in [('pickle', False), ('pickle', True), ('index', False), ('index', True)]:
+		path = tempfile.mkdtemp()
+		reference = tempfile.mkdtemp()
+		try:
+			tagging = Tagging(path, backend=backend, journal=journal)
+			tagging.initDB(forceInit=True)
+			sequential = Tagging(reference)
+			sequential.initDB(forceInit=True)
+			elements = ['e%d' % i for i in range(8)]
+			tags = ['t%d' % i for i in range(12)]
+			for run in range(100):
+				ops = []
+				for i in range(rand.randint(1, 5)):
+					op = rand.randint(0, 3)
+					args = (rand.sample(elements, rand.randint(0, 3)), rand.sample(tags, rand.randint(0, 2)))
+					ops.append((op, args))
+				for t in [tagging, sequential]:
+					if t is tagging:
+						t.setWriteCaching()
+					for op, (e, tl) in ops:
+						if op == 0:
+							t.addTags(e, tl)
+						elif op == 1:
+							t.delElementsFromTags(e, tl)
+						elif op == 2:
+							t.delTagsFromElements(tl, e)
+						else:
+							t.setAttrs(dict([(element, run) for element in e]))
+					if t is tagging:
+						t.doneWriteCaching()
+				for t in [tagging, Tagging(path)]:
+					if t.getTagsDict() != sequential.getTagsDict() or \
+							t.getElementsDict() != sequential.getElementsDict() or \
+							[t.getAttrs(e) for e in elements] != [sequential.getAttrs(e) for e in elements]:
+						ok = False
+		finally:
+			shutil.rmtree(path, True)
+			shutil.rmtree(reference, True)
+	if ok:
+		print "Test3 succesful"
+	else:
+		print "Test3 Failed"
+
+	# Test4: The backends list the same tags and elements for tag paths
+	paths = tempfile.mkdtemp()
+	try:
+		taggings = []
+		for backend in ['pickle', 'sqlite', 'index']:
+			path = os.path.join(paths, backend)
+			os.mkdir(path)
+			t = Tagging(path, backend=backend)
+			t.initDB(forceInit=True)
+			taggings.append(t)
+		for i in range(300):
+			element = 'e%d' % i
+			tags = [tag for tag in ['t%d' % j for j in range(8)] if rand.random() < 0.4]
+			# Elements listed as files of the paths, next to the tags of the other elements
+			if i % 10 == 0:
+				tags = ['t0', 't1']
+			elif i % 10 == 5:
+				tags = ['t2', 't3', 't4']
+			for t in taggings:
+				t.addTags([element], tags)
+		ok = True
+		for tagList in [['t0'], ['t0', 't1'], ['t2', 't3', 't4'], ['t7', 't0']]:
+			results = []
+			for t in taggings:
+				tags, elements = t.getTagsAndElementsForTags(tagList, True)
+				results.append((sorted(tags), sorted(elements), sorted(t.getElements(tagList))))
+			ok = ok and results[1:] == results[:-1] and 0 < len(results[0][1]) < len(results[0][2])
+	finally:
+		shutil.rmtree(paths, True)
+	if ok:
+		print "Test4 succesful"
+	else:
+		print "Test4 Failed"
+
 # TEST
 if __name__ == "__main__":
 	main()